@@ -3,38 +3,46 @@ import auser_page
 import os
 import traceback
 from sipr0n import util
-import glob
 from pathlib import Path
 import re
 import json
 import datetime
 from sipr0n import metadata
 from sipr0n import env
-
-
-class CustomPage(Exception):
-    pass
-
-
-def html2meta(txt):
-    # auto generated
-    # Make some assumptions how its formatted
-    # initViewer({"tilesAlignedTopLeft": true, "scale": null, ... , "name_raw": "???"});
-    for l in txt.split("\n"):
-        if l.find("initViewer") < 0:
-            continue
-        js = l.strip().replace("initViewer(", "").replace(");", "")
-        return json.loads(js)
-    # A special custom page
-    # /var/www/map/mos/6581r3/vec-a/index.html
-    # print a warning and move on
-    if "SiProjection" in txt:
-        raise CustomPage()
-
-    raise ValueError("unexpected page")
-
-
-def guess_collection(person_cc, copyright_db):
+from sipr0n import maptree
+from sipr0n import htmlmeta
+
+
+# Copyright holder substring => collection
+# For names that don't match copyright.txt exactly
+# Earlier entries win if several match
+COLLECTION_ALIASES = (
+    ("travis", "goodspeed"),
+    ("texplained", "texplained"),
+    ("digshadow", "mcmaster"),
+    ("caps0ff", "caps0ff"),
+    ("gerlinsky", "gerlinsky"),
+    ("nats", "nats"),
+    ("furrtek", "furrtek"),
+    ("whitequark", "whitequark"),
+    ("shirriff", "shirriff"),
+    ("lempinen", "lempinen"),
+    ("riddle", "sean"),
+    ("decap", "drdecap"),
+    ("nico", "nico"),
+    ("ogoun", "ogun"),
+)
+COLLECTION_ALIAS_PRIORITY = dict([
+    (alias, i) for i, (alias, _collection) in enumerate(COLLECTION_ALIASES)
+])
+# Zero width so every position is tried, including overlapping aliases
+# At a given position the alternation takes the earliest table entry
+COLLECTION_ALIAS_RE = re.compile(
+    "(?=(%s))" %
+    "|".join([re.escape(alias) for alias, _collection in COLLECTION_ALIASES]))
+
+
+def guess_collection(person_cc, copyright_names=None):
     """
     | drdecap       | Dr. Decap                                                      |       |
     | furrtek       | Furrtek CC BY 4.0                                              |       |
@@ -42,59 +50,46 @@ def guess_collection(person_cc, copyright_db):
     | marchcat      | FIXME                                                          |       |
     | marmontel     | Boris Marmontel, CC BY 4.0                                     |       |
     | nico          | nico <xxx@xxx.net>, CC BY 3.0     
+    copyright_names: metadata.index_copyright_names() style index
+    default metadata.copyright_names()
     """
     person_cc = person_cc.split(",")[0].split("CC")[0].lower()
     print("  Guessing:", person_cc)
     if person_cc == "FIXME" or not person_cc or person_cc == "None" or person_cc == "none":
         return None
-    for this_collection, cstr in copyright_db.items():
-        this_collection = this_collection.lower()
-        cstr = cstr.lower()
-        cstr = cstr.split(",")[0].split("CC")[0]
-        if person_cc == cstr:
-            return this_collection
-
-    if "travis" in person_cc:
-        return "goodspeed"
-    if "texplained" in person_cc:
-        return "texplained"
-    if "digshadow" in person_cc:
-        return "mcmaster"
-    if "caps0ff" in person_cc:
-        return "caps0ff"
-    if "gerlinsky" in person_cc:
-        return "gerlinsky"
-    if "nats" in person_cc:
-        return "nats"
-    if "furrtek" in person_cc:
-        return "furrtek"
-    if "whitequark" in person_cc:
-        return "whitequark"
-    if "shirriff" in person_cc:
-        return "shirriff"
-    if "lempinen" in person_cc:
-        return "lempinen"
-    if "riddle" in person_cc:
-        return "sean"
-    if "decap" in person_cc:
-        return "drdecap"
-    if "nico" in person_cc:
-        return "nico"
-    if "ogoun" in person_cc:
-        return "ogun"
+    if copyright_names is None:
+        copyright_names = metadata.copyright_names()
+    ret = copyright_names.get(person_cc)
+    if ret:
+        return ret
+
+    aliases = [m.group(1) for m in COLLECTION_ALIAS_RE.finditer(person_cc)]
+    if aliases:
+        alias = min(aliases, key=lambda a: COLLECTION_ALIAS_PRIORITY[a])
+        return COLLECTION_ALIASES[COLLECTION_ALIAS_PRIORITY[alias]][1]
 
     print(f"  WARNING: failed to guess copyright: {person_cc}")
     return None
 
 
-def run_page(fn, meta, copyright_db):
+def run_page(fn, meta, copyright_names=None, mapj=None):
+    """
+    mapj: maptree entry for fn, if already indexed
+    """
     custom = False
-    try:
-        pagej = html2meta(open(fn).read())
-    except CustomPage:
+    if mapj is None:
+        try:
+            pagej = htmlmeta.extract(fn)
+        except htmlmeta.CustomPage:
+            pagej = None
+            custom = True
+    else:
+        if mapj["error"]:
+            raise ValueError(mapj["error"])
+        pagej = mapj["meta"]
+        custom = mapj["custom"]
+    if custom:
         print("  WARNING: custom page")
-        pagej = None
-        custom = True
 
     # Stack overflow argues this isn't proper but seems to work well enough
     file_year = datetime.datetime.fromtimestamp(os.path.getctime(fn)).year
@@ -119,14 +114,15 @@ def run_page(fn, meta, copyright_db):
         if m:
             parsed_year = int(m.group(1))
             person_cc = m.group(2)
-            parsed_collection = guess_collection(person_cc, copyright_db)
+            parsed_collection = guess_collection(person_cc, copyright_names)
         else:
             # &copy;  Travis Goodspeed, CC0
             # uggghhh
             m = re.match(r"&copy; (.+)", map_copyright)
             if m:
                 person_cc = m.group(1)
-                parsed_collection = guess_collection(person_cc, copyright_db)
+                parsed_collection = guess_collection(person_cc,
+                                                     copyright_names)
             else:
                 print(map_copyright)
                 assert 0
@@ -157,12 +153,13 @@ def run(fndir=None, fn_out=None, ignore_errors=False):
     Search /wiki and try to guess linked images based on collection
     """
     meta = {}
-    copyright_db = metadata.load_copyright_db()
+    # Built once per copyright.txt, not per page
+    copyright_names = metadata.copyright_names()
     env.setup_env_default()
     if fndir:
         assert ".html" in fndir
         assert os.path.isfile(fndir)
-        run_page(fndir, meta, copyright_db=copyright_db)
+        run_page(fndir, meta, copyright_names=copyright_names)
     else:
         fndir = env.MAP_DIR
         assert "www/map" in fndir
@@ -175,22 +172,23 @@ def run(fndir=None, fn_out=None, ignore_errors=False):
 
         errors = 0
         npages = 0
-        for vendor_dir in glob.glob("%s/*" % fndir):
-            # print(vendor_dir)
-            for chipid_dir in glob.glob("%s/*" % vendor_dir):
-                # print(chipid_dir)
-                for html_page in glob.glob("%s/*/index.html" % chipid_dir):
-                    print("Page:", html_page)
-                    print("  %s" % topage(html_page))
-                    try:
-                        npages += 1
-                        run_page(html_page, meta, copyright_db=copyright_db)
-                    except Exception as e:
-                        errors += 1
-                        if ignore_errors:
-                            traceback.print_exc()
-                        else:
-                            raise
+        tree = maptree.load(fndir)
+        for chip, mapj in maptree.maps(tree):
+            html_page = maptree.map_index_fn(tree, chip, mapj)
+            print("Page:", html_page)
+            print("  %s" % topage(html_page))
+            try:
+                npages += 1
+                run_page(html_page,
+                         meta,
+                         copyright_names=copyright_names,
+                         mapj=mapj)
+            except Exception as e:
+                errors += 1
+                if ignore_errors:
+                    traceback.print_exc()
+                else:
+                    raise
         js = json.dumps(meta, sort_keys=True, indent=4, separators=(',', ': '))
         if fn_out:
             open(fn_out, "w").write(js)
@@ -7,13 +7,12 @@ Also create baseline metadata noting file types
 import shutil
 import re
 import os
-import glob
 from pathlib import Path
 import traceback
 from sipr0n import util
 from sipr0n import simap
-import glob
 from sipr0n import env
+from sipr0n import maptree
 
 
 def single_fn_add_user(fn, collection):
@@ -40,64 +39,63 @@ def run(mapdir, dry=False, ignore_errors=False):
     new_collection = "unknown"
     assert "www/map" in mapdir
     assert os.path.basename(mapdir) == "map"
-    for vendor_dir in sorted(os.listdir(mapdir)):
-        vendor_dir = os.path.join(mapdir, vendor_dir)
-        if not os.path.isdir(vendor_dir):
-            print("Skip special", vendor_dir)
+    tree = maptree.load(mapdir)
+    for chip in maptree.chips(tree):
+        print("Check", chip["chipid"])
+        chipid_dir = maptree.chip_dir(tree, chip)
+        mfn = chipid_dir + "/.manifest"
+        if os.path.exists(mfn):
+            print("  skip: eixsting manifest")
             continue
-        for chipid_dir in sorted(os.listdir(vendor_dir)):
-            print("Check", chipid_dir)
-            chipid_dir = os.path.join(vendor_dir, chipid_dir)
-            mfn = chipid_dir + "/.manifest"
-            if os.path.exists(mfn):
-                print("  skip: eixsting manifest")
+        """
+        chipid/single high resolution photos
+        """
+        single_dir = os.path.join(chipid_dir, "single")
+        for single in chip["singles"]:
+            base_fn = single["basename"]
+            print(f"  check {base_fn}")
+            if ".thumb" in base_fn:
+                print("    Skip .thumb")
                 continue
-            """
-            chipid/single high resolution photos
-            """
-            single_dir = os.path.join(chipid_dir, "single")
-            if os.path.exists(single_dir):
-                for base_fn in sorted(os.listdir(single_dir)):
-                    print(f"  check {base_fn}")
-                    if ".thumb" in base_fn:
-                        print("    Skip .thumb")
-                        continue
-                    fn_orig = os.path.join(single_dir, base_fn)
-                    if not os.path.isfile(fn_orig):
-                        print("    Skip dir")
-                        continue
-                    if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
-                        raise ValueError("Unexpected fn %s" % fn_orig)
-                    base_fn_new = single_fn_add_user(base_fn,
-                                                     collection=new_collection)
-                    print(f"    {base_fn} => {base_fn_new}")
-                    fn_new = os.path.join(single_dir, base_fn_new)
-                    reg_fn = os.path.join("single", base_fn_new)
-                    print(f"    manfesting image: {reg_fn}")
-                    print(f"    mv {fn_orig} => {fn_new}")
-                    if not dry:
-                        shutil.move(fn_orig, fn_new)
-                        simap.map_manifest_add_file(chipid_dir,
-                                                    reg_fn,
-                                                    collection=new_collection,
-                                                    type_="image")
-            """
-            Map file
-            """
-            for index_fn in sorted(glob.glob(chipid_dir + "/*/index.html")):
-                print(f"  check {index_fn}")
-                orig_map_dir = os.path.basename(os.path.dirname(index_fn))
-                new_map_dir = new_collection + "_" + orig_map_dir
-                fn_orig = os.path.join(chipid_dir, orig_map_dir)
-                fn_new = os.path.join(chipid_dir, new_map_dir)
-                print(f"    manfesting map: {new_map_dir}")
-                print(f"    mv {fn_orig} => {fn_new}")
-                if not dry:
-                    shutil.move(fn_orig, fn_new)
-                    simap.map_manifest_add_file(chipid_dir,
-                                                new_map_dir,
-                                                collection=new_collection,
-                                                type_="map")
+            fn_orig = os.path.join(single_dir, base_fn)
+            if not os.path.isfile(fn_orig):
+                print("    Skip dir")
+                continue
+            if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
+                raise ValueError("Unexpected fn %s" % fn_orig)
+            base_fn_new = single_fn_add_user(base_fn,
+                                             collection=new_collection)
+            print(f"    {base_fn} => {base_fn_new}")
+            fn_new = os.path.join(single_dir, base_fn_new)
+            reg_fn = os.path.join("single", base_fn_new)
+            print(f"    manfesting image: {reg_fn}")
+            print(f"    mv {fn_orig} => {fn_new}")
+            if not dry:
+                shutil.move(fn_orig, fn_new)
+                simap.map_manifest_add_file(chipid_dir,
+                                            reg_fn,
+                                            collection=new_collection,
+                                            type_="image")
+        """
+        Map file
+        """
+        for mapj in chip["maps"]:
+            index_fn = maptree.map_index_fn(tree, chip, mapj)
+            print(f"  check {index_fn}")
+            orig_map_dir = os.path.basename(os.path.dirname(index_fn))
+            new_map_dir = new_collection + "_" + orig_map_dir
+            fn_orig = os.path.join(chipid_dir, orig_map_dir)
+            fn_new = os.path.join(chipid_dir, new_map_dir)
+            print(f"    manfesting map: {new_map_dir}")
+            print(f"    mv {fn_orig} => {fn_new}")
+            if not dry:
+                shutil.move(fn_orig, fn_new)
+                simap.map_manifest_add_file(chipid_dir,
+                                            new_map_dir,
+                                            collection=new_collection,
+                                            type_="map")
+        if not dry:
+            simap.map_manifest_compact(chipid_dir)
 
 
 def main():
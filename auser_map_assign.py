@@ -6,14 +6,13 @@ Use copyright databases to rename files in /map
 import shutil
 import re
 import os
-import glob
 from pathlib import Path
 import traceback
 from sipr0n import util
 from sipr0n import simap
-import glob
 import json
 from sipr0n import env
+from sipr0n import maptree
 import datetime
 
 
@@ -174,98 +173,57 @@ def run(archive_db=None, map_db=None, dry=False, ignore_errors=False):
     new_collection = "unknown"
     assert "www/map" in mapdir
     assert os.path.basename(mapdir) == "map"
-    for vendor_dir in sorted(os.listdir(mapdir)):
-        vendor_dir = os.path.join(mapdir, vendor_dir)
-        if not os.path.isdir(vendor_dir):
-            print("skip non-dir", vendor_dir)
-            continue
-        for chipid_dir in sorted(os.listdir(vendor_dir)):
-            print("")
-            chipid_dir = os.path.join(vendor_dir, chipid_dir)
-            print("Check", chipid_dir)
-
-            single_dir = os.path.join(chipid_dir, "single")
-            if os.path.exists(single_dir):
-                for base_fn in sorted(os.listdir(single_dir)):
-                    print(f"Found single/{base_fn}")
-                    fn_orig = os.path.join(single_dir, base_fn)
-                    if not os.path.isfile(fn_orig):
-                        print("  skip non-file")
-                        continue
-                    if ".thumb" in base_fn:
-                        # Instead of fixing thumbnails, just regenerate them
-                        print(f"  rm {fn_orig}")
-                        if not dry:
-                            os.unlink(fn_orig)
-                    else:
-                        if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
-                            raise ValueError("Unexpected fn %s" % fn_orig)
-                        new_meta = collection_assign_single(
-                            base_fn, archive_db=archive_db, map_db=map_db)
-                        if not new_meta:
-                            print("  Completely failed to assign :(")
-                        else:
-                            if "copyright_year" not in new_meta:
-                                file_year = datetime.datetime.fromtimestamp(
-                                    os.path.getctime(fn_orig)).year
-                                new_meta["copyright_year"] = file_year
-                                print(f"  Detect file year {file_year}")
-                            new_collection = new_meta.get("collection")
-                            if not new_collection:
-                                print("  Matched w/o collection :(")
-                                manifest_fn = fn_orig
-                            else:
-                                print(f"  Matched collection {new_collection}")
-                                base_fn_new = single_fn_rename_collection(
-                                    base_fn, collection=new_collection)
-                                print(f"  {base_fn} => {base_fn_new}")
-                                fn_new = os.path.join(single_dir, base_fn_new)
-                                reg_fn = os.path.join("single", base_fn_new)
-                                manifest_fn = reg_fn
-                                print(f"  mv {fn_orig} => {fn_new}")
-                                if not dry:
-                                    shutil.move(fn_orig, fn_new)
+    tree = maptree.load(mapdir)
+    for chip in maptree.chips(tree):
+        print("")
+        chipid_dir = maptree.chip_dir(tree, chip)
+        print("Check", chipid_dir)
 
-                            copyright_year = new_meta["copyright_year"]
-                            print(
-                                f"  manifesting image: {manifest_fn}, year={copyright_year}"
-                            )
-                            if not dry:
-                                simap.map_manifest_add_file(
-                                    chipid_dir,
-                                    manifest_fn,
-                                    collection=new_meta.get("collection"),
-                                    copyright_year=copyright_year,
-                                    type_="image")
-            """
-            Map file
-            """
-            for index_fn in sorted(glob.glob(chipid_dir + "/*/index.html")):
-                print(f"Found {index_fn}")
-                orig_map_dir = os.path.basename(os.path.dirname(index_fn))
-                new_meta = collection_assign_map(index_fn,
-                                                 archive_db=archive_db,
-                                                 map_db=map_db)
+        single_dir = os.path.join(chipid_dir, "single")
+        for single in chip["singles"]:
+            base_fn = single["basename"]
+            print(f"Found single/{base_fn}")
+            fn_orig = os.path.join(single_dir, base_fn)
+            if not os.path.isfile(fn_orig):
+                print("  skip non-file")
+                continue
+            if ".thumb" in base_fn:
+                # Instead of fixing thumbnails, just regenerate them
+                print(f"  rm {fn_orig}")
+                if not dry:
+                    os.unlink(fn_orig)
+            else:
+                if not ".jpg" in fn_orig and not ".tif" in fn_orig and not ".png" in fn_orig and not ".xcf" in fn_orig:
+                    raise ValueError("Unexpected fn %s" % fn_orig)
+                new_meta = collection_assign_single(
+                    base_fn, archive_db=archive_db, map_db=map_db)
                 if not new_meta:
                     print("  Completely failed to assign :(")
                 else:
+                    if "copyright_year" not in new_meta:
+                        file_year = datetime.datetime.fromtimestamp(
+                            os.path.getctime(fn_orig)).year
+                        new_meta["copyright_year"] = file_year
+                        print(f"  Detect file year {file_year}")
                     new_collection = new_meta.get("collection")
                     if not new_collection:
                         print("  Matched w/o collection :(")
-                        manifest_fn = orig_map_dir
+                        manifest_fn = fn_orig
                     else:
                         print(f"  Matched collection {new_collection}")
-                        base_fn_new = map_fn_rename_collection(
-                            orig_map_dir, collection=new_collection)
-                        fn_orig = os.path.join(chipid_dir, orig_map_dir)
-                        fn_new = os.path.join(chipid_dir, base_fn_new)
-                        manifest_fn = base_fn_new
+                        base_fn_new = single_fn_rename_collection(
+                            base_fn, collection=new_collection)
+                        print(f"  {base_fn} => {base_fn_new}")
+                        fn_new = os.path.join(single_dir, base_fn_new)
+                        reg_fn = os.path.join("single", base_fn_new)
+                        manifest_fn = reg_fn
                         print(f"  mv {fn_orig} => {fn_new}")
                         if not dry:
                             shutil.move(fn_orig, fn_new)
+
                     copyright_year = new_meta["copyright_year"]
                     print(
-                        f"  manifesting map: {manifest_fn}, year={copyright_year}"
+                        f"  manifesting image: {manifest_fn}, year={copyright_year}"
                     )
                     if not dry:
                         simap.map_manifest_add_file(
@@ -273,7 +231,47 @@ def run(archive_db=None, map_db=None, dry=False, ignore_errors=False):
                             manifest_fn,
                             collection=new_meta.get("collection"),
                             copyright_year=copyright_year,
-                            type_="map")
+                            type_="image")
+        """
+        Map file
+        """
+        for mapj in chip["maps"]:
+            index_fn = maptree.map_index_fn(tree, chip, mapj)
+            print(f"Found {index_fn}")
+            orig_map_dir = os.path.basename(os.path.dirname(index_fn))
+            new_meta = collection_assign_map(index_fn,
+                                             archive_db=archive_db,
+                                             map_db=map_db)
+            if not new_meta:
+                print("  Completely failed to assign :(")
+            else:
+                new_collection = new_meta.get("collection")
+                if not new_collection:
+                    print("  Matched w/o collection :(")
+                    manifest_fn = orig_map_dir
+                else:
+                    print(f"  Matched collection {new_collection}")
+                    base_fn_new = map_fn_rename_collection(
+                        orig_map_dir, collection=new_collection)
+                    fn_orig = os.path.join(chipid_dir, orig_map_dir)
+                    fn_new = os.path.join(chipid_dir, base_fn_new)
+                    manifest_fn = base_fn_new
+                    print(f"  mv {fn_orig} => {fn_new}")
+                    if not dry:
+                        shutil.move(fn_orig, fn_new)
+                copyright_year = new_meta["copyright_year"]
+                print(
+                    f"  manifesting map: {manifest_fn}, year={copyright_year}"
+                )
+                if not dry:
+                    simap.map_manifest_add_file(
+                        chipid_dir,
+                        manifest_fn,
+                        collection=new_meta.get("collection"),
+                        copyright_year=copyright_year,
+                        type_="map")
+        if not dry:
+            simap.map_manifest_compact(chipid_dir)
 
 
 def main():
@@ -1,11 +1,16 @@
 import os
+import sys
 import argparse
-from time import sleep
 from glob import glob
 import shutil
+import heapq
+import time
+import concurrent.futures
+import queue
 
 import PIL
 from PIL import Image
+from PIL import features
 from watchdog.observers import Observer
 
 # Have to disable DecompressionBombError limits because these images are large
@@ -16,6 +21,11 @@ PIL.Image.MAX_IMAGE_PIXELS = None
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# sipr0n package lives in the parent dir
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sipr0n import probe
+from sipr0n import thumbs
+
 GALLERY_IMAGES = 20
 
 ALLOWED_ENDINGS = ["png", "jpg", "jpeg"]
@@ -29,11 +39,29 @@ assert os.path.exists(MAP_DIR)
 THUMBFILELIST = "gallery.txt"
 
 SMALL_MAX_WIDTH = SMALL_MAX_HEIGHT = 300
+# Extra thumbnails listed in the thumbs manifest (see sipr0n.thumbs)
+THUMB_SIZES = [150, 300, 600]
+THUMB_FORMATS = ["webp", "jpg"]
+THUMB_QUALITY = 85
+# Decode at least this much larger than the thumbnail so the final LANCZOS
+# pass has real pixels to filter (same idea as Image.thumbnail reducing_gap)
+DRAFT_GAP = 2.0
 
 FORCE_REGEN = False
 
+# Manual mode thumbnail worker processes
+JOBS = 1
+# Seconds between manual mode progress reports
+PROGRESS_INTERVAL = 10
+# Watch mode: process a batch once no events arrive for this many seconds
+BATCH_WINDOW = 2.0
+# ...but don't hold a batch longer than this during a steady stream
+BATCH_MAX_WAIT = 30.0
+
 
-def thumb(path):
+def thumb(path, force=None):
+    if force is None:
+        force = FORCE_REGEN
 
     if ".thumb" in path:
         return
@@ -44,33 +72,216 @@ def thumb(path):
     if path.split(os.path.sep)[-2] != "single":
         return
 
-    withoutext, ext = path.rsplit(".", 1)
-    smallthumbpath = withoutext + ".thumb." + ext
+    smallthumbpath = thumbs.legacy_fn(path)
 
-    if not FORCE_REGEN and os.path.exists(smallthumbpath):
-        return
+    if not force and os.path.exists(smallthumbpath):
+        if os.path.exists(thumbs.manifest_fn(path)):
+            return
+        # Thumbnailed before manifests existed
+        if seed_manifest(path):
+            return
 
-    print("Resizing", path)
+    # Cheap header check before committing to a full decode
+    try:
+        info = probe.probe(path)
+    except probe.ProbeError as e:
+        print("WARNING: skipping", path, e)
+        return
 
+    # Decode once, every size is resized from this
+    img = open_thumb_source(path)
+    print("Resizing", path, probe.format_wh(info),
+          "decode %ux%u" % (img.size[0], img.size[1]))
+    img.load()
+
+    variants = []
+    for size in sorted(set(THUMB_SIZES + [SMALL_MAX_WIDTH])):
+        small = img.copy()
+        small.thumbnail((size, size), Image.LANCZOS)
+        if size == SMALL_MAX_WIDTH:
+            small.save(smallthumbpath)
+        if size not in THUMB_SIZES:
+            continue
+        for fmt in THUMB_FORMATS:
+            fn = thumbs.variant_fn(path, size, fmt)
+            save_variant(small, fn, fmt)
+            variants.append({
+                "fn": os.path.basename(fn),
+                "size": size,
+                "format": fmt,
+                "width": small.size[0],
+                "height": small.size[1],
+                "bytes": os.path.getsize(fn),
+            })
+    thumbs.write_manifest(path, info, variants)
+
+
+def seed_manifest(path):
+    """
+    Write a manifest listing the thumbnails already on disk
+    Only thumbnails at least as new as the image are listed
+    Missing sizes aren't made here, use --force to fill them in
+    Return False if the image needs fresh thumbnails instead
+    """
+    mtime = os.path.getmtime(path)
+    try:
+        if os.path.getmtime(thumbs.legacy_fn(path)) < mtime:
+            return False
+        info = probe.probe(path)
+    except (FileNotFoundError, probe.ProbeError):
+        # Let the full pass report it
+        return False
+
+    variants = []
+    for size in sorted(set(THUMB_SIZES)):
+        for fmt in THUMB_FORMATS:
+            fn = thumbs.variant_fn(path, size, fmt)
+            try:
+                st = os.stat(fn)
+                if st.st_mtime < mtime:
+                    continue
+                # Header only
+                with Image.open(fn) as img:
+                    width, height = img.size
+            except OSError:
+                # Missing or unreadable: leave it out
+                continue
+            variants.append({
+                "fn": os.path.basename(fn),
+                "size": size,
+                "format": fmt,
+                "width": width,
+                "height": height,
+                "bytes": st.st_size,
+            })
+    thumbs.write_manifest(path, info, variants)
+    print("Seeded manifest", path, "w/ %u variants" % len(variants))
+    return True
+
+
+def save_variant(img, fn, fmt):
+    if fmt == "jpg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    elif fmt == "webp" and img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if img.mode in ("LA", "P", "PA") else "RGB")
+    img.save(fn, thumbs.PIL_FORMATS[fmt], quality=THUMB_QUALITY)
+
+
+def source_size():
+    # Largest thumbnail + headroom for the final LANCZOS pass
+    return int(max(THUMB_SIZES + [SMALL_MAX_WIDTH]) * DRAFT_GAP)
+
+
+def path_to_map_dir(path):
+    """
+    MAP_DIR/vendor/chipid/single/vendor_chipid_user_flavor.jpg
+    => MAP_DIR/vendor/chipid/user_flavor
+    """
+    return MAP_DIR + "/" + os.path.sep.join(
+        os.path.basename(path).split(".", 1)[0].split("_", 2))
+
+
+def open_thumb_source(path):
+    """
+    Open path set up to decode only as much resolution as the thumbnail needs
+
+    JPEG is decoded directly at 1/2, 1/4 or 1/8 scale in the DCT domain
+    (draft()) so a 30000x30000 die shot is never fully allocated
+    Other formats decode at full size
+    """
     img = Image.open(path)
-    img.thumbnail((SMALL_MAX_WIDTH, SMALL_MAX_HEIGHT), Image.LANCZOS)
-    img.save(smallthumbpath)
-
-
-def thumbfilelist():
+    if img.format == "JPEG":
+        img.draft(None, (source_size(), source_size()))
+    return img
+
+
+def is_thumb_path(path):
+    # MAP_DIR/vendor/chipid/single/x.thumb.jpg
+    return ".thumb." in os.path.basename(path) and path.split(
+        os.path.sep)[-2] == "single"
+
+
+class GalleryIndex:
+    """
+    Newest thumbnails by mtime without rescanning the map tree
+
+    Keeps a min-heap of the newest CAPACITY thumbnails
+    Seeded once with a full scan, then kept current from watch events
+    A few extra beyond GALLERY_IMAGES are kept so deletes rarely force a rescan
+    """
+    CAPACITY = GALLERY_IMAGES * 2
+
+    def __init__(self):
+        # path to mtime for the tracked newest thumbnails
+        self.mtimes = {}
+        # (mtime, path), may have stale entries (lazy deletion)
+        self.heap = []
+
+    def seed(self):
+        print("Scanning thumbnails")
+        self.mtimes = {}
+        self.heap = []
+        for path in glob(MAP_DIR + "/**/single/*.thumb.*", recursive=True):
+            try:
+                self.add(path, os.path.getmtime(path))
+            except FileNotFoundError:
+                pass
+        print("Tracking %u newest thumbnails" % len(self.mtimes))
+
+    def add(self, path, mtime=None):
+        if mtime is None:
+            mtime = os.path.getmtime(path)
+        if self.mtimes.get(path) == mtime:
+            return False
+        if path not in self.mtimes and len(
+                self.mtimes) >= self.CAPACITY and mtime <= self.heap[0][0]:
+            return False
+        self.mtimes[path] = mtime
+        heapq.heappush(self.heap, (mtime, path))
+        self.compact()
+        return True
+
+    def compact(self):
+        # Drop stale entries and evict the oldest beyond capacity
+        while self.heap:
+            mtime, path = self.heap[0]
+            if self.mtimes.get(path) != mtime:
+                heapq.heappop(self.heap)
+            elif len(self.mtimes) > self.CAPACITY:
+                heapq.heappop(self.heap)
+                del self.mtimes[path]
+            else:
+                break
+
+    def remove(self, path):
+        if path not in self.mtimes:
+            return False
+        del self.mtimes[path]
+        self.compact()
+        # Don't know what the next newest outside the index is
+        if len(self.mtimes) < GALLERY_IMAGES:
+            self.seed()
+        return True
+
+    def newest(self, n=GALLERY_IMAGES):
+        return [
+            path for path, _mtime in sorted(
+                self.mtimes.items(), key=lambda x: x[1], reverse=True)[:n]
+        ]
+
+
+gallery = GalleryIndex()
+
+
+def write_gallery(thumbpaths):
     print("Generating " + THUMBFILELIST)
 
-    thumbpaths = glob(MAP_DIR + "/**/single/*.thumb.*", recursive=True)
-
     result = []
 
-    for path in sorted(thumbpaths,
-                       key=lambda path: os.path.getmtime(path),
-                       reverse=True)[:GALLERY_IMAGES]:
+    for path in thumbpaths:
         parentdir = os.path.dirname(os.path.dirname(path))
 
-        tilemappath = MAP_DIR + "/" + os.path.sep.join(
-            os.path.basename(path).split(".", 1)[0].split("_", 2))
+        tilemappath = path_to_map_dir(path)
 
         if not os.path.isdir(tilemappath):
             print("WARNING: tilemap %s doesn't exist for thumb %s" %
@@ -78,6 +289,10 @@ def thumbfilelist():
             continue
 
         bigpath = path.replace(".thumb", "")
+        # Lighter webp etc if autothumb has made them
+        variant = thumbs.best_variant(bigpath, SMALL_MAX_WIDTH)
+        if variant:
+            path = os.path.join(os.path.dirname(path), variant)
 
         def relative(path):
             return path.replace("/var/www/", "")
@@ -98,39 +313,194 @@ def thumbfilelist():
     shutil.move(tmp_fn, THUMBFILELIST)
 
 
+def thumbfilelist():
+    """
+    Rebuild gallery.txt from a full scan
+    """
+    gallery.seed()
+    write_gallery(gallery.newest())
+
+
+def is_single_path(path):
+    # MAP_DIR/vendor/chipid/single/x
+    # Everything else (ex: thousands of map tiles) is ignored
+    return os.path.basename(os.path.dirname(path)) == "single"
+
+
+# (event type, path) from the observer thread
+# Moves are split into a delete and a create
+event_queue = queue.Queue()
+
+
 class event_handler:
     @staticmethod
     def dispatch(event):
-        if event.event_type == "created" and not event.is_directory:
+        # Runs on the observer thread: filter and queue only
+        if event.is_directory:
+            return
+        if event.event_type in ("created", "deleted"):
+            if is_single_path(event.src_path):
+                event_queue.put((event.event_type, event.src_path))
+        elif event.event_type == "moved":
+            if is_single_path(event.src_path):
+                event_queue.put(("deleted", event.src_path))
+            # Uploads are placed under a tmp name and then renamed in
+            if is_single_path(event.dest_path):
+                event_queue.put(("created", event.dest_path))
+
+
+def collect_batch():
+    """
+    Block for an event, then keep collecting until things are quiet for
+    BATCH_WINDOW (or BATCH_MAX_WAIT passed)
+    Return dict of path to the last event type seen for it
+    """
+    batch = {}
+    event_type, path = event_queue.get()
+    batch[path] = event_type
+    tstart = time.time()
+    while True:
+        timeout = min(BATCH_WINDOW, tstart + BATCH_MAX_WAIT - time.time())
+        if timeout <= 0:
+            break
+        try:
+            event_type, path = event_queue.get(timeout=timeout)
+        except queue.Empty:
+            break
+        batch[path] = event_type
+    return batch
+
+
+def process_batch(pool, batch):
+    """
+    Thumbnail new images on the pool, then update gallery.txt at most once
+    """
+    changed = False
+    futures = {}
+    for path, event_type in sorted(batch.items()):
+        if event_type == "deleted":
+            changed = gallery.remove(path) or changed
+        elif is_thumb_path(path):
             try:
-                thumb(event.src_path)
-                thumbfilelist()
-            except PIL.UnidentifiedImageError as e:
-                print(e)
+                changed = gallery.add(path) or changed
+            except FileNotFoundError:
+                # Already gone by the time the batch was handled
+                pass
+        elif ".thumb" in os.path.basename(path):
+            # Thumbnail variants and manifests
+            continue
+        else:
+            futures[pool.submit(thumb_worker, path, FORCE_REGEN)] = path
+
+    for future in concurrent.futures.as_completed(futures):
+        path = futures[future]
+        try:
+            error = future.result()
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        if error:
+            print("WARNING: failed %s: %s" % (path, error))
+            continue
+        # Don't wait for the thumbnail's own event to show it
+        withoutext, ext = path.rsplit(".", 1)
+        thumbpath = withoutext + ".thumb." + ext
+        if os.path.exists(thumbpath):
+            changed = gallery.add(thumbpath) or changed
+
+    if changed:
+        write_gallery(gallery.newest())
 
 
 def mode_observe():
+    # One full scan, then kept up to date from events
+    thumbfilelist()
     observer = Observer()
     observer.schedule(event_handler, MAP_DIR, recursive=True)
     observer.start()
 
     try:
-        while True:
-            sleep(1)
+        with make_pool() as pool:
+            while True:
+                batch = collect_batch()
+                print("Processing %u changed files" % len(batch))
+                process_batch(pool, batch)
     finally:
         observer.stop()
         observer.join()
 
 
+def init_worker(sizes, formats):
+    # Worker processes may not have run __main__'s argument parsing
+    global THUMB_SIZES
+    global THUMB_FORMATS
+    THUMB_SIZES = sizes
+    THUMB_FORMATS = formats
+
+
+def make_pool():
+    return concurrent.futures.ProcessPoolExecutor(max_workers=JOBS,
+                                                  initializer=init_worker,
+                                                  initargs=(THUMB_SIZES,
+                                                            THUMB_FORMATS))
+
+
+def thumb_worker(path, force):
+    """
+    Process pool entry point
+    Return None on success or an error message
+    One bad image shouldn't take down the whole run
+    """
+    try:
+        thumb(path, force=force)
+        return None
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%uh%02um%02us" % (seconds // 3600, seconds // 60 % 60,
+                              seconds % 60)
+
+
 def mode_manual():
     print("Manual mode: scanning")
     paths = []
     for ending in ALLOWED_ENDINGS:
         paths += glob(MAP_DIR + "/**/single/*." + ending, recursive=True)
 
-    print("Manual mode: generating thumbnails from %u files" % len(paths))
-    for path in paths:
-        thumb(path)
+    print("Manual mode: generating thumbnails from %u files w/ %u jobs" %
+          (len(paths), JOBS))
+    failures = {}
+    tstart = time.time()
+    last_print = tstart
+    with make_pool() as pool:
+        futures = dict([(pool.submit(thumb_worker, path, FORCE_REGEN), path)
+                        for path in paths])
+        for done, future in enumerate(concurrent.futures.as_completed(futures),
+                                      1):
+            path = futures[future]
+            try:
+                error = future.result()
+            except Exception as e:
+                # Ex: worker process killed by OOM
+                error = "%s: %s" % (type(e).__name__, e)
+            if error:
+                print("WARNING: failed %s: %s" % (path, error))
+                failures[path] = error
+            now = time.time()
+            if now - last_print >= PROGRESS_INTERVAL or done == len(paths):
+                last_print = now
+                eta = (now - tstart) / done * (len(paths) - done)
+                print("Manual mode: %u / %u (%0.1f%%), %u failed, ETA %s" %
+                      (done, len(paths), 100.0 * done / len(paths),
+                       len(failures), format_duration(eta)))
+
+    print("Manual mode: took %s" % format_duration(time.time() - tstart))
+    if failures:
+        print("Manual mode: %u failures" % len(failures))
+        for path, error in sorted(failures.items()):
+            print("  %s: %s" % (path, error))
 
     print("Manual mode: generating gallery.txt")
     thumbfilelist()
@@ -150,6 +520,17 @@ if __name__ == "__main__":
                         const=True,
                         default=False,
                         help="Force regeneration of existing thumbnails")
+    parser.add_argument("--jobs",
+                        "-j",
+                        type=int,
+                        default=1,
+                        help="Thumbnail processes (0: all CPUs)")
+    parser.add_argument("--thumb-sizes",
+                        default=",".join([str(x) for x in THUMB_SIZES]),
+                        help="Comma separated extra thumbnail sizes")
+    parser.add_argument("--thumb-formats",
+                        default=",".join(THUMB_FORMATS),
+                        help="Comma separated extra thumbnail formats")
     parser.add_argument("--gallery-txt",
                         default="/var/www/gallery.txt",
                         help="Output gallery file name")
@@ -157,4 +538,16 @@ if __name__ == "__main__":
     args = parser.parse_args()
     THUMBFILELIST = args.gallery_txt
     FORCE_REGEN = args.force
+    JOBS = args.jobs or os.cpu_count()
+    THUMB_SIZES = [int(x) for x in args.thumb_sizes.split(",") if x]
+    THUMB_FORMATS = []
+    for fmt in args.thumb_formats.split(","):
+        if not fmt:
+            continue
+        if fmt not in thumbs.PIL_FORMATS:
+            parser.error("Unknown thumbnail format %s" % (fmt, ))
+        if fmt == "webp" and not features.check("webp"):
+            print("WARNING: PIL lacks webp support, skipping webp thumbnails")
+            continue
+        THUMB_FORMATS.append(fmt)
     args.mode()
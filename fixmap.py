@@ -21,7 +21,6 @@ import subprocess
 import re
 import os
 import glob
-import json
 import pr0nmap
 from pr0nmap.groupxiv import GroupXIV
 from pr0nmap.groupxiv import write_js_meta
@@ -29,23 +28,14 @@ from pr0nmap.map import ImageMapSource
 import shutil
 import copy
 import img2doku
+from sipr0n import htmlmeta
 
 
-def extract_html_meta(fn):
+def extract_html_meta(fn, cache_=True):
     """
     initViewer({"tilesAlignedTopLeft": true, "scale": null, "layers": [{"imageSize": 4096, "tileExt": ".jpg", "width": 31000, "height": 31000, "URL": "l1", "tileSize": 250, "name": "???", "copyright": "2018 John McMaster, CC BY"}], "name": "out, &copy;2018 John McMaster, CC BY", "name_raw": "out"});
     """
-    for l in open(fn, "r"):
-        if "initViewer" in l:
-            break
-    else:
-        raise Exception("Failed to find initViewer")
-    l = l.strip()
-    l = l.replace("initViewer(", "")
-    # remove );
-    l = l[:-2]
-    j = json.loads(l)
-    return j
+    return htmlmeta.extract(fn, cache_=cache_)
 
 
 def img2j(img_fn):
@@ -65,7 +55,8 @@ def img2j(img_fn):
 
         m.run()
 
-        j = extract_html_meta(tmp_dir + "/index.html")
+        # Regenerated on every call
+        j = extract_html_meta(tmp_dir + "/index.html", cache_=False)
     finally:
         if os.path.exists(tmp_dir):
             shutil.rmtree(tmp_dir)
@@ -98,7 +89,8 @@ def run(map_dir, dry=False, verbose=False):
     print("")
     print("")
     for img_fn in glob.glob(map_dir + "/single/*.jpg"):
-        if ".thumb.jpg" in img_fn:
+        # Thumbnail and its variants (.thumb150.jpg etc)
+        if ".thumb" in os.path.basename(img_fn):
             continue
         print("")
         print("")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Build / refresh the content hash index used by simapper and sipager to spot
+duplicate uploads
+Only new or changed files are read, so this is cheap to run periodically
+"""
+
+from sipr0n import env
+from sipr0n import hashdb
+
+
+def run(dev=False, remote=False, dups=False, verbose=False):
+    env.setup_env(dev=dev, remote=remote)
+    db = hashdb.HashDB(env.HASH_DB)
+    try:
+        hashdb.update_index(db,
+                            env.MAP_DIR,
+                            env.ARCHIVE_WIKI_DIR,
+                            verbose=verbose)
+        if dups:
+            duplicates = db.duplicates()
+            print("Duplicate sets: %u" % len(duplicates))
+            for digest, fns in sorted(duplicates.items()):
+                print(digest)
+                for fn in fns:
+                    print("  " + fn)
+    finally:
+        db.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Update the archive content hash index')
+    parser.add_argument('--dev', action="store_true", help='Local test')
+    parser.add_argument('--remote', action="store_true", help='Remote test')
+    parser.add_argument('--dups',
+                        action="store_true",
+                        help='Print files with identical contents')
+    parser.add_argument('--verbose', action="store_true", help='Verbose')
+    args = parser.parse_args()
+
+    run(dev=args.dev, remote=args.remote, dups=args.dups, verbose=args.verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 from sipr0n.util import parse_map_image_vcufe
+from sipr0n import probe
+from sipr0n import thumbs
 
-import subprocess
+import concurrent.futures
 import os
 import glob
 
@@ -105,7 +107,11 @@ def process_fns(fns):
     for fn in fns:
         if os.path.isdir(fn):
             page_fns += list(glob.glob(fn + "/*.jpg"))
-            map_fns += list(glob.glob(fn + "/single/*.jpg"))
+            # Skip autothumb's x.thumb.jpg, x.thumb150.jpg etc
+            map_fns += [
+                x for x in glob.glob(fn + "/single/*.jpg")
+                if ".thumb" not in os.path.basename(x)
+            ]
         else:
             map_fns.append(fn)
 
@@ -113,9 +119,19 @@ def process_fns(fns):
     return map_fns, page_fns, vendor, chipid
 
 
-def image_2_thumb_name(fn):
+def image_2_thumb_name(fn, single_dir=None):
+    """
+    single_dir: if given, use the best variant from autothumb's manifest
+    when it has already run
+    """
     vendor_this, chipid_this, user_this, flavor, ext = parse_map_image_vcufe(
         fn)
+    if single_dir:
+        variant = thumbs.best_variant(os.path.join(single_dir, fn),
+                                      300,
+                                      formats=thumbs.WIKI_FORMATS)
+        if variant:
+            return variant
     return f"{vendor_this}_{chipid_this}_{user_this}_{flavor}.thumb.{ext}"
 
 
@@ -129,12 +145,11 @@ def add_maps(map_fns, vendor, chipid, user, map_chipid_url):
         assert chipid == chipid_this
         assert user == user_this
 
-        # vendor_chpiid_flavor.jpg JPEG 1158x750 1158x750+0+0 8-bit sRGB 313940B 0.000u 0:00.000
-        identify = subprocess.check_output(["identify", fn],
-                                           text=True)
-        wh = identify.split(" ")[2]
-        size = identify.split(" ")[6]
-        thumb_name = image_2_thumb_name(fnbase)
+        # Header only, usually already cached from simapper's sanity check
+        info = probe.probe(fn)
+        wh = probe.format_wh(info)
+        size = probe.format_size(info["size"])
+        thumb_name = image_2_thumb_name(fnbase, os.path.dirname(fn))
         image_thumb_txt = "{{" + f"{map_chipid_url}/single/{thumb_name}" + "}}"
         out += f"""\
 {image_thumb_txt}
@@ -146,39 +161,24 @@ def add_maps(map_fns, vendor, chipid, user, map_chipid_url):
     return out
 
 
-def run(
-    hi_fns=[],
-    print_links=True,
-    collect=None,
-    nspre="",
-    mappre="map",
-    host="https://siliconpr0n.org",
-    print_pack=True,
-    write=False,
-    overwrite=False,
-    write_lazy=False,
-    print_=True,
-    www_dir="/var/www",
-    code_txt=None,
-    header_txt=None,
-    # Auto guess if given hi_fn
-    vendor=None,
-    chipid=None,
-    page_fns=[],
-    map_fns=[],
-    force_tags=None,
-    force_fns=None):
+def resolve_page(hi_fns=[],
+                 collect=None,
+                 nspre="",
+                 mappre="map",
+                 host="https://siliconpr0n.org",
+                 www_dir="/var/www",
+                 vendor=None,
+                 chipid=None,
+                 page_fns=[],
+                 map_fns=[],
+                 pages_dir=None,
+                 page_path=None):
     """
-    hi_fns: to turn into /map entries under "die"
-    print_links: debug output
-    nspre: namespace prefix for protected namespace
-    
-    page_fns: untagged files. Will try to guess what they are for
-    force_header_fns: if given add these images to the heaer
-    force_pack_fns: if given add these images to the pack section and don't try to guess
-    force_die_fns: if given add these images to the die section and don't try to guess
+    Return dict with the files, names and paths for a page
+    See run() for arguments
+    pages_dir: default the wiki's page dir under www_dir
+    page_path: default the wiki page's file under pages_dir
     """
-
     if len(hi_fns):
         map_fns, page_fns, vendor, chipid = process_fns(hi_fns)
     else:
@@ -186,21 +186,36 @@ def run(
         assert chipid
 
     wiki_page = f"{nspre}{collect}:{vendor}:{chipid}"
-    wiki_url = f"{host}/archive/doku.php?id={wiki_page}"
-    map_chipid_url = f"{host}/{mappre}/{vendor}/{chipid}"
-
-    wiki_data_dir = www_dir + "/archive/data"
-    page_path = wiki_data_dir + "/pages/" + wiki_page.replace(":",
-                                                              "/") + ".txt"
-
-    exists = os.path.exists(page_path)
-
-    if print_links:
-        print(wiki_url)
-        print(wiki_url + ":s")
-        print("")
-        print("")
-
+    if pages_dir is None:
+        pages_dir = www_dir + "/archive/data/pages"
+    if page_path is None:
+        page_path = pages_dir + "/" + wiki_page.replace(":", "/") + ".txt"
+    return {
+        "map_fns": map_fns,
+        "page_fns": page_fns,
+        "vendor": vendor,
+        "chipid": chipid,
+        "wiki_page": wiki_page,
+        "wiki_url": f"{host}/archive/doku.php?id={wiki_page}",
+        "map_chipid_url": f"{host}/{mappre}/{vendor}/{chipid}",
+        "page_path": page_path,
+    }
+
+
+def render_page(page,
+                exists,
+                collect=None,
+                print_pack=True,
+                code_txt=None,
+                header_txt=None,
+                force_tags=None,
+                force_fns=None):
+    """
+    page: resolve_page()
+    exists: page already exists. Only add the new maps / images
+    """
+    wiki_page = page["wiki_page"]
+    page_fns = page["page_fns"]
     if page_fns is not None:
         page_fns_base = set()
         for fn in sorted(page_fns):
@@ -212,7 +227,7 @@ def run(
     if not exists:
         out += header_pack(wiki_page=wiki_page,
                            collect=collect,
-                           vendor=vendor,
+                           vendor=page["vendor"],
                            print_pack=print_pack,
                            page_fns_base=page_fns_base,
                            code_txt=code_txt,
@@ -238,11 +253,11 @@ def run(
         out += "</code>\n"
         out += "\n"
 
-    out += add_maps(map_fns,
-                    vendor=vendor,
-                    chipid=chipid,
+    out += add_maps(page["map_fns"],
+                    vendor=page["vendor"],
+                    chipid=page["chipid"],
                     user=collect,
-                    map_chipid_url=map_chipid_url)
+                    map_chipid_url=page["map_chipid_url"])
 
     if exists and force_fns:
         # Instead of placing images in specific places
@@ -253,10 +268,23 @@ def run(
         for fn in sorted(new_fns):
             out += simple_image(wiki_page, fn)
             out += "\n"
+    return out
+
 
-    def try_write():
-        if exists and not write_lazy and not overwrite:
-            raise Exception(f"Refusing to overwrite existing page {page_path}")
+def write_page(page_path,
+               out,
+               exists,
+               overwrite=False,
+               write_lazy=False,
+               mkdirs=True,
+               replace=False):
+    """
+    mkdirs: create the user / vendor dirs if needed
+    replace: truncate an existing page instead of appending to it
+    """
+    if exists and not write_lazy and not overwrite and not replace:
+        raise Exception(f"Refusing to overwrite existing page {page_path}")
+    if mkdirs:
         # Might be the first page for this vendor (or maybe even user?)
         vendor_dir = os.path.dirname(page_path)
         # There should at least be a user landing page
@@ -264,22 +292,215 @@ def run(
         user_dir = os.path.dirname(vendor_dir)
         if not os.path.exists(user_dir):
             write_lazy and print("mkdir " + user_dir)
-            os.mkdir(user_dir)
+            # exist_ok: simapper may be writing several pages at once
+            os.makedirs(user_dir, exist_ok=True)
         if not os.path.exists(vendor_dir):
             write_lazy and print("mkdir " + vendor_dir)
-            os.mkdir(vendor_dir)
-        with open(page_path, "a") as f:
-            f.write(out)
-        write_lazy and print("Wrote to " + page_path)
-        # subprocess.run(["sudo", "chown", "www-data:www-data", page_path])
-        return True
+            os.makedirs(vendor_dir, exist_ok=True)
+    with open(page_path, "w" if replace else "a") as f:
+        f.write(out)
+    write_lazy and print("Wrote to " + page_path)
+    # subprocess.run(["sudo", "chown", "www-data:www-data", page_path])
+    return True
+
+
+def run(
+    hi_fns=[],
+    print_links=True,
+    collect=None,
+    nspre="",
+    mappre="map",
+    host="https://siliconpr0n.org",
+    print_pack=True,
+    write=False,
+    overwrite=False,
+    write_lazy=False,
+    print_=True,
+    www_dir="/var/www",
+    code_txt=None,
+    header_txt=None,
+    # Auto guess if given hi_fn
+    vendor=None,
+    chipid=None,
+    page_fns=[],
+    map_fns=[],
+    force_tags=None,
+    force_fns=None):
+    """
+    hi_fns: to turn into /map entries under "die"
+    print_links: debug output
+    nspre: namespace prefix for protected namespace
+    
+    page_fns: untagged files. Will try to guess what they are for
+    force_header_fns: if given add these images to the heaer
+    force_pack_fns: if given add these images to the pack section and don't try to guess
+    force_die_fns: if given add these images to the die section and don't try to guess
+    """
+
+    page = resolve_page(hi_fns=hi_fns,
+                        collect=collect,
+                        nspre=nspre,
+                        mappre=mappre,
+                        host=host,
+                        www_dir=www_dir,
+                        vendor=vendor,
+                        chipid=chipid,
+                        page_fns=page_fns,
+                        map_fns=map_fns)
+    wiki_url = page["wiki_url"]
+    page_path = page["page_path"]
+
+    exists = os.path.exists(page_path)
+
+    if print_links:
+        print(wiki_url)
+        print(wiki_url + ":s")
+        print("")
+        print("")
+
+    out = render_page(page,
+                      exists,
+                      collect=collect,
+                      print_pack=print_pack,
+                      code_txt=code_txt,
+                      header_txt=header_txt,
+                      force_tags=force_tags,
+                      force_fns=force_fns)
 
     wrote = False
     if print_:
         print(out)
     if write:
-        wrote = try_write()
-    return (out, wiki_page, wiki_url, map_chipid_url, wrote, exists)
+        wrote = write_page(page_path,
+                           out,
+                           exists,
+                           overwrite=overwrite,
+                           write_lazy=write_lazy)
+    return (out, page["wiki_page"], wiki_url, page["map_chipid_url"], wrote,
+            exists)
+
+
+# resolve_page() / render_page() keyword arguments
+RESOLVE_ARGS = ("hi_fns", "collect", "nspre", "mappre", "host", "www_dir",
+                "vendor", "chipid", "page_fns", "map_fns", "pages_dir",
+                "page_path")
+RENDER_ARGS = ("collect", "print_pack", "code_txt", "header_txt",
+               "force_tags", "force_fns")
+BULK_THREADS = 8
+
+
+def pick_args(args, names):
+    return dict([(k, v) for k, v in args.items() if k in names])
+
+
+def run_many(pages,
+             write=False,
+             overwrite=False,
+             write_lazy=False,
+             replace=False,
+             threads=BULK_THREADS,
+             verbose=False,
+             **defaults):
+    """
+    Generate many pages in one call
+    pages: list of dict of run() page arguments, ex:
+        {"hi_fns": ["signetics_25120_mcmaster_mz.jpg"], "collect": "mcmaster"}
+    defaults: run() page arguments shared by all pages, ex: www_dir
+    replace: render full pages and write them over existing ones
+    Existence checks are done once per vendor dir and missing dirs created
+    up front. Pages are then rendered / written in parallel
+
+    Return a report like
+    {
+        "pages": [
+            {"wiki_page": ..., "wiki_url": ..., "map_chipid_url": ...,
+             "page_path": ..., "exists": False, "wrote": True, "error": None},
+        ],
+        "wrote": 1, "exists": 0, "errors": 0,
+    }
+    pages are in the same order as the input
+    """
+    for k in defaults:
+        assert k in RESOLVE_ARGS or k in RENDER_ARGS, k
+    entries = []
+    for args in pages:
+        args = dict(defaults, **args)
+        entry = {
+            "wiki_page": None,
+            "wiki_url": None,
+            "map_chipid_url": None,
+            "page_path": None,
+            "exists": False,
+            "wrote": False,
+            "error": None,
+        }
+        page = None
+        try:
+            page = resolve_page(**pick_args(args, RESOLVE_ARGS))
+            for k in ("wiki_page", "wiki_url", "map_chipid_url", "page_path"):
+                entry[k] = page[k]
+        except Exception as e:
+            entry["error"] = "%s: %s" % (type(e).__name__, e)
+        entries.append((args, page, entry))
+
+    # Two pages for the same chip would append over each other
+    seen = set()
+    for _args, page, entry in entries:
+        if page is None:
+            continue
+        if page["page_path"] in seen:
+            entry["error"] = "Duplicate page " + page["page_path"]
+        seen.add(page["page_path"])
+
+    # One listdir per vendor dir instead of a stat per page
+    listings = {}
+    for _args, page, entry in entries:
+        if page is None or entry["error"]:
+            continue
+        vendor_dir = os.path.dirname(page["page_path"])
+        if vendor_dir not in listings:
+            try:
+                listings[vendor_dir] = set(os.listdir(vendor_dir))
+            except FileNotFoundError:
+                listings[vendor_dir] = set()
+                if write:
+                    verbose and print("mkdir " + vendor_dir)
+                    os.makedirs(vendor_dir, exist_ok=True)
+        entry["exists"] = os.path.basename(
+            page["page_path"]) in listings[vendor_dir]
+
+    def process(item):
+        args, page, entry = item
+        if page is None or entry["error"]:
+            return
+        try:
+            out = render_page(page, entry["exists"] and not replace,
+                              **pick_args(args, RENDER_ARGS))
+            if write:
+                entry["wrote"] = write_page(page["page_path"],
+                                            out,
+                                            entry["exists"],
+                                            overwrite=overwrite,
+                                            write_lazy=write_lazy,
+                                            mkdirs=False,
+                                            replace=replace)
+            verbose and print("%s: %s" %
+                              (page["wiki_page"],
+                               "wrote" if entry["wrote"] else "ok"))
+        except Exception as e:
+            entry["error"] = "%s: %s" % (type(e).__name__, e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(process, entries))
+
+    report = {"pages": [entry for _args, _page, entry in entries]}
+    for k in ("wrote", "exists"):
+        report[k] = len([x for x in report["pages"] if x[k]])
+    report["errors"] = len([x for x in report["pages"] if x["error"]])
+    print("Pages: %u, wrote %u, existing %u, errors %u" %
+          (len(report["pages"]), report["wrote"], report["exists"],
+           report["errors"]))
+    return report
 
 
 def add_bool_arg(parser, yes_arg, default=False, **kwargs):
@@ -4,25 +4,12 @@ Take an input directory of image files and output directory sorted into pages
 '''
 
 import os
-import re
-import errno
-import subprocess
+import img2doku
 from sipr0n.util import parse_map_image_vcufe
 
 
-# https://stackoverflow.com/questions/600268/mkdir-p-functionality-in-python
-def mkdir_p(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:  # Python >2.5
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-
-
 def index_image_dir(dir_in):
-    """Return dict as ret[vendor][chipid][flavor] = file_name"""
+    """Return dict as ret[(user, vendor, chipid)][flavor] = file_name"""
     images = []
 
     for root, dirs, files in os.walk(dir_in):
@@ -30,33 +17,41 @@ def index_image_dir(dir_in):
             if file.endswith(".jpg"):
                 images.append(os.path.join(root, file))
 
-    vendors = {}
-    for image in images:
+    chips = {}
+    for image in sorted(images):
         vendor, chipid, user, flavor, e = parse_map_image_vcufe(image)
-        vendorm = vendors.setdefault(vendor, {})
-        chipidm = vendorm.setdefault(chipid, {})
-        chipidm[flavor] = image
-
-    return vendors
-
-
-def img2doku(filenames, page_fn, optstr=''):
-    subprocess.check_call('img2doku -L %s %s >%s' %
-                          (optstr, ' '.join(filenames), page_fn),
-                          shell=True)
-
-
-def run(dir_in, dir_out, img2doku_optstr=''):
-    vendors = index_image_dir(dir_in)
-    for vendor, chipids in vendors.iteritems():
-        vendor_dir = os.path.join(dir_out, vendor)
-        mkdir_p(vendor_dir)
-        for chipid, filenames in chipids.iteritems():
-            page_fn = os.path.join(vendor_dir, "%s.txt" % chipid)
-            print("%s" % page_fn)
-            for fn in filenames.values():
-                print('  %s' % fn)
-            img2doku(filenames.values(), page_fn, img2doku_optstr)
+        chipm = chips.setdefault((user, vendor, chipid), {})
+        chipm[flavor] = image
+
+    return chips
+
+
+def run(dir_in, dir_out, threads=img2doku.BULK_THREADS, verbose=False):
+    """
+    Write dir_out/vendor/chipid.txt for every chip found in dir_in
+    Existing pages are replaced
+    """
+    chips = index_image_dir(dir_in)
+    pages = []
+    for (user, vendor, chipid), filenames in sorted(chips.items()):
+        page_fn = os.path.join(dir_out, vendor, "%s.txt" % chipid)
+        print("%s" % page_fn)
+        for fn in filenames.values():
+            print('  %s' % fn)
+        pages.append({
+            "hi_fns": sorted(filenames.values()),
+            "collect": user,
+            "page_path": page_fn,
+        })
+    report = img2doku.run_many(pages,
+                               write=True,
+                               replace=True,
+                               threads=threads,
+                               verbose=verbose)
+    for entry in report["pages"]:
+        if entry["error"]:
+            print("ERROR: %s: %s" % (entry["wiki_page"], entry["error"]))
+    return report
 
 
 def main():
@@ -67,10 +62,14 @@ def main():
     parser.add_argument('--verbose',
                         action="store_true",
                         help='Verbose output')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=img2doku.BULK_THREADS,
+                        help='Pages written in parallel')
     parser.add_argument('dir_in', help='Input image directory')
     parser.add_argument('dir_out', help='Output page directory')
     args = parser.parse_args()
-    run(args.dir_in, args.dir_out)
+    run(args.dir_in, args.dir_out, threads=args.threads, verbose=args.verbose)
 
 
 if __name__ == "__main__":
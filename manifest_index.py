@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Query the archive wide .manifest index
+ex: all maps by collection mcmaster
+./manifest_index.py --collection mcmaster --type map
+ex: all files from 2020
+./manifest_index.py --year 2020
+The index is brought up to date first unless --no-refresh
+"""
+
+import json
+
+from sipr0n import env
+from sipr0n import manifestdb
+
+
+def run(dev=False,
+        remote=False,
+        refresh=True,
+        collection=None,
+        type_=None,
+        year=None,
+        vendor=None,
+        chipid=None,
+        summary=False,
+        as_json=False,
+        verbose=False):
+    env.setup_env(dev=dev, remote=remote)
+    db = manifestdb.ManifestDB(env.MANIFEST_DB)
+    try:
+        if refresh:
+            manifestdb.update_index(db, env.MAP_DIR, verbose=verbose)
+        if summary:
+            for collection_, type__, count in db.summary():
+                print("%s %s: %u" % (collection_, type__, count))
+            return
+        rows = db.query(collection=collection,
+                        type_=type_,
+                        year=year,
+                        vendor=vendor,
+                        chipid=chipid)
+        if as_json:
+            print(json.dumps(rows, indent=4, sort_keys=True))
+            return
+        for row in rows:
+            print("%s/%s/%s %s %s %s" %
+                  (row["vendor"], row["chipid"], row["fn"], row["collection"],
+                   row["type"], row["copyright_year"]))
+        print("Matches: %u" % len(rows))
+    finally:
+        db.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Query the archive .manifest index')
+    parser.add_argument('--dev', action="store_true", help='Local test')
+    parser.add_argument('--remote', action="store_true", help='Remote test')
+    parser.add_argument('--no-refresh',
+                        action="store_true",
+                        help='Query the index as is w/o checking manifests')
+    parser.add_argument('--collection', help='ex: mcmaster')
+    parser.add_argument('--type', help='image or map')
+    parser.add_argument('--year', type=int, help='Copyright year')
+    parser.add_argument('--vendor', help='ex: signetics')
+    parser.add_argument('--chipid', help='ex: 25120')
+    parser.add_argument('--summary',
+                        action="store_true",
+                        help='Print file counts per collection and type')
+    parser.add_argument('--json', action="store_true", help='JSON output')
+    parser.add_argument('--verbose', action="store_true", help='Verbose')
+    args = parser.parse_args()
+
+    run(dev=args.dev,
+        remote=args.remote,
+        refresh=not args.no_refresh,
+        collection=args.collection,
+        type_=args.type,
+        year=args.year,
+        vendor=args.vendor,
+        chipid=args.chipid,
+        summary=args.summary,
+        as_json=args.json,
+        verbose=args.verbose)
+
+
+if __name__ == "__main__":
+    main()
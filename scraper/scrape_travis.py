@@ -9,12 +9,57 @@ import json
 from collections import OrderedDict
 import requests
 from sipr0n import util
+from sipr0n import hashdb
 import subprocess
-import hashlib
+import concurrent.futures
 
+# Outlives the per run travis/<date> dirs so re-runs don't rehash
+HASH_DB_FN = "travis/hash.sqlite"
+# Hashing is I/O bound
+SIG_THREADS = 4
+# One line per converted image, across all runs
+COMPLETED_DB_FN = "travis/completed.jsonl"
+# convert on a full die .tif takes a lot of RAM, keep this modest
+COPY_WORKERS = 2
 
-def load_completed_db():
-    return set()
+
+def load_completed_db(fn=COMPLETED_DB_FN):
+    """
+    Source images (relative to dir_in) already converted by a previous run
+    """
+    ret = set()
+    if not os.path.exists(fn):
+        return ret
+    with open(fn, "r") as f:
+        for l in f:
+            try:
+                ret.add(json.loads(l)["src_image"])
+            except ValueError:
+                # Partial last line from an interrupted run
+                print("WARNING: bad completed db line: %s" % (l.strip(), ))
+    return ret
+
+
+def ends_with_newline(fn):
+    with open(fn, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def log_completed(f, entry, dst_fn):
+    """
+    Append to the completed db
+    Flushed per image so an interruption loses at most the in progress ones
+    """
+    f.write(
+        json.dumps({
+            "src_image": entry["src_image"],
+            "sha1sum": entry.get("sha1sum"),
+            "dst_fn": dst_fn,
+            "date": datetime.datetime.utcnow().isoformat(),
+        }, sort_keys=True) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
 
 
 def load_patches():
@@ -310,17 +355,21 @@ def is_collision(entry):
         raise Exception(f"{url}: is Not reachable \nErr: {e}")
 
 
-def sig_images(parsed, dir_in):
+def sig_images(parsed, dir_in, hash_db, threads=SIG_THREADS):
     """
     Calculate signatures so if git changes later can detect
+    Cached by (path, size, mtime) in hash_db
     """
-    for src_image_rel, entry in parsed.items():
-        print(f"Calculating {src_image_rel}...")
-        src_image = dir_in + "/" + src_image_rel
-        s = subprocess.check_output(f"sha1sum {src_image}", shell=True)
-        s = s.strip().split()[0]
-        s = util.tostr(s)
-        entry["sha1sum"] = s
+    def sig(src_image_rel):
+        return hash_db.hash(dir_in + "/" + src_image_rel)
+
+    print(f"Calculating {len(parsed)} signatures w/ {threads} threads...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        # map() keeps the input order
+        for src_image_rel, s in zip(parsed.keys(),
+                                    pool.map(sig, parsed.keys())):
+            print(f"{src_image_rel}: {s}")
+            parsed[src_image_rel]["sha1sum"] = s
 
 
 def validate_images(parsed):
@@ -364,19 +413,59 @@ def validate_images(parsed):
     return noks
 
 
-def copy_images(parsed, dir_in, single_dir):
-    for src_image, entry in parsed.items():
-        print("")
-        print(f"Converting {src_image}...")
-        src_fn = dir_in + "/" + src_image
-        assert os.path.exists(src_fn)
-        dst_fn = os.path.join(single_dir, entry["single_fn"])
-        cmd = f"convert -quality 90 {src_fn} {dst_fn}"
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
+def copy_image(src_fn, dst_fn):
+    assert os.path.exists(src_fn)
+    # Keep the extension so convert picks the output format
+    tmp_fn = os.path.join(os.path.dirname(dst_fn),
+                          ".tmp_" + os.path.basename(dst_fn))
+    cmd = ["convert", "-quality", "90", src_fn, tmp_fn]
+    print(" ".join(cmd))
+    try:
+        subprocess.check_call(cmd)
+        os.replace(tmp_fn, dst_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+
+
+def copy_images(parsed,
+                dir_in,
+                single_dir,
+                workers=COPY_WORKERS,
+                completed_fn=COMPLETED_DB_FN):
+    """
+    Convert images into single_dir on a worker pool
+    Each finished image is recorded in the completed db
+    Return dict of src_image : error message for failures
+    """
+    noks = {}
+    print(f"Converting {len(parsed)} images w/ {workers} workers...")
+    with open(completed_fn, "a") as completed_f:
+        # Don't glue the first entry onto an interrupted run's partial line
+        if completed_f.tell() and not ends_with_newline(completed_fn):
+            completed_f.write("\n")
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            futures = {}
+            for src_image, entry in parsed.items():
+                src_fn = dir_in + "/" + src_image
+                dst_fn = os.path.join(single_dir, entry["single_fn"])
+                futures[pool.submit(copy_image, src_fn, dst_fn)] = (entry,
+                                                                    dst_fn)
+            for future in concurrent.futures.as_completed(futures):
+                entry, dst_fn = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Failed {entry['src_image']}: {e}")
+                    noks[entry["src_image"]] = str(e)
+                    continue
+                print(f"Converted {entry['src_image']}")
+                log_completed(completed_f, entry, dst_fn)
+    return noks
 
 
-def run(dir_in, verbose=False):
+def run(dir_in, verbose=False, threads=SIG_THREADS, workers=COPY_WORKERS):
     dir_out = "travis"
     if not os.path.exists(dir_out):
         os.mkdir(dir_out)
@@ -395,12 +484,17 @@ def run(dir_in, verbose=False):
     os.mkdir(uploaded_dir)
 
     completed_images = load_completed_db()
+    print("Previously completed images: %u" % len(completed_images))
     patches = load_patches()
     all_images, all_images_noks = find_images(dir_in, patches, verbose=verbose)
     print("")
     parsed, parsed_noks = parse_images(dir_in, all_images, completed_images)
     print("")
-    sig_images(parsed, dir_in)
+    hash_db = hashdb.HashDB(HASH_DB_FN)
+    try:
+        sig_images(parsed, dir_in, hash_db, threads=threads)
+    finally:
+        hash_db.close()
     print("")
     validate_noks = validate_images(parsed)
 
@@ -427,7 +521,10 @@ def run(dir_in, verbose=False):
                    indent=4,
                    separators=(',', ': ')))
 
-    copy_images(parsed, dir_in, single_dir)
+    copy_noks = copy_images(parsed, dir_in, single_dir, workers=workers)
+    open(this_dir + "/copy_noks.json", "w").write(
+        json.dumps(copy_noks, sort_keys=True, indent=4,
+                   separators=(',', ': ')))
 
     with open(this_dir + "/done.txt", "w") as f:
         f.write("huzzah!")
@@ -446,7 +543,11 @@ def run(dir_in, verbose=False):
     for im_fn, msg in validate_noks.items():
         print("  %s: %s" % (im_fn, msg))
     print("")
-    print("Images ready: %s" % len(parsed))
+    print("Copy failed images: %s" % len(copy_noks))
+    for im_fn, msg in copy_noks.items():
+        print("  %s: %s" % (im_fn, msg))
+    print("")
+    print("Images ready: %s" % (len(parsed) - len(copy_noks)))
 
 
 def main():
@@ -456,9 +557,20 @@ def main():
                         default="/home/mcmaster/buffer/ic/travis/goodchips2",
                         nargs="?",
                         help='File name in')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=SIG_THREADS,
+                        help='Signature threads (default: %(default)s)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=COPY_WORKERS,
+                        help='Concurrent image conversions (default: %(default)s)')
     args = parser.parse_args()
 
-    run(dir_in=args.dir_in)
+    run(dir_in=args.dir_in,
+        verbose=args.verbose,
+        threads=args.threads,
+        workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -4,34 +4,76 @@ import os
 import glob
 import shutil
 import subprocess
-import time
 import traceback
+import threading
+import concurrent.futures
 import map_user
 from sipr0n import env
-from sipr0n.util import FnRetry
+from sipr0n.util import FnRetry, UploadGate
 from sipr0n import simap
+from sipr0n import watch
+from sipr0n import jobdb
+from sipr0n import reindex
+from sipr0n import probe
+from sipr0n import place
+from sipr0n import hashdb
 import json
 
 import img2doku
 from sipr0n.util import parse_map_image_user_vcufe, validate_username, map_image_uvcfe_to_basename
+from sipr0n.util import parse_map_image_vcufe, ParseError
 
 STATUS_DONE = "Done"
 STATUS_PENDING = "Pending"
 STATUS_ERROR = "Error"
 STATUS_COLLISION = "Collision"
+STATUS_DUPLICATE = "Duplicate"
 
 fn_retry = FnRetry()
+# Replaced by run() w/ configured stable time
+upload_gate = UploadGate()
+# Persistent job state, opened by run()
+job_db = None
+# Wiki pages written by jobs, set up by run()
+reindexer = None
+# Content hash index, opened by run()
+hash_db = None
 
 DEL_ON_DONE = True
 
+# Number of map jobs to run at once
+# pr0nmap is a subprocess so threads are enough to keep several going
+WORKERS = 1
+
+# Seconds an upload must be unchanged before it's processed
+UPLOAD_STABLE = 10.0
+
+# Seconds to collect changed wiki pages before reindexing them together
+REINDEX_DEBOUNCE = 30.0
+
+# Reject uploads identical to an image already in the archive
+DEDUP = True
+
+# Uploads are normally picked up by inotify events
+# Still do a full slow rescan in case something was missed
+RESCAN_INTERVAL = 300.0
+
+# Replaced by run() w/ configured values
+reject_duplicates = DEDUP
+
 
 def get_user_page(user):
     return env.SIMAPPER_USER_DIR + "/" + user + ".txt"
 
 
+# Several map jobs may finish for the same user at once
+log_lock = threading.Lock()
+
+
 def log_simapper_update(entry, page=None):
     """
     Update user page w/ URL
+    Return the page file name
     """
     if page is None:
         page = get_user_page(entry["user"])
@@ -41,16 +83,18 @@ def log_simapper_update(entry, page=None):
     page_dir = os.path.dirname(page)
     if not os.path.exists(page_dir):
         print("mkdir " + page_dir)
-        os.mkdir(page_dir)
+        os.makedirs(page_dir, exist_ok=True)
 
-    f = open(page, "a")
-    try:
-        # Double new line to put links on individual lines
-        f.write("\n")
-        f.write("[[" + entry["wiki"] + "]]\n")
-        f.flush()
-    finally:
-        f.close()
+    with log_lock:
+        f = open(page, "a")
+        try:
+            # Double new line to put links on individual lines
+            f.write("\n")
+            f.write("[[" + entry["wiki"] + "]]\n")
+            f.flush()
+        finally:
+            f.close()
+    return page
 
     # Force cache update
     # Works from chrome but not wget
@@ -58,6 +102,10 @@ def log_simapper_update(entry, page=None):
 
 
 def reindex_all(dev=False):
+    """
+    Reindex the entire wiki
+    Slow: services should use a reindex.Reindexer instead
+    """
     print("Running reindex all")
     # subprocess.check_call(["sudo", "-u", "www-data", "php", "/var/www/archive/bin/indexer.php"])
     # Already running as www-data
@@ -69,6 +117,8 @@ def reindex_all(dev=False):
 
 
 def shift_done(entry):
+    upload_gate.done(entry["local_fn"])
+    fn_retry.forget(entry["local_fn"])
     if DEL_ON_DONE:
         print("Deleting local file %s" % (entry["local_fn"], ))
         os.unlink(entry["local_fn"])
@@ -81,7 +131,74 @@ def shift_done(entry):
         shutil.move(entry["local_fn"], dst_fn)
 
 
+class ChipLocks:
+    """
+    One lock per vendor/chipid
+    Maps for the same chip share the single/ dir and the .manifest
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def get(self, vendor, chipid):
+        with self.lock:
+            return self.locks.setdefault((vendor, chipid), threading.Lock())
+
+
+chip_locks = ChipLocks()
+
+
 def process(entry):
+    """
+    Safe to call from multiple threads
+    Jobs for the same vendor/chipid are serialized
+    """
+    try:
+        # Ex: badly named upload
+        vendor, chipid, _user, _flavor, _ext = parse_map_image_user_vcufe(
+            entry["local_fn"], assume_user=entry["user"])
+        with chip_locks.get(vendor, chipid):
+            process_locked(entry)
+    finally:
+        # Exception => error
+        job_update(entry, status=entry["status"] or STATUS_ERROR)
+
+
+def job_update(entry, **kwargs):
+    if job_db and "local_fn" in entry:
+        job_db.update(entry["local_fn"], **kwargs)
+
+
+def cleanup_outputs(single_fn, map_fn):
+    if single_fn and os.path.exists(single_fn):
+        print("WARNING: deleting map image failure: " + single_fn)
+        os.unlink(single_fn)
+    if map_fn and os.path.exists(map_fn):
+        print("WARNING: deleting map dir on failure: " + map_fn)
+        shutil.rmtree(map_fn)
+
+
+def duplicate_map_dir(fn):
+    """
+    Return the map dir of an archived MAP_DIR/vendor/chipid/single/ image
+    or None if fn isn't one or was never mapped
+    The hash index also covers wiki media, which don't have maps
+    """
+    map_dir = os.path.realpath(env.MAP_DIR)
+    parts = os.path.relpath(fn, map_dir).split(os.path.sep)
+    if len(parts) != 4 or parts[0] == ".." or parts[2] != "single":
+        return None
+    try:
+        _vendor, _chipid, user, flavor, _ext = parse_map_image_vcufe(fn)
+    except ParseError:
+        return None
+    ret = os.path.join(map_dir, parts[0], parts[1], user + "_" + flavor)
+    if not os.path.isdir(ret):
+        return None
+    return ret
+
+
+def process_locked(entry):
     print("")
     print(entry)
     print("Validating URL file name...")
@@ -122,19 +239,41 @@ def process(entry):
         entry["status"] = STATUS_COLLISION
         return
 
+    digest = None
+    if hash_db:
+        print("Checking for duplicates...")
+        digest = hashdb.hash_file(entry["local_fn"])
+        dups = hash_db.find(digest)
+        if dups:
+            entry["duplicates"] = dups
+            mapped = False
+            print("Duplicate of:")
+            for dup in dups:
+                dup_map = duplicate_map_dir(dup)
+                if dup_map:
+                    mapped = True
+                    print("  %s (map %s)" % (dup, dup_map))
+                else:
+                    print("  " + dup)
+            if not mapped:
+                print("No existing map, continuing")
+            elif reject_duplicates:
+                entry["status"] = STATUS_DUPLICATE
+                return
+            else:
+                print("WARNING: duplicates allowed, continuing")
+
     def cleanup():
-        if os.path.exists(single_fn):
-            print("WARNING: deleting map image failure: " + single_fn)
-            os.unlink(single_fn)
-        if os.path.exists(map_fn):
-            print("WARNING: deleting map dir on failure: " + map_fn)
-            shutil.rmtree(map_fn)
+        cleanup_outputs(single_fn, map_fn)
 
+    # Past collision checks: anything here is ours to clean up after a crash
+    job_update(entry, single_fn=single_fn, map_fn=map_fn)
     try:
         print("Checking if directories exist....")
         if not os.path.exists(vendor_dir):
             print("Create %s" % vendor_dir)
-            os.mkdir(vendor_dir)
+            # Another worker may be creating it for a different chipid
+            os.makedirs(vendor_dir, exist_ok=True)
         if not os.path.exists(chipid_dir):
             print("Create %s" % chipid_dir)
             os.mkdir(chipid_dir)
@@ -143,18 +282,25 @@ def process(entry):
             os.mkdir(single_dir)
 
         print("Fetching file...")
-        print("Local copy %s => %s" % (entry["local_fn"], single_fn))
-        shutil.copy(entry["local_fn"], single_fn)
+        # Keep the upload until done so a failed / interrupted job
+        # can be cleaned up and retried. Usually ends up a hardlink
+        method = place.place_file(entry["local_fn"], single_fn, move=False)
+        print("Local %s %s => %s" % (method, entry["local_fn"], single_fn))
+        if hash_db:
+            hash_db.add(os.path.realpath(single_fn), digest)
         single_rel = "single/" + os.path.basename(single_fn)
         simap.map_manifest_add_file(basedir=chipid_dir,
                                     fn=single_rel,
                                     collection=user,
                                     type_="image")
+        job_update(entry, stage=jobdb.STAGE_PLACED)
 
         # Sanity check its image file / multimedia
         # Mostly intended for failing faster on HTML in non-direct link
-        subprocess.check_call(["identify", single_fn])
-        print("Sanity check OK")
+        info = probe.probe(single_fn)
+        print("Sanity check OK: %s %s %s" %
+              (info["format"], probe.format_wh(info),
+               probe.format_size(info["size"])))
 
         print("Converting...")
         try:
@@ -166,6 +312,7 @@ def process(entry):
             traceback.print_exc()
             entry["status"] = STATUS_ERROR
             return
+        job_update(entry, stage=jobdb.STAGE_MAPPED)
 
         _out_txt, wiki_page, wiki_url, map_chipid_url, wrote, exists = img2doku.run(
             hi_fns=[single_fn],
@@ -180,16 +327,21 @@ def process(entry):
         print("exists: " + str(exists))
         entry["map"] = map_chipid_url
         entry["wiki"] = wiki_url
-        log_simapper_update(entry)
+        reindexer and reindexer.add(wiki_page)
+        user_page = log_simapper_update(entry)
+        reindexer and reindexer.add_page_fn(user_page)
+        job_update(entry, stage=jobdb.STAGE_WIKI)
 
         map_rel = os.path.basename(map_chipid_url)
         simap.map_manifest_add_file(basedir=chipid_dir,
                                     fn=map_rel,
                                     collection=user,
                                     type_="map")
+        simap.map_manifest_compact(chipid_dir)
 
         if "local_fn" in entry:
             shift_done(entry)
+        job_update(entry, stage=jobdb.STAGE_DONE)
         entry["status"] = STATUS_DONE
     finally:
         if entry["status"] != STATUS_DONE:
@@ -212,23 +364,158 @@ def mk_entry(status="", user=None, force_name=None, url=None, local_fn=None):
     return ret
 
 
+class MapPool:
+    """
+    Runs process() jobs, optionally several at once
+    With one worker jobs run synchronously in the caller
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = None
+        if workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="simapper")
+        self.futures = set()
+        # Jobs finished since last reap()
+        self.completed = 0
+
+    def submit(self, entry):
+        if not self.executor:
+            try:
+                process(entry)
+            finally:
+                self.completed += 1
+            return
+        self.futures.add(self.executor.submit(process, entry))
+
+    def busy(self):
+        return len(self.futures) > 0
+
+    def reap(self, wait=False):
+        """
+        Collect finished jobs
+        Return the number of jobs completed since the last call
+        """
+        if self.futures:
+            if wait:
+                done, _not_done = concurrent.futures.wait(self.futures)
+            else:
+                done = set([f for f in self.futures if f.done()])
+            for future in done:
+                self.futures.remove(future)
+                self.completed += 1
+                try:
+                    future.result()
+                except Exception as e:
+                    print("WARNING: exception in map job: %s" % (e, ))
+                    traceback.print_exc()
+        ret = self.completed
+        self.completed = 0
+        return ret
+
+    def shutdown(self):
+        if self.executor:
+            self.reap(wait=True)
+            self.executor.shutdown()
+
+
+map_pool = MapPool()
+
+
 def print_log_break():
     for _i in range(6):
         print("")
     print("*" * 78)
 
 
+def scrape_upload_fn(user, im_fn, verbose=False):
+    """
+    Queue a single candidate file in a user upload dir
+    Return True if a job was submitted
+    """
+    im_fn = os.path.realpath(im_fn)
+    # foo.jpg.done => check foo.jpg
+    if upload_gate.is_marker(im_fn):
+        im_fn = upload_gate.marker_target(im_fn)
+    # Ignore done dir
+    if not os.path.isfile(im_fn):
+        verbose and print("Not a file " + im_fn)
+        return False
+    # Before try_fn so the file isn't marked as tried while incomplete
+    if not upload_gate.ready(im_fn):
+        verbose and print("Waiting for upload to finish: " + im_fn)
+        return False
+    if not fn_retry.try_fn(im_fn):
+        verbose and print("Already tried: " + im_fn)
+        return False
+    job = job_db and job_db.get(im_fn)
+    # Ex: a rejected upload left in the dir across a restart
+    if jobdb.rejected(job, im_fn, (STATUS_PENDING, STATUS_DONE)):
+        verbose and print("Already finished (%s): %s" %
+                          (job["status"], im_fn))
+        return False
+    print_log_break()
+    print("Found fn: " + im_fn)
+    if job_db:
+        job_db.add(im_fn,
+                   user=user,
+                   mtime=os.path.getmtime(im_fn),
+                   status=STATUS_PENDING,
+                   ident=jobdb.file_ident(im_fn))
+    map_pool.submit(mk_entry(user=user, local_fn=im_fn))
+    return True
+
+
+def resume_job(job):
+    im_fn = job["fn"]
+    print("Resuming %s (stage: %s)" % (im_fn, job["stage"]))
+    if job["stage"] == jobdb.STAGE_DONE:
+        # Finished but stopped before the status was recorded
+        job_db.update(im_fn, status=STATUS_DONE)
+        return
+    cleanup_outputs(job["single_fn"], job["map_fn"])
+    if not os.path.isfile(im_fn):
+        print("WARNING: upload disappeared: " + im_fn)
+        job_db.update(im_fn, status=STATUS_ERROR)
+        return
+    fn_retry.try_fn(im_fn)
+    job_db.add(im_fn,
+               user=job["user"],
+               mtime=os.path.getmtime(im_fn),
+               status=STATUS_PENDING,
+               ident=jobdb.file_ident(im_fn))
+    map_pool.submit(mk_entry(user=job["user"], local_fn=im_fn))
+
+
+def resume_jobs(once=False):
+    """
+    Restart jobs that were in progress when the service last stopped
+    Partial output from the interrupted attempt is removed first
+    A job that fails again is marked as an error so it isn't resumed forever
+    """
+    for job in job_db.with_status(STATUS_PENDING):
+        try:
+            resume_job(job)
+        except Exception as e:
+            print("WARNING: exception resuming job: %s" % (e, ))
+            job_db.update(job["fn"], status=STATUS_ERROR)
+            if once:
+                raise
+            else:
+                traceback.print_exc()
+
+
 def scrape_upload_dir(once=False, dev=False, verbose=False):
     """
-    TODO: consider implementing upload timeout
-    As currently implemented dokuwiki buffers files and writes them instantly
-    However might want to allow slower uploads such as through sftp
-    Consider verifying the file size is stable (say over 1 second)
+    Full rescan of all user upload dirs
+    Normally uploads are picked up via scrape_upload_events()
+    but this is still run periodically in case an event was missed
+
+    Files still being written (ex: slow sftp) are held back by upload_gate
     """
     # verbose = True
     verbose and print("")
     verbose and print("Scraping upload dir")
-    change = False
     for user_dir in glob.glob(env.SIMAPPER_DIR + "/*"):
         user_dir = os.path.realpath(user_dir)
         if not fn_retry.should_try_fn(user_dir):
@@ -243,29 +530,57 @@ def scrape_upload_dir(once=False, dev=False, verbose=False):
             user = os.path.basename(user_dir)
             verbose and print("Checking user dir " + user_dir)
             for im_fn in glob.glob(user_dir + "/*"):
-                im_fn = os.path.realpath(im_fn)
-                if not fn_retry.try_fn(im_fn):
-                    verbose and print("Already tried: " + im_fn)
-                    continue
-                # Ignore done dir
-                if not os.path.isfile(im_fn):
-                    verbose and print("Not a file " + im_fn)
-                    continue
-                print_log_break()
-                print("Found fn: " + im_fn)
-                process(mk_entry(user=user, local_fn=im_fn))
-                change = True
+                scrape_upload_fn(user, im_fn, verbose=verbose)
         except Exception as e:
             print("WARNING: exception scraping user dir: %s" % (e, ))
             if once:
                 raise
             else:
                 traceback.print_exc()
-    if change:
-        reindex_all(dev=dev)
 
 
-def run(once=False, dev=False, remote=False, verbose=False):
+def scrape_upload_events(fns, once=False, dev=False, verbose=False):
+    """
+    Process files reported by the upload watcher
+    Only files directly in a user dir are considered
+    """
+    simapper_dir = os.path.realpath(env.SIMAPPER_DIR)
+    for im_fn in fns:
+        user_dir = os.path.dirname(im_fn)
+        if os.path.dirname(user_dir) != simapper_dir:
+            verbose and print("Ignoring event outside user dir: " + im_fn)
+            continue
+        if not fn_retry.should_try_fn(user_dir):
+            verbose and print("Ignoring tried: " + user_dir)
+            continue
+        try:
+            scrape_upload_fn(os.path.basename(user_dir),
+                             im_fn,
+                             verbose=verbose)
+        except Exception as e:
+            print("WARNING: exception processing upload: %s" % (e, ))
+            if once:
+                raise
+            else:
+                traceback.print_exc()
+
+
+def run(once=False,
+        dev=False,
+        remote=False,
+        verbose=False,
+        rescan_interval=RESCAN_INTERVAL,
+        workers=WORKERS,
+        reindex_debounce=REINDEX_DEBOUNCE,
+        upload_stable=UPLOAD_STABLE,
+        dedup=DEDUP):
+    global map_pool
+    global job_db
+    global reindexer
+    global upload_gate
+    global hash_db
+    global reject_duplicates
+
     env.setup_env(dev=dev, remote=remote)
 
     # assert getpass.getuser() == "www-data"
@@ -273,7 +588,25 @@ def run(once=False, dev=False, remote=False, verbose=False):
     shutil.rmtree(env.SIMAPPER_TMP_DIR, ignore_errors=True)
     os.mkdir(env.SIMAPPER_TMP_DIR)
 
+    watcher = None
+    reject_duplicates = dedup
+    map_pool = MapPool(workers=workers)
+    # Test mode: files are copied in complete
+    upload_gate = UploadGate(stable_time=0.0 if once else upload_stable)
+    job_db = jobdb.JobDB(env.SIMAPPER_DB)
+    hash_db = hashdb.HashDB(env.HASH_DB)
+    reindexer = reindex.Reindexer(env.ARCHIVE_WIKI_DIR,
+                                  debounce=reindex_debounce,
+                                  dev=dev)
     try:
+        # Only pending jobs need attention
+        # The first full scan below skips uploads that already finished
+        # but is still needed: uploads that landed while stopped fire no events
+        resume_jobs(once=once)
+        if not once:
+            watcher = watch.UploadWatcher(env.SIMAPPER_DIR,
+                                          rescan_interval=rescan_interval)
+            watcher.start()
         print("Running")
         iters = 0
         while True:
@@ -281,22 +614,76 @@ def run(once=False, dev=False, remote=False, verbose=False):
             if iters > 1 and once:
                 print("Break on test mode")
                 break
-            # Consider select() / notify instead
+            # None => full rescan
+            fns = None
             if iters > 1:
-                time.sleep(3)
+                # Wake up for jobs finishing, uploads settling
+                # and the reindex coming due
+                waits = [reindexer.time_left(), upload_gate.time_left()]
+                if map_pool.busy():
+                    waits.append(1.0)
+                waits = [x for x in waits if x is not None]
+                fns = watcher.wait(max_wait=min(waits) if waits else None)
+                if fns is not None:
+                    fns += upload_gate.waiting_fns()
 
             try:
-                scrape_upload_dir(once=once, dev=dev)
+                if fns is None:
+                    scrape_upload_dir(once=once, dev=dev, verbose=verbose)
+                elif fns:
+                    scrape_upload_events(fns,
+                                         once=once,
+                                         dev=dev,
+                                         verbose=verbose)
             except Exception as e:
                 print("WARNING: exception: %s" % (e, ))
                 if once:
                     raise
                 else:
                     traceback.print_exc()
+
+            map_pool.reap(wait=once)
+            try:
+                if once:
+                    reindexer.flush()
+                else:
+                    reindexer.flush_if_due()
+            except Exception as e:
+                print("WARNING: reindex failed: %s" % (e, ))
+                if once:
+                    raise
+                else:
+                    traceback.print_exc()
     finally:
+        if watcher:
+            watcher.stop()
+        map_pool.shutdown()
+        # Don't leave pages out of the index on shutdown
+        try:
+            reindexer.flush()
+        except Exception:
+            traceback.print_exc()
+        reindexer = None
+        job_db.close()
+        job_db = None
+        hash_db.close()
+        hash_db = None
         shutil.rmtree(env.SIMAPPER_TMP_DIR, ignore_errors=True)
 
 
+def status(dev=False, remote=False):
+    """
+    Print job queue summary
+    Safe to run while the service is running
+    """
+    env.setup_env(dev=dev, remote=remote)
+    db = jobdb.JobDB(env.SIMAPPER_DB)
+    try:
+        jobdb.print_status(db, STATUS_PENDING)
+    finally:
+        db.close()
+
+
 def main():
     import argparse
 
@@ -307,9 +694,52 @@ def main():
     parser.add_argument('--once',
                         action="store_true",
                         help='Test once and exit')
+    parser.add_argument('--verbose', action="store_true", help='Verbose')
+    parser.add_argument(
+        '--rescan-interval',
+        type=float,
+        default=RESCAN_INTERVAL,
+        help='Seconds between full upload dir rescans (default: %(default)s)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=WORKERS,
+                        help='Map jobs to run at once (default: %(default)s)')
+    parser.add_argument(
+        '--reindex-debounce',
+        type=float,
+        default=REINDEX_DEBOUNCE,
+        help=
+        'Seconds to collect changed wiki pages before reindexing (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--upload-stable',
+        type=float,
+        default=UPLOAD_STABLE,
+        help=
+        'Seconds an upload must be unchanged before processing, unless foo.jpg.done exists (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--allow-duplicates',
+        action="store_true",
+        help='Map uploads even if identical to an image already archived')
+    parser.add_argument('--status',
+                        action="store_true",
+                        help='Print job queue status and exit')
     args = parser.parse_args()
 
-    run(dev=args.dev, remote=args.remote, once=args.once)
+    if args.status:
+        status(dev=args.dev, remote=args.remote)
+        return
+
+    run(dev=args.dev,
+        remote=args.remote,
+        once=args.once,
+        verbose=args.verbose,
+        rescan_interval=args.rescan_interval,
+        workers=args.workers,
+        reindex_debounce=args.reindex_debounce,
+        upload_stable=args.upload_stable,
+        dedup=not args.allow_duplicates)
 
 
 if __name__ == "__main__":
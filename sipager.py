@@ -50,6 +50,7 @@ import shutil
 import time
 import traceback
 import tarfile
+import zipfile
 
 import img2doku
 from sipr0n.util import parse_wiki_image_user_vcufe, ParseError
@@ -57,18 +58,44 @@ from sipr0n.util import validate_username
 import simapper
 from simapper import print_log_break
 from sipr0n import env
-from sipr0n.util import FnRetry, archive_page_last_change_user
+from sipr0n.util import FnRetry, UploadGate, archive_page_last_change_user
+from sipr0n import jobdb
+from sipr0n import reindex
+from sipr0n import place
+from sipr0n import hashdb
+from simapper import STATUS_DONE, STATUS_PENDING, STATUS_ERROR
 
 DEL_ON_DONE = True
 
+ARCHIVE_EXTS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst",
+                ".zip")
+# Most an archive may expand to
+ARCHIVE_MAX_BYTES = 64 * 1024 * 1024 * 1024
+# Stop extracting rather than fill the disk
+ARCHIVE_MIN_FREE = 1 * 1024 * 1024 * 1024
+ARCHIVE_CHUNK = 1024 * 1024
+
 fn_retry = FnRetry()
+# Replaced by run() w/ configured stable time
+upload_gate = UploadGate()
+# Persistent job state, opened by run()
+job_db = None
+# Wiki pages written, set up by run()
+reindexer = None
+# Content hash index, opened by run()
+hash_db = None
 
 
 def file_completed(src_fn):
     """
     Archive a file that was completed
     """
+    upload_gate.done(src_fn)
+    fn_retry.forget(src_fn)
 
+    if not os.path.exists(src_fn):
+        print("Local file already moved %s" % (src_fn, ))
+        return
     if DEL_ON_DONE:
         print("Deleting local file %s" % (src_fn, ))
         os.unlink(src_fn)
@@ -96,7 +123,8 @@ def get_user_page(user):
 
 
 def log_sipager_update(page_name, user):
-    simapper.log_simapper_update({"wiki": page_name}, page=get_user_page(user))
+    return simapper.log_simapper_update({"wiki": page_name},
+                                        page=get_user_page(user))
 
 
 def import_images(page):
@@ -120,10 +148,31 @@ def import_images(page):
                 print("    mkdir " + chipid_dir)
                 os.mkdir(chipid_dir)
             dst_fn = chipid_dir + "/" + page_fn
-            print("    cp: " + src_fn + " => " + dst_fn)
             if os.path.exists(dst_fn):
                 print("    WARNING: overwriting file")
-            shutil.copy(src_fn, dst_fn)
+            dups = []
+            if hash_db:
+                digest = hashdb.hash_file(src_fn)
+                dups = hash_db.find(digest,
+                                    exclude=os.path.realpath(dst_fn))
+            placed = False
+            if dups:
+                # Share the copy already in the archive
+                print("    Duplicate of " + dups[0])
+                try:
+                    method = place.place_file(dups[0], dst_fn)
+                    print("    " + method + ": " + dups[0] + " => " + dst_fn)
+                    placed = True
+                except FileNotFoundError:
+                    # Deleted since it was looked up
+                    print("    WARNING: duplicate disappeared, using upload")
+            if not placed:
+                # Not moved: the upload is only removed by file_completed()
+                # once the page is written so a failure can be retried
+                method = place.place_file(src_fn, dst_fn)
+                print("    " + method + ": " + src_fn + " => " + dst_fn)
+            if hash_db:
+                hash_db.add(os.path.realpath(dst_fn), digest)
     print("")
 
 
@@ -168,14 +217,106 @@ def process(page):
     print("wiki_url: " + wiki_url)
     print("wrote: " + str(wrote))
     print("exists: " + str(exists))
-    log_sipager_update(wiki_url, page["user"])
+    user_page = log_sipager_update(wiki_url, page["user"])
+    if reindexer:
+        reindexer.add(wiki_page)
+        reindexer.add_page_fn(user_page)
 
     shift_done(page)
 
 
+class ArchiveError(Exception):
+    pass
+
+
+def is_archive(fn):
+    fn = fn.lower()
+    for ext in ARCHIVE_EXTS:
+        if fn.endswith(ext):
+            return True
+    return False
+
+
+def open_zstd(fn):
+    """
+    Return a decompressed stream of a .zst file
+    """
+    try:
+        # python 3.14+
+        from compression import zstd
+        return zstd.open(fn, "rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ArchiveError("zstd support requires the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(open(fn, "rb"),
+                                                      closefd=True)
+
+
+def iter_archive(archive_fn):
+    """
+    Stream members of a supported archive in storage order
+    Yields (name, is_dir, is_reg, mtime, fileobj)
+    fileobj is only valid until the next member is requested
+    """
+    if archive_fn.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_fn, "r") as zf:
+            for info in zf.infolist():
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.is_dir():
+                    yield info.filename, True, False, mtime, None
+                    continue
+                with zf.open(info, "r") as f:
+                    yield info.filename, False, True, mtime, f
+        return
+
+    if archive_fn.lower().endswith(".zst"):
+        fileobj = open_zstd(archive_fn)
+        tar = tarfile.open(fileobj=fileobj, mode="r|")
+    else:
+        fileobj = None
+        # Stream mode, transparently handles gz / bz2 / xz
+        tar = tarfile.open(archive_fn, "r|*")
+    try:
+        for tarinfo in tar:
+            f = None
+            if tarinfo.isreg():
+                f = tar.extractfile(tarinfo)
+            yield tarinfo.name, tarinfo.isdir(), tarinfo.isreg(
+            ), tarinfo.mtime, f
+    finally:
+        tar.close()
+        if fileobj:
+            fileobj.close()
+
+
+def copy_member(fin, fn_out, budget):
+    """
+    Copy with a bounded buffer
+    Return bytes written
+    Raise ArchiveError if more than budget bytes
+    """
+    written = 0
+    with open(fn_out, "wb") as fout:
+        while True:
+            buf = fin.read(ARCHIVE_CHUNK)
+            if not buf:
+                break
+            written += len(buf)
+            if written > budget:
+                raise ArchiveError("archive exceeds byte budget")
+            fout.write(buf)
+    return written
+
+
 def extract_archives(scrape_dir, assume_user, verbose=False):
     """
     Extract archives into current dir
+    Members are streamed to disk in chunks, never held in memory
+    Each archive may expand to at most ARCHIVE_MAX_BYTES
+    and must leave ARCHIVE_MIN_FREE bytes free on disk
 
     Rules:
     -File paths ignored / flattened
@@ -188,46 +329,60 @@ def extract_archives(scrape_dir, assume_user, verbose=False):
             return False
         return True
 
-    for fn_glob in glob.glob(scrape_dir + "/*.tar"):
-        tar_fn = os.path.realpath(fn_glob)
+    for fn_glob in sorted(glob.glob(scrape_dir + "/*")):
+        if not is_archive(fn_glob):
+            continue
+        archive_fn = os.path.realpath(fn_glob)
 
-        if not fn_retry.try_fn(tar_fn):
-            verbose and print("Ignoring tried: " + tar_fn)
+        if not upload_gate.ready(archive_fn):
+            verbose and print("Waiting for upload to finish: " + archive_fn)
             continue
-        print("tar: examining %s" % (tar_fn, ))
+        if not fn_retry.try_fn(archive_fn):
+            verbose and print("Ignoring tried: " + archive_fn)
+            continue
+        print("archive: examining %s" % (archive_fn, ))
 
-        tar = tarfile.open(tar_fn, "r")
         fn_cache = set()
+        members = iter_archive(archive_fn)
+        ok = False
         try:
-            for tarinfo in tar:
-                if tarinfo.isdir():
+            budget = ARCHIVE_MAX_BYTES
+            for name, is_dir, is_reg, mtime, f in members:
+                if is_dir:
                     continue
-                if not tarinfo.isreg():
-                    print("  WARNING: unrecognized tar element: %s" %
-                          (str(tarinfo), ))
+                if not is_reg:
+                    print("  WARNING: unrecognized archive element: %s" %
+                          (name, ))
                     raise ParseError()
 
-                basename = os.path.basename(tarinfo.name).lower()
+                basename = os.path.basename(name).lower()
                 if not conforming_name(basename):
                     print("  WARNING: bad image file name within archive: %s" %
-                          (tarinfo.name, ))
+                          (name, ))
                     raise ParseError()
 
+                free = shutil.disk_usage(scrape_dir).free - ARCHIVE_MIN_FREE
                 fn_out = scrape_dir + "/" + basename
                 fn_cache.add(fn_out)
-                with open(fn_out, "wb") as f:
-                    print("  writing %s" % (fn_out))
-                    f.write(tar.extractfile(tarinfo).read())
+                print("  writing %s" % (fn_out))
+                budget -= copy_member(f, fn_out, min(budget, free))
+                # Like tar does. Also keeps upload_gate from waiting on it
+                os.utime(fn_out, (mtime, mtime))
 
-            # Extracted: trash it
-            file_completed(tar_fn)
-        except ParseError as e:
+            ok = True
+        except Exception as e:
+            # Bad names, corrupt data (any codec), disk full...
             traceback.print_exc()
-            print("WARNING: aborted tar on parse error")
-            for fn in fn_cache:
-                os.unlink(fn)
+            print("WARNING: aborted archive: %s" % (e, ))
         finally:
-            tar.close()
+            members.close()
+            if not ok:
+                for fn in fn_cache:
+                    if os.path.exists(fn):
+                        os.unlink(fn)
+        if ok:
+            # Extracted: trash it
+            file_completed(archive_fn)
 
 
 def bucket_image_dir(scrape_dir, assume_user=None, verbose=False):
@@ -258,12 +413,24 @@ def bucket_image_dir(scrape_dir, assume_user=None, verbose=False):
     ret = {}
     for fn_glob in glob.glob(scrape_dir + "/*"):
         fn_can = os.path.realpath(fn_glob)
+        if upload_gate.is_marker(fn_can):
+            continue
+        # Before try_fn so the file isn't marked as tried while incomplete
+        if os.path.isfile(fn_can) and not upload_gate.ready(fn_can):
+            verbose and print("Waiting for upload to finish: " + fn_can)
+            continue
         if not fn_retry.try_fn(fn_can):
             continue
+        if job_finished(fn_can):
+            verbose and print("Already finished: " + fn_can)
+            continue
 
         basename = os.path.basename(fn_can)
         if basename == "done" or os.path.isdir(fn_can):
             continue
+        # Failed extraction
+        if is_archive(basename):
+            continue
         verbose and print("Checking file " + fn_can)
         try:
             vendor, chipid, user, flavor, ext = parse_wiki_image_user_vcufe(
@@ -341,6 +508,40 @@ def parse_image_dir(scrape_dir, assume_user=None, verbose=False):
     return ret
 
 
+def job_finished(fn):
+    """
+    Check persistent state for a file that was already rejected
+    Pending jobs were interrupted and are simply tried again
+    Done uploads were consumed so anything there now is a new upload
+    """
+    if not job_db:
+        return False
+    return jobdb.rejected(job_db.get(fn), fn, (STATUS_PENDING, STATUS_DONE))
+
+
+def page_fns(page):
+    ret = []
+    for imagek in ("header", "package", "die"):
+        ret += list(page["images"][imagek].keys())
+    return ret
+
+
+def job_update_page(page, status, stage=None):
+    if not job_db:
+        return
+    for fn in page_fns(page):
+        if status == STATUS_PENDING:
+            job_db.add(fn,
+                       user=page["user"],
+                       mtime=os.path.getmtime(fn),
+                       status=status,
+                       ident=jobdb.file_ident(fn))
+        elif stage:
+            job_db.update(fn, status=status, stage=stage)
+        else:
+            job_db.update(fn, status=status)
+
+
 def scrape_upload_dir_inner(scrape_dir, assume_user=None, verbose=False):
     change = False
     # don't assume_user here or will double stack against dir name
@@ -351,7 +552,13 @@ def scrape_upload_dir_inner(scrape_dir, assume_user=None, verbose=False):
     verbose and print_log_break()
 
     for page in pages.values():
-        process(page)
+        job_update_page(page, STATUS_PENDING)
+        try:
+            process(page)
+        except:
+            job_update_page(page, STATUS_ERROR)
+            raise
+        job_update_page(page, STATUS_DONE, stage=jobdb.STAGE_DONE)
         change = True
 
     return change
@@ -359,14 +566,12 @@ def scrape_upload_dir_inner(scrape_dir, assume_user=None, verbose=False):
 
 def scrape_upload_dir_outer(verbose=False, dev=False):
     """
-    TODO: consider implementing upload timeout
-    As currently implemented dokuwiki buffers files and writes them instantly
-    However might want to allow slower uploads such as through sftp
-    Consider verifying the file size is stable (say over 1 second)
+    Files still being written (ex: slow sftp) are held back by upload_gate
+
+    Written pages are reindexed by run()
     """
     verbose and print("")
     verbose and print("Scraping upload dir")
-    change = False
     # Check main dir with username prefix
     scrape_upload_dir_inner(env.SIPAGER_DIR, verbose=verbose)
 
@@ -388,12 +593,26 @@ def scrape_upload_dir_outer(verbose=False, dev=False):
             continue
         scrape_upload_dir_inner(glob_dir, verbose=verbose, assume_user=user)
 
-    if change:
-        simapper.reindex_all(dev=dev)
 
+def run(once=False,
+        dev=False,
+        remote=False,
+        verbose=False,
+        reindex_debounce=simapper.REINDEX_DEBOUNCE,
+        upload_stable=simapper.UPLOAD_STABLE):
+    global job_db
+    global reindexer
+    global upload_gate
+    global hash_db
 
-def run(once=False, dev=False, remote=False, verbose=False):
     env.setup_env(dev=dev, remote=remote)
+    job_db = jobdb.JobDB(env.SIPAGER_DB)
+    hash_db = hashdb.HashDB(env.HASH_DB)
+    # Test mode: files are copied in complete
+    upload_gate = UploadGate(stable_time=0.0 if once else upload_stable)
+    reindexer = reindex.Reindexer(env.ARCHIVE_WIKI_DIR,
+                                  debounce=reindex_debounce,
+                                  dev=dev)
 
     # assert getpass.getuser() == "www-data"
 
@@ -402,23 +621,50 @@ def run(once=False, dev=False, remote=False, verbose=False):
 
     print("Running")
     iters = 0
-    while True:
-        iters += 1
-        if iters > 1 and once:
-            print("Break on test mode")
-            break
-        # Consider select() / notify instead
-        if iters > 1:
-            time.sleep(3)
-
+    try:
+        while True:
+            iters += 1
+            if iters > 1 and once:
+                print("Break on test mode")
+                break
+            # Consider select() / notify instead
+            if iters > 1:
+                time.sleep(3)
+
+            try:
+                scrape_upload_dir_outer(verbose=verbose, dev=dev)
+                if once:
+                    reindexer.flush()
+                else:
+                    reindexer.flush_if_due()
+            except Exception as e:
+                print("WARNING: exception: %s" % (e, ))
+                if once:
+                    raise
+                else:
+                    traceback.print_exc()
+    finally:
         try:
-            scrape_upload_dir_outer(verbose=verbose, dev=dev)
-        except Exception as e:
-            print("WARNING: exception: %s" % (e, ))
-            if once:
-                raise
-            else:
-                traceback.print_exc()
+            reindexer.flush()
+        except Exception:
+            traceback.print_exc()
+        reindexer = None
+        job_db.close()
+        job_db = None
+        hash_db.close()
+        hash_db = None
+
+
+def status(dev=False, remote=False):
+    """
+    Print job queue summary
+    """
+    env.setup_env(dev=dev, remote=remote)
+    db = jobdb.JobDB(env.SIPAGER_DB)
+    try:
+        jobdb.print_status(db, STATUS_PENDING)
+    finally:
+        db.close()
 
 
 def main():
@@ -432,9 +678,35 @@ def main():
                         action="store_true",
                         help='Test once and exit')
     parser.add_argument('--verbose', action="store_true", help='Verbose')
+    parser.add_argument(
+        '--reindex-debounce',
+        type=float,
+        default=simapper.REINDEX_DEBOUNCE,
+        help=
+        'Seconds to collect changed wiki pages before reindexing (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--upload-stable',
+        type=float,
+        default=simapper.UPLOAD_STABLE,
+        help=
+        'Seconds an upload must be unchanged before processing, unless foo.jpg.done exists (default: %(default)s)'
+    )
+    parser.add_argument('--status',
+                        action="store_true",
+                        help='Print job queue status and exit')
     args = parser.parse_args()
 
-    run(dev=args.dev, remote=args.remote, once=args.once, verbose=args.verbose)
+    if args.status:
+        status(dev=args.dev, remote=args.remote)
+        return
+
+    run(dev=args.dev,
+        remote=args.remote,
+        once=args.once,
+        verbose=args.verbose,
+        reindex_debounce=args.reindex_debounce,
+        upload_stable=args.upload_stable)
 
 
 if __name__ == "__main__":
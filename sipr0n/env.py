@@ -14,6 +14,15 @@ ARCHIVE_TOOL_DIR = None
 SIMAPPER_USER_DIR = None
 SIPAGER_USER_DIR = None
 SIMAPPER_TMP_DIR = "/tmp/simapper"
+# Persistent job state
+SIMAPPER_DB = None
+SIPAGER_DB = None
+# Content hash index shared by simapper / sipager
+HASH_DB = None
+# See sipr0n.maptree
+MAPTREE_CACHE = None
+# See sipr0n.manifestdb
+MANIFEST_DB = None
 
 
 def setup_env_default():
@@ -31,6 +40,11 @@ def setup_env(dev=False, remote=False):
     global WIKI_TOOL_DIR
     global SIMAPPER_USER_DIR
     global SIPAGER_USER_DIR
+    global SIMAPPER_DB
+    global SIPAGER_DB
+    global HASH_DB
+    global MAPTREE_CACHE
+    global MANIFEST_DB
 
     # XXX: consider removing this now that have unit test
     assert not remote
@@ -66,6 +80,13 @@ def setup_env(dev=False, remote=False):
     # but good enough right now
     COPYRIGHT_TXT = WWW_DIR + "/archive/data/pages/tool/copyright.txt"
 
+    # Next to the service logs
+    SIMAPPER_DB = WWW_DIR + "/lib/simapper.sqlite"
+    SIPAGER_DB = WWW_DIR + "/lib/sipager.sqlite"
+    HASH_DB = WWW_DIR + "/lib/hash.sqlite"
+    MAPTREE_CACHE = WWW_DIR + "/lib/maptree.json"
+    MANIFEST_DB = WWW_DIR + "/lib/manifest.sqlite"
+
     print("Environment:")
     print("  WWW_DIR: ", WWW_DIR)
     print("  MAP_DIR: ", MAP_DIR)
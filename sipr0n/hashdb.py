@@ -0,0 +1,203 @@
+"""
+Content hash index of archive images
+
+Maps file name => content hash for map/*/*/single and the wiki media tree
+so a new upload that is byte for byte identical to something already in the
+archive can be spotted before it gets tiled again
+Files are only rehashed when their size or mtime changes
+"""
+
+import fnmatch
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Same as scrape_travis signatures
+HASH_ALGO = "sha1"
+# Large reads: these are often multi GB
+HASH_CHUNK = 4 * 1024 * 1024
+
+# Not worth indexing: generated from indexed images
+IGNORE_PATTERNS = ("*.thumb*", "*.tmp")
+
+
+def hash_file(fn, algo=HASH_ALGO):
+    """
+    Streaming hash of a file's contents, returned as a hex string
+    """
+    h = hashlib.new(algo)
+    buf = bytearray(HASH_CHUNK)
+    view = memoryview(buf)
+    with open(fn, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def is_ignored(fn):
+    base = os.path.basename(fn)
+    for pattern in IGNORE_PATTERNS:
+        if fnmatch.fnmatch(base, pattern):
+            return True
+    return False
+
+
+class HashDB:
+    def __init__(self, fn):
+        self.fn = fn
+        dirname = os.path.dirname(fn)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # Shared by simapper and sipager, used from worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fn, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("""\
+CREATE TABLE IF NOT EXISTS files (
+    fn TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    updated REAL
+)""")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def cached(self, fn, st=None):
+        """
+        Return the stored hash if fn hasn't changed since it was hashed
+        """
+        if st is None:
+            st = os.stat(fn)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash FROM files WHERE fn = ? AND size = ? AND mtime = ?",
+                (fn, st.st_size, st.st_mtime)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add(self, fn, digest, st=None):
+        if st is None:
+            st = os.stat(fn)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (fn, size, mtime, hash, updated)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (fn, st.st_size, st.st_mtime, digest, time.time()))
+            self.db.commit()
+
+    def remove(self, fn):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE fn = ?", (fn, ))
+            self.db.commit()
+
+    def hash(self, fn):
+        """
+        Return the hash of fn, computing and storing it if needed
+        """
+        fn = os.path.realpath(fn)
+        st = os.stat(fn)
+        digest = self.cached(fn, st)
+        if digest is None:
+            digest = hash_file(fn)
+            self.add(fn, digest, st)
+        return digest
+
+    def find(self, digest, exclude=None):
+        """
+        Indexed files that still exist with the given hash
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT fn FROM files WHERE hash = ? ORDER BY fn",
+                (digest, )).fetchall()
+        ret = []
+        for row in rows:
+            fn = row[0]
+            if fn == exclude:
+                continue
+            if not os.path.exists(fn):
+                self.remove(fn)
+                continue
+            ret.append(fn)
+        return ret
+
+    def duplicates(self):
+        """
+        dict of
+        hash : [fn, ...] for every hash with more than one file
+        """
+        with self.lock:
+            rows = self.db.execute("""\
+SELECT hash, fn FROM files WHERE hash IN
+    (SELECT hash FROM files GROUP BY hash HAVING COUNT(*) > 1)
+ORDER BY hash, fn""").fetchall()
+        ret = {}
+        for row in rows:
+            ret.setdefault(row[0], []).append(row[1])
+        return ret
+
+    def prune(self):
+        """
+        Drop files that no longer exist
+        Return the number removed
+        """
+        with self.lock:
+            fns = [
+                row[0]
+                for row in self.db.execute("SELECT fn FROM files").fetchall()
+            ]
+        removed = 0
+        for fn in fns:
+            if not os.path.exists(fn):
+                self.remove(fn)
+                removed += 1
+        return removed
+
+
+def archive_fns(map_dir, wiki_dir):
+    """
+    Every file that should be in the index
+    """
+    fns = glob.glob(map_dir + "/*/*/single/*")
+    fns += glob.glob(wiki_dir + "/data/media/**", recursive=True)
+    return sorted([
+        os.path.realpath(fn) for fn in fns
+        if os.path.isfile(fn) and not is_ignored(fn)
+    ])
+
+
+def update_index(db, map_dir, wiki_dir, verbose=False):
+    """
+    Bring the index up to date w/ the archive
+    Only new / changed files are read
+    """
+    removed = db.prune()
+    hashed = 0
+    fns = archive_fns(map_dir, wiki_dir)
+    for fn in fns:
+        try:
+            st = os.stat(fn)
+            if db.cached(fn, st) is not None:
+                continue
+            verbose and print("Hashing " + fn)
+            db.add(fn, hash_file(fn), st)
+            hashed += 1
+        except FileNotFoundError:
+            # Deleted during the scan
+            pass
+    print("Hash index: %u files, %u hashed, %u removed" %
+          (len(fns), hashed, removed))
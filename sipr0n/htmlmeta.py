@@ -0,0 +1,94 @@
+"""
+Extract the initViewer({...}); metadata from a map index.html
+
+pr0nmap puts the whole viewer config on one line near the top
+Only a bounded prefix of the file is read. If the marker isn't in it the
+rest of the file is searched through mmap rather than read into memory
+Results are cached by (path, mtime, size)
+"""
+
+import copy
+import json
+import mmap
+import os
+import threading
+
+MARKER = b"initViewer("
+# Custom pages w/o generated metadata
+# ex: /var/www/map/mos/6581r3/vec-a/index.html
+CUSTOM_MARKER = b"SiProjection"
+# Generated pages have the line within the first ~1 KB
+PREFIX_BYTES = 64 * 1024
+
+# (path, mtime, size) to result
+cache = {}
+cache_lock = threading.Lock()
+CACHE_MAX = 65536
+
+decoder = json.JSONDecoder()
+
+
+class CustomPage(ValueError):
+    """
+    Hand written page w/o initViewer() metadata
+    """
+    pass
+
+
+def parse(buf, pos, fn):
+    """
+    buf: bytes like holding the initViewer( line starting at pos
+    """
+    end = buf.find(b"\n", pos)
+    if end < 0:
+        end = len(buf)
+    line = bytes(buf[pos + len(MARKER):end]).decode("utf-8")
+    try:
+        # Ignores the trailing );
+        j, _end = decoder.raw_decode(line.strip())
+    except ValueError as e:
+        raise ValueError("Bad initViewer JSON in %s: %s" % (fn, e))
+    return j
+
+
+def extract_uncached(fn):
+    with open(fn, "rb") as f:
+        buf = f.read(PREFIX_BYTES)
+        pos = buf.find(MARKER)
+        # Found w/ the whole line in the prefix
+        if pos >= 0 and (buf.find(b"\n", pos) >= 0 or len(buf) < PREFIX_BYTES):
+            return parse(buf, pos, fn)
+        if len(buf) < PREFIX_BYTES:
+            if CUSTOM_MARKER in buf:
+                raise CustomPage(fn)
+            raise ValueError("Failed to find initViewer: %s" % (fn, ))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = m.find(MARKER)
+            if pos >= 0:
+                return parse(m, pos, fn)
+            if m.find(CUSTOM_MARKER) >= 0:
+                raise CustomPage(fn)
+    raise ValueError("Failed to find initViewer: %s" % (fn, ))
+
+
+def extract(fn, cache_=True):
+    """
+    Return the initViewer() argument as a dict like
+    {"tilesAlignedTopLeft": true, "scale": null, "layers": [{"imageSize": 32000, "tileExt": ".jpg", "width": 30811, "height": 30989, "URL": "l1", "tileSize": 250, "name": "...", "copyright": "..."}], "name": "..."}
+    Raises CustomPage for hand written pages, ValueError if not found
+    Returned dict is a copy and may be modified
+    cache_: set False for files that are regenerated in place quickly
+    """
+    if not cache_:
+        return extract_uncached(fn)
+    st = os.stat(fn)
+    k = (os.path.realpath(fn), st.st_mtime_ns, st.st_size)
+    with cache_lock:
+        ret = cache.get(k)
+    if ret is None:
+        ret = extract_uncached(fn)
+        with cache_lock:
+            if len(cache) >= CACHE_MAX:
+                cache.clear()
+            cache[k] = ret
+    return copy.deepcopy(ret)
@@ -0,0 +1,151 @@
+"""
+Persistent upload job state for simapper / sipager
+
+One row per uploaded file recording the last status (Pending/Done/...)
+and how far processing got
+Lets a restart resume just the pending jobs and skip uploads that were
+already rejected instead of re-running them
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# Stages an upload goes through
+# Recorded as they complete so a crash can be cleaned up
+STAGE_QUEUED = "queued"
+STAGE_PLACED = "placed"
+STAGE_MAPPED = "mapped"
+STAGE_WIKI = "wiki"
+STAGE_DONE = "done"
+
+COLUMNS = ("fn", "user", "mtime", "status", "stage", "single_fn", "map_fn",
+           "created", "updated", "ident")
+
+
+def file_ident(fn):
+    """
+    Identifies one particular upload at a path
+    mtime alone isn't enough: extracted archive members keep the archive's
+    """
+    st = os.stat(fn)
+    return "%u:%u:%u" % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def rejected(job, fn, retry_statuses):
+    """
+    True if job ended w/o consuming the upload (ex: collision) and fn is
+    still that exact file, so trying it again would fail the same way
+    retry_statuses: never skipped, ex: pending (interrupted) and done
+    (consumed, so a file there now is a new upload)
+    """
+    if job is None or job["status"] in retry_statuses or not job["ident"]:
+        return False
+    try:
+        return job["ident"] == file_ident(fn)
+    except FileNotFoundError:
+        return False
+
+
+class JobDB:
+    def __init__(self, fn):
+        self.fn = fn
+        dirname = os.path.dirname(fn)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # Jobs run on worker threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fn, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("""\
+CREATE TABLE IF NOT EXISTS jobs (
+    fn TEXT PRIMARY KEY,
+    user TEXT,
+    mtime REAL,
+    status TEXT,
+    stage TEXT,
+    single_fn TEXT,
+    map_fn TEXT,
+    created REAL,
+    updated REAL,
+    ident TEXT
+)""")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, fn):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE fn = ?",
+                                  (fn, )).fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
+    def add(self, fn, user, mtime, status, ident=None):
+        """
+        Start a new job, replacing any previous attempt on the same file
+        ident: file_ident() of the upload
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs"
+                " (fn, user, mtime, status, stage, single_fn, map_fn, created, updated, ident)"
+                " VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?, ?)",
+                (fn, user, mtime, status, STAGE_QUEUED, now, now, ident))
+            self.db.commit()
+
+    def update(self, fn, **kwargs):
+        for k in kwargs.keys():
+            if k not in COLUMNS or k == "fn":
+                raise ValueError("Bad job column %s" % (k, ))
+        kwargs["updated"] = time.time()
+        keys = sorted(kwargs.keys())
+        sets = ", ".join(["%s = ?" % k for k in keys])
+        with self.lock:
+            self.db.execute("UPDATE jobs SET %s WHERE fn = ?" % sets,
+                            [kwargs[k] for k in keys] + [fn])
+            self.db.commit()
+
+    def delete(self, fn):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE fn = ?", (fn, ))
+            self.db.commit()
+
+    def with_status(self, status):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created",
+                (status, )).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self):
+        """
+        dict of
+        status : number of jobs
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict([(row[0], row[1]) for row in rows])
+
+
+def print_status(db, pending_status):
+    """
+    Operator summary of a job table
+    """
+    print("Job DB: %s" % (db.fn, ))
+    counts = db.counts()
+    for status in sorted(counts.keys()):
+        print("  %s: %u" % (status, counts[status]))
+    pending = db.with_status(pending_status)
+    print("Queue depth: %u" % len(pending))
+    for job in pending:
+        print("  %s (stage: %s)" % (job["fn"], job["stage"]))
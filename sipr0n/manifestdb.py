@@ -0,0 +1,174 @@
+"""
+Archive wide index of the per chipid .manifest files (see sipr0n.simap)
+
+Answers things like "all maps by collection X" or "all files from 2020"
+w/o walking the /map tree and parsing every manifest
+A chip is only reloaded when its .manifest or journal changed
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from sipr0n import simap
+
+
+def manifest_state(chipid_dir):
+    """
+    Return a key that changes whenever the chip's manifest contents may have
+    or None if the chip has no manifest
+    """
+    ret = []
+    for basename in (simap.MANIFEST, simap.JOURNAL):
+        try:
+            st = os.stat(os.path.join(chipid_dir, basename))
+            ret.append("%u:%u" % (st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            ret.append("")
+    if not any(ret):
+        return None
+    return " ".join(ret)
+
+
+class ManifestDB:
+    def __init__(self, fn):
+        self.fn = fn
+        dirname = os.path.dirname(fn)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fn, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute("""\
+CREATE TABLE IF NOT EXISTS chips (
+    vendor TEXT,
+    chipid TEXT,
+    state TEXT,
+    updated REAL,
+    PRIMARY KEY (vendor, chipid)
+)""")
+            self.db.execute("""\
+CREATE TABLE IF NOT EXISTS files (
+    vendor TEXT,
+    chipid TEXT,
+    fn TEXT,
+    collection TEXT,
+    type TEXT,
+    copyright_year INTEGER,
+    PRIMARY KEY (vendor, chipid, fn)
+)""")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS files_collection ON files (collection)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS files_year ON files (copyright_year)"
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def states(self):
+        """
+        dict of
+        (vendor, chipid) : state
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT vendor, chipid, state FROM chips").fetchall()
+        return dict([((row[0], row[1]), row[2]) for row in rows])
+
+    def set_chip(self, vendor, chipid, state, manifest):
+        """
+        Replace all entries for a chip with manifest's
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE vendor = ? AND chipid = ?",
+                            (vendor, chipid))
+            self.db.executemany(
+                "INSERT INTO files (vendor, chipid, fn, collection, type, copyright_year)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(vendor, chipid, fn, v.get("collection"), v.get("type"),
+                  v.get("copyright_year"))
+                 for fn, v in sorted(manifest["files"].items())])
+            self.db.execute(
+                "INSERT OR REPLACE INTO chips (vendor, chipid, state, updated)"
+                " VALUES (?, ?, ?, ?)", (vendor, chipid, state, time.time()))
+            self.db.commit()
+
+    def remove_chip(self, vendor, chipid):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE vendor = ? AND chipid = ?",
+                            (vendor, chipid))
+            self.db.execute("DELETE FROM chips WHERE vendor = ? AND chipid = ?",
+                            (vendor, chipid))
+            self.db.commit()
+
+    def query(self, collection=None, type_=None, year=None, vendor=None,
+              chipid=None):
+        """
+        Return a list of dict like
+        {"vendor": ..., "chipid": ..., "fn": ..., "collection": ..., "type": ..., "copyright_year": ...}
+        Unset arguments match anything
+        """
+        where = []
+        args = []
+        for k, v in (("collection", collection), ("type", type_),
+                     ("copyright_year", year), ("vendor", vendor),
+                     ("chipid", chipid)):
+            if v is not None:
+                where.append(k + " = ?")
+                args.append(v)
+        sql = "SELECT * FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY vendor, chipid, fn"
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [dict(row) for row in rows]
+
+    def summary(self):
+        """
+        Return a list of (collection, type, count)
+        """
+        with self.lock:
+            rows = self.db.execute("""\
+SELECT collection, type, COUNT(*) FROM files
+GROUP BY collection, type ORDER BY collection, type""").fetchall()
+        return [tuple(row) for row in rows]
+
+
+def update_index(db, map_dir, verbose=False):
+    """
+    Bring the index up to date w/ the manifests under map_dir
+    Only chips whose manifest changed are read
+    """
+    old = db.states()
+    seen = set()
+    loaded = 0
+    for vendor in sorted(os.listdir(map_dir)):
+        vendor_dir = os.path.join(map_dir, vendor)
+        if not os.path.isdir(vendor_dir):
+            continue
+        for chipid in sorted(os.listdir(vendor_dir)):
+            chipid_dir = os.path.join(vendor_dir, chipid)
+            state = manifest_state(chipid_dir)
+            if state is None:
+                continue
+            seen.add((vendor, chipid))
+            if old.get((vendor, chipid)) == state:
+                continue
+            verbose and print("Loading %s/%s" % (vendor, chipid))
+            db.set_chip(vendor, chipid, state,
+                        simap.map_manifest_load(chipid_dir))
+            loaded += 1
+    removed = 0
+    for vendor, chipid in sorted(set(old.keys()) - seen):
+        verbose and print("Removing %s/%s" % (vendor, chipid))
+        db.remove_chip(vendor, chipid)
+        removed += 1
+    print("Manifest index: %u chips, %u loaded, %u removed" %
+          (len(seen), loaded, removed))
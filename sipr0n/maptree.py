@@ -0,0 +1,211 @@
+"""
+Cached index of the /map tree
+
+MAP_DIR/vendor/chipid/
+-single/: high resolution images
+-collection_flavor/index.html: tile maps
+-.manifest
+
+The auser_* tools each used to walk the whole tree and re-read every
+index.html. Instead scan once into a JSON cache and on later loads only
+re-list dirs / re-read index.html files whose mtime changed
+
+Note: a file overwritten in place (same name, no rename) doesn't change its
+dir's mtime so its single/ stat info may be stale. index.html is always
+checked individually
+"""
+
+import json
+import os
+
+from sipr0n import env
+from sipr0n import htmlmeta
+from sipr0n import util
+
+VERSION = 1
+
+
+def read_map_meta(index_fn):
+    """
+    Return (initViewer() dict or None, custom page flag)
+    """
+    try:
+        return htmlmeta.extract(index_fn), False
+    except htmlmeta.CustomPage:
+        return None, True
+
+
+def scan_map(index_fn, basename, old):
+    """
+    old: previous entry for this map or None
+    """
+    mtime = os.path.getmtime(index_fn)
+    if old and old["index_mtime"] == mtime:
+        return old, False
+    ret = {
+        "basename": basename,
+        "collection": None,
+        "flavor": None,
+        "index_mtime": mtime,
+        "meta": None,
+        "custom": False,
+        "error": None,
+    }
+    try:
+        ret["collection"], ret["flavor"] = util.parse_map_basename_uf(basename)
+    except Exception:
+        # Old style dir w/o collection prefix
+        pass
+    try:
+        ret["meta"], ret["custom"] = read_map_meta(index_fn)
+    except ValueError as e:
+        ret["error"] = str(e)
+    return ret, True
+
+
+def scan_single(single_dir):
+    ret = []
+    for basename in sorted(os.listdir(single_dir)):
+        fn = os.path.join(single_dir, basename)
+        if not os.path.isfile(fn):
+            continue
+        st = os.stat(fn)
+        ret.append({
+            "basename": basename,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+        })
+    return ret
+
+
+def scan_chip(chipid_dir, vendor, chipid, old, stats):
+    """
+    old: previous entry for this chip or None
+    """
+    single_dir = os.path.join(chipid_dir, "single")
+    single_mtime = None
+    if os.path.isdir(single_dir):
+        single_mtime = os.path.getmtime(single_dir)
+    ret = {
+        "vendor": vendor,
+        "chipid": chipid,
+        "mtime": os.path.getmtime(chipid_dir),
+        "single_mtime": single_mtime,
+        "manifest": os.path.exists(os.path.join(chipid_dir, ".manifest")),
+        "singles": [],
+        "maps": [],
+    }
+
+    if old and old["single_mtime"] == single_mtime:
+        ret["singles"] = old["singles"]
+    elif single_mtime is not None:
+        ret["singles"] = scan_single(single_dir)
+        stats["singles"] += 1
+
+    old_maps = {}
+    if old:
+        old_maps = dict([(m["basename"], m) for m in old["maps"]])
+    # Map dirs added / removed / renamed change the chip dir's mtime
+    if old and old["mtime"] == ret["mtime"]:
+        basenames = sorted(old_maps.keys())
+    else:
+        basenames = sorted(os.listdir(chipid_dir))
+        stats["listed"] += 1
+    for basename in basenames:
+        index_fn = os.path.join(chipid_dir, basename, "index.html")
+        try:
+            mapj, reread = scan_map(index_fn, basename,
+                                    old_maps.get(basename))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if reread:
+            stats["reread"] += 1
+        ret["maps"].append(mapj)
+    return ret
+
+
+def load_cache(cache_fn, map_dir):
+    try:
+        with open(cache_fn, "r") as f:
+            j = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if j.get("version") != VERSION or j.get("map_dir") != map_dir:
+        return None
+    return j
+
+
+def save_cache(cache_fn, tree):
+    dirname = os.path.dirname(cache_fn)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    with open(cache_fn + ".tmp", "w") as f:
+        json.dump(tree, f, sort_keys=True)
+    os.replace(cache_fn + ".tmp", cache_fn)
+
+
+def load(map_dir=None, cache_fn=None, refresh=True):
+    """
+    Return the map tree index, bringing the cache up to date unless
+    refresh=False and a cache exists
+    {
+        "version": 1,
+        "map_dir": "/var/www/map",
+        "chips": {
+            "vendor/chipid": {"vendor": ..., "chipid": ..., "singles": [...], "maps": [...], ...},
+        },
+    }
+    """
+    if map_dir is None or cache_fn is None:
+        env.setup_env_default()
+    if map_dir is None:
+        map_dir = env.MAP_DIR
+    if cache_fn is None:
+        cache_fn = env.MAPTREE_CACHE
+
+    old = load_cache(cache_fn, map_dir)
+    if old and not refresh:
+        return old
+    old_chips = old["chips"] if old else {}
+
+    tree = {"version": VERSION, "map_dir": map_dir, "chips": {}}
+    stats = {"listed": 0, "singles": 0, "reread": 0}
+    for vendor in sorted(os.listdir(map_dir)):
+        vendor_dir = os.path.join(map_dir, vendor)
+        if not os.path.isdir(vendor_dir):
+            continue
+        for chipid in sorted(os.listdir(vendor_dir)):
+            chipid_dir = os.path.join(vendor_dir, chipid)
+            if not os.path.isdir(chipid_dir):
+                continue
+            k = vendor + "/" + chipid
+            tree["chips"][k] = scan_chip(chipid_dir, vendor, chipid,
+                                         old_chips.get(k), stats)
+    save_cache(cache_fn, tree)
+    print("Map tree: %u chips, %u maps (listed %u, single %u, read %u)" %
+          (len(tree["chips"]), len(maps(tree)), stats["listed"],
+           stats["singles"], stats["reread"]))
+    return tree
+
+
+def chip_dir(tree, chip):
+    return os.path.join(tree["map_dir"], chip["vendor"], chip["chipid"])
+
+
+def chips(tree):
+    return [tree["chips"][k] for k in sorted(tree["chips"].keys())]
+
+
+def maps(tree):
+    """
+    List of (chip, map) for every index.html
+    """
+    ret = []
+    for chip in chips(tree):
+        for mapj in chip["maps"]:
+            ret.append((chip, mapj))
+    return ret
+
+
+def map_index_fn(tree, chip, mapj):
+    return os.path.join(chip_dir(tree, chip), mapj["basename"], "index.html")
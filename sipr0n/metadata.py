@@ -1,3 +1,6 @@
+import os
+import threading
+
 from sipr0n import env
 """
 Think this format should be shuffle agnostic
@@ -27,6 +30,12 @@ We'll have to see how easy they are to resolve / how many
 }
 """
 
+# Parsed copyright.txt
+# k: (fn, mtime, size) it was parsed from
+copyright_cache = {}
+copyright_lock = threading.Lock()
+
+
 class CollectionNotFound(Exception):
     pass
 
@@ -74,16 +83,15 @@ def add_meta_map(meta, vendor, chipid, collection, basename):
     return j
 
 
-def load_copyright_db():
+def parse_copyright_txt(fn):
     """
-    dict of
-    collection : copyright
+    cat /var/www/archive/data/pages/copyright.txt
+    ^ User ^ Copyright ^ Note ^
+    | mcmaster | John McMaster, CC-BY |  |
+    A collection listed twice takes its last entry
     """
-    env.setup_env_default()
     ret = {}
-    print("Loading", env.COPYRIGHT_TXT)
-    f = open(env.COPYRIGHT_TXT, "r")
-    try:
+    with open(fn, "r") as f:
         f.readline()
         for l in f:
             l = l.strip()
@@ -91,34 +99,75 @@ def load_copyright_db():
                 continue
             _prefix, collection, copyright, _notes, _postfix = l.split("|")
             ret[collection.strip()] = copyright.strip()
-        return ret
-    finally:
-        f.close()
+    return ret
 
 
-def default_copyright(collection):
+def copyright_name(copyright):
     """
-    cat /var/www/archive/data/pages/copyright.txt
-    ^ User ^ Copyright ^ Note ^
-    | mcmaster | John McMaster, CC-BY |  |
+    "John McMaster, CC-BY" => "john mcmaster"
     """
-    f = open(env.COPYRIGHT_TXT, "r")
-    try:
-        f.readline()
-        for l in f:
-            l = l.strip()
-            if not l:
-                continue
-            _prefix, this_collection, copyright, _notes, _postfix = l.split(
-                "|")
-            this_collection = this_collection.strip()
-            copyright = copyright.strip()
-            if collection == this_collection:
-                return copyright
-        else:
-            raise CollectionNotFound("Failed to find copyright for " + collection)
-    finally:
-        f.close()
+    return copyright.lower().split(",")[0]
+
+
+def index_copyright_names(db):
+    """
+    dict of
+    copyright_name() : collection (lower case)
+    """
+    ret = {}
+    for collection, copyright in db.items():
+        ret.setdefault(copyright_name(copyright), collection.lower())
+    return ret
+
+
+def load_copyright_cache():
+    env.setup_env_default()
+    fn = env.COPYRIGHT_TXT
+    st = os.stat(fn)
+    k = (fn, st.st_mtime_ns, st.st_size)
+    with copyright_lock:
+        if copyright_cache.get("k") != k:
+            db = parse_copyright_txt(fn)
+            copyright_cache["db"] = db
+            copyright_cache["names"] = index_copyright_names(db)
+            copyright_cache["k"] = k
+        return copyright_cache
+
+
+def copyright_db():
+    """
+    dict of
+    collection : copyright
+    Parsed once and reparsed only when copyright.txt changes
+    Shared, don't modify
+    """
+    return load_copyright_cache()["db"]
+
+
+def copyright_names():
+    """
+    index_copyright_names() of copyright_db()
+    Shared, don't modify
+    """
+    return load_copyright_cache()["names"]
+
+
+def load_copyright_db():
+    """
+    dict of
+    collection : copyright
+    """
+    env.setup_env_default()
+    print("Loading", env.COPYRIGHT_TXT)
+    return dict(copyright_db())
+
+
+def default_copyright(collection):
+    ret = copyright_db().get(collection)
+    if ret is None:
+        raise CollectionNotFound("Failed to find copyright for " + collection)
+    return ret
+
 
 def assert_collection_exists(collection):
     # throws an exception as a side effect
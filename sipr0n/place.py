@@ -0,0 +1,102 @@
+"""
+Put an uploaded file into its final location without copying the data
+when the filesystem allows it
+
+Multi GB die images are usually on the same filesystem as the upload dir,
+so a full read + write is wasted I/O
+Tries in order: rename (only if the source may go away), hardlink,
+reflink (FICLONE, ex: btrfs / XFS), then falls back to a streamed copy
+"""
+
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+METHOD_RENAME = "rename"
+METHOD_HARDLINK = "hardlink"
+METHOD_REFLINK = "reflink"
+METHOD_COPY = "copy"
+
+# Expected when the filesystem / mount can't do the cheaper method
+FALLBACK_ERRNOS = set([
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EACCES,
+    errno.EMLINK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.ENOSYS,
+])
+
+
+def tmp_fn(dst):
+    # Same dir so the final os.replace() is atomic
+    return os.path.join(os.path.dirname(dst),
+                        ".%s.%u.tmp" % (os.path.basename(dst), os.getpid()))
+
+
+def rm_f(fn):
+    try:
+        os.unlink(fn)
+    except FileNotFoundError:
+        pass
+
+
+def try_hardlink(src, dst):
+    tmp = tmp_fn(dst)
+    rm_f(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+
+
+def try_reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflink not supported")
+    tmp = tmp_fn(dst)
+    try:
+        with open(src, "rb") as fin, open(tmp, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+    except:
+        rm_f(tmp)
+        raise
+
+
+def place_file(src, dst, move=False):
+    """
+    Make dst have the contents of src, replacing dst if it exists
+    move: src isn't needed afterwards, so it may be renamed away
+    Return the method used (METHOD_*)
+    """
+    attempts = []
+    if move:
+        attempts.append((METHOD_RENAME, os.rename))
+    attempts.append((METHOD_HARDLINK, try_hardlink))
+    attempts.append((METHOD_REFLINK, try_reflink))
+    for method, func in attempts:
+        try:
+            func(src, dst)
+            return method
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+    # sendfile() based on linux
+    tmp = tmp_fn(dst)
+    try:
+        shutil.copy(src, tmp)
+        os.replace(tmp, dst)
+    except:
+        rm_f(tmp)
+        raise
+    return METHOD_COPY
@@ -0,0 +1,219 @@
+"""
+Get image dimensions by reading only the file header
+
+Replaces running ImageMagick identify, which on a multi hundred MB image
+can decode far more than it needs to
+Parsed: JPEG (SOF marker), PNG (IHDR), TIFF / BigTIFF (first IFD)
+Anything else (webp, gif, bmp, ...) is still handed to identify
+"""
+
+import os
+import struct
+import subprocess
+import threading
+
+
+class ProbeError(Exception):
+    pass
+
+
+class UnknownFormat(ProbeError):
+    pass
+
+
+# JPEG start of frame markers: all except DHT (C4), JPG (C8), DAC (CC)
+JPEG_SOF = set([
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE,
+    0xCF
+])
+# Standalone markers (no length field)
+JPEG_STANDALONE = set([0x01] + list(range(0xD0, 0xD8)))
+
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+
+# (path, mtime, size) to result
+cache = {}
+cache_lock = threading.Lock()
+CACHE_MAX = 4096
+
+
+def read_exact(f, n):
+    buf = f.read(n)
+    if len(buf) != n:
+        raise ProbeError("Truncated header")
+    return buf
+
+
+def probe_jpeg(f):
+    # Skip SOI
+    f.seek(2)
+    while True:
+        b = read_exact(f, 1)
+        if b != b"\xFF":
+            raise ProbeError("Bad JPEG marker")
+        marker = read_exact(f, 1)[0]
+        # Fill bytes
+        while marker == 0xFF:
+            marker = read_exact(f, 1)[0]
+        if marker in JPEG_STANDALONE:
+            continue
+        # EOI / SOS before a frame header
+        if marker in (0xD9, 0xDA):
+            raise ProbeError("JPEG missing SOF")
+        length = struct.unpack(">H", read_exact(f, 2))[0]
+        if marker in JPEG_SOF:
+            _precision, height, width = struct.unpack(">BHH",
+                                                      read_exact(f, 5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def probe_png(f):
+    f.seek(8)
+    _length, ctype, width, height = struct.unpack(">I4sII",
+                                                  read_exact(f, 16))
+    if ctype != b"IHDR":
+        raise ProbeError("PNG missing IHDR")
+    return width, height
+
+
+def probe_tiff(f, endian):
+    f.seek(2)
+    version = struct.unpack(endian + "H", read_exact(f, 2))[0]
+    if version == 42:
+        ifd_offset = struct.unpack(endian + "I", read_exact(f, 4))[0]
+        count_fmt, entry_fmt, value_size = "H", "HHI", 4
+    elif version == 43:
+        # BigTIFF
+        _bytesize, _zero, ifd_offset = struct.unpack(endian + "HHQ",
+                                                     read_exact(f, 12))
+        count_fmt, entry_fmt, value_size = "Q", "HHQ", 8
+    else:
+        raise ProbeError("Bad TIFF version %u" % version)
+
+    f.seek(ifd_offset)
+    entries = struct.unpack(endian + count_fmt,
+                            read_exact(f, struct.calcsize(count_fmt)))[0]
+    # Packed: w/o the endian prefix calcsize() would add native padding
+    head_size = struct.calcsize(endian + entry_fmt)
+    entry_size = head_size + value_size
+    width = None
+    height = None
+    for _i in range(entries):
+        entry = read_exact(f, entry_size)
+        tag, type_, _count = struct.unpack(endian + entry_fmt,
+                                           entry[:head_size])
+        value = entry[head_size:]
+        # SHORT or LONG (or LONG8), left justified in the value field
+        if type_ == 3:
+            value = struct.unpack(endian + "H", value[:2])[0]
+        elif type_ == 4:
+            value = struct.unpack(endian + "I", value[:4])[0]
+        elif type_ == 16:
+            value = struct.unpack(endian + "Q", value[:8])[0]
+        else:
+            continue
+        if tag == TIFF_IMAGE_WIDTH:
+            width = value
+        elif tag == TIFF_IMAGE_LENGTH:
+            height = value
+        if width is not None and height is not None:
+            return width, height
+    raise ProbeError("TIFF missing dimensions")
+
+
+def probe_uncached(fn):
+    with open(fn, "rb") as f:
+        magic = f.read(8)
+        if magic[0:3] == b"\xFF\xD8\xFF":
+            return "JPEG", probe_jpeg(f)
+        if magic == b"\x89PNG\r\n\x1a\n":
+            return "PNG", probe_png(f)
+        if magic[0:2] == b"II":
+            return "TIFF", probe_tiff(f, "<")
+        if magic[0:2] == b"MM":
+            return "TIFF", probe_tiff(f, ">")
+    raise UnknownFormat("Unrecognized image format: %s" % (fn, ))
+
+
+def probe_identify(fn):
+    """
+    Slow path for formats not parsed here
+    Only the first frame / page is reported
+    """
+    try:
+        out = subprocess.check_output(
+            ["identify", "-ping", "-format", "%m %w %h\n", fn],
+            text=True,
+            stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        raise ProbeError("identify failed: %s" % (fn, ))
+    try:
+        format_, width, height = out.split("\n")[0].split(" ")
+        return format_, (int(width), int(height))
+    except ValueError:
+        raise ProbeError("Bad identify output: %s" % (fn, ))
+
+
+def probe(fn):
+    """
+    Return dict like
+    {
+        "format": "JPEG",
+        "width": 1158,
+        "height": 750,
+        "size": 313940,
+    }
+    Raises ProbeError if not an image
+    """
+    st = os.stat(fn)
+    k = (os.path.realpath(fn), st.st_mtime, st.st_size)
+    with cache_lock:
+        ret = cache.get(k)
+    if ret:
+        return dict(ret)
+
+    try:
+        format_, (width, height) = probe_uncached(fn)
+    except UnknownFormat:
+        format_, (width, height) = probe_identify(fn)
+    except struct.error:
+        raise ProbeError("Corrupt header: %s" % (fn, ))
+    if not width or not height:
+        raise ProbeError("Bad dimensions %ux%u: %s" % (width, height, fn))
+    ret = {
+        "format": format_,
+        "width": width,
+        "height": height,
+        "size": st.st_size,
+    }
+    with cache_lock:
+        if len(cache) >= CACHE_MAX:
+            cache.clear()
+        cache[k] = ret
+    return dict(ret)
+
+
+def format_wh(info):
+    """
+    ex: 1158x750
+    """
+    return "%ux%u" % (info["width"], info["height"])
+
+
+def format_size(size):
+    """
+    File size exactly as identify prints it
+    Raw bytes while they fit in 6 significant digits, then scaled by 1000
+    ex: 313940B, 12.3457MB
+    """
+    if size < 1000000:
+        return "%uB" % size
+    units = ["", "K", "M", "G", "T", "P", "E"]
+    value = float(size)
+    i = 0
+    while value >= 1000 and i + 1 < len(units):
+        value /= 1000
+        i += 1
+    return "%.6g%sB" % (value, units[i])
@@ -0,0 +1,97 @@
+"""
+Incremental DokuWiki search reindex
+
+bin/indexer.php walks every page in the wiki which takes longer than most
+map jobs. Instead collect the page IDs that were actually written and index
+just those, coalescing everything changed within a debounce window into a
+single php invocation
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+# Run with DokuWiki loaded, same as bin/indexer.php does
+# argv: wiki dir, page IDs...
+PHP_INDEX_PAGES = """\
+if (!defined('DOKU_INC')) define('DOKU_INC', $argv[1] . '/');
+define('NOSESSION', 1);
+require_once(DOKU_INC . 'inc/init.php');
+foreach (array_slice($argv, 2) as $id) {
+    idx_addPage($id, false, true);
+}
+"""
+
+
+def page_fn_to_id(wiki_dir, page_fn):
+    """
+    /var/www/archive/data/pages/tool/simapper/mcmaster.txt => tool:simapper:mcmaster
+    """
+    pages_dir = os.path.realpath(wiki_dir + "/data/pages")
+    rel = os.path.relpath(os.path.realpath(page_fn), pages_dir)
+    if rel.startswith("..") or not rel.endswith(".txt"):
+        raise ValueError("Not a wiki page: %s" % (page_fn, ))
+    return rel[:-len(".txt")].replace(os.path.sep, ":")
+
+
+class Reindexer:
+    def __init__(self, wiki_dir, debounce=30.0, dev=False):
+        self.wiki_dir = wiki_dir
+        # Seconds to wait after the first change before indexing
+        self.debounce = debounce
+        self.dev = dev
+        # Pages may be written from map worker threads
+        self.lock = threading.Lock()
+        self.page_ids = set()
+        self.first_change = None
+
+    def add(self, page_id):
+        with self.lock:
+            if not self.page_ids:
+                self.first_change = time.time()
+            self.page_ids.add(page_id)
+
+    def add_page_fn(self, page_fn):
+        self.add(page_fn_to_id(self.wiki_dir, page_fn))
+
+    def time_left(self):
+        """
+        Seconds until a flush is due, or None if nothing is pending
+        """
+        with self.lock:
+            if not self.page_ids:
+                return None
+            return max(0.0,
+                       self.first_change + self.debounce - time.time())
+
+    def flush_if_due(self):
+        time_left = self.time_left()
+        if time_left is None or time_left > 0:
+            return False
+        return self.flush()
+
+    def flush(self):
+        with self.lock:
+            page_ids = sorted(self.page_ids)
+            self.page_ids = set()
+            self.first_change = None
+        if not page_ids:
+            return False
+        print("Reindexing %u pages" % len(page_ids))
+        for page_id in page_ids:
+            print("  " + page_id)
+        if self.dev:
+            print("dev: skip reindex")
+        else:
+            try:
+                # Already running as www-data
+                subprocess.check_output(["php", "-r", PHP_INDEX_PAGES, "--"] +
+                                        [self.wiki_dir] + page_ids)
+            except:
+                # Try again on the next flush
+                for page_id in page_ids:
+                    self.add(page_id)
+                raise
+        print("Reindex complete")
+        return True
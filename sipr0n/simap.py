@@ -1,39 +1,167 @@
+"""
+Per chipid .manifest: JSON with explicit copyright information
+
+chipid_dir/.manifest: canonical JSON, same format as always
+    {"files": {"single/x.jpg": {"collection": ..., "type": ..., "copyright_year": ...}}}
+chipid_dir/.manifest.journal: one JSON entry per line, not yet folded in
+chipid_dir/.manifest.lock: fcntl lock shared by all writers
+
+Adding a file appends one line to the journal instead of rewriting the
+whole manifest. The journal is folded into .manifest (fsync'd, then renamed
+over it) when it gets large, or on map_manifest_compact() after a batch
+Use map_manifest_load() to get the current contents including the journal
+"""
+
+import contextlib
+import datetime
+import fcntl
 import json
 import os
-import shutil
-import datetime
 
+MANIFEST = ".manifest"
+JOURNAL = ".manifest.journal"
+LOCK = ".manifest.lock"
+# Fold the journal in once it's this big
+JOURNAL_MAX_BYTES = 64 * 1024
 
-def map_manifest_add_file(basedir, fn, collection, type_, copyright_year=None):
+
+@contextlib.contextmanager
+def manifest_lock(basedir, exclusive=True):
     """
-    JSON with explicit copyright information
+    exclusive: writer, creates the lock file if needed
+    Otherwise reader: only needs read access and doesn't create anything,
+    so tools not running as the service user can still read
+    A missing lock file means nothing has written w/ the journal yet
     """
-    assert type_ in ("image", "map")
-    jfn = os.path.join(basedir, ".manifest")
+    fn = os.path.join(basedir, LOCK)
+    if exclusive:
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o644)
+    else:
+        try:
+            fd = os.open(fn, os.O_RDONLY)
+        except FileNotFoundError:
+            yield
+            return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_journal(basedir):
+    ret = []
+    try:
+        f = open(os.path.join(basedir, JOURNAL), "r")
+    except FileNotFoundError:
+        return ret
+    with f:
+        for l in f:
+            try:
+                ret.append(json.loads(l))
+            except ValueError:
+                # Torn write from a crash, the entry never completed
+                print("WARNING: %s: bad journal line: %s" %
+                      (basedir, l.strip()))
+    return ret
+
+
+def load_unlocked(basedir):
+    jfn = os.path.join(basedir, MANIFEST)
     if os.path.exists(jfn):
-        j = json.load(open(jfn))
+        with open(jfn, "r") as f:
+            j = json.load(f)
     else:
         j = {
             "files": {},
         }
+    # Replaying is idempotent so a crash mid compaction is harmless
+    for entry in read_journal(basedir):
+        fn = entry.pop("fn")
+        j["files"][fn] = entry
+    return j
+
+
+def map_manifest_load(basedir):
+    """
+    Return the manifest including journaled entries
+    """
+    if not os.path.exists(os.path.join(basedir, MANIFEST)) and \
+            not os.path.exists(os.path.join(basedir, JOURNAL)):
+        return {"files": {}}
+    with manifest_lock(basedir, exclusive=False):
+        return load_unlocked(basedir)
+
+
+def compact_unlocked(basedir):
+    jfn = os.path.join(basedir, MANIFEST)
+    j = load_unlocked(basedir)
+
+    # Be really careful not to corrupt records
+    with open(jfn + ".tmp", "w") as f:
+        json.dump(j, f, sort_keys=True, indent=4, separators=(',', ': '))
+        f.flush()
+        os.fsync(f.fileno())
+    # Keep the previous version around like before
+    if os.path.exists(jfn):
+        if os.path.exists(jfn + ".old"):
+            os.unlink(jfn + ".old")
+        os.link(jfn, jfn + ".old")
+    os.replace(jfn + ".tmp", jfn)
+    fsync_dir(basedir)
+
+    journal_fn = os.path.join(basedir, JOURNAL)
+    if os.path.exists(journal_fn):
+        os.truncate(journal_fn, 0)
+
+
+def map_manifest_compact(basedir):
+    """
+    Fold the journal into .manifest
+    Call when done adding a batch of files so .manifest is current
+    """
+    journal_fn = os.path.join(basedir, JOURNAL)
+    if not os.path.exists(journal_fn) or not os.path.getsize(journal_fn):
+        return
+    with manifest_lock(basedir):
+        compact_unlocked(basedir)
+
+
+def map_manifest_add_file(basedir, fn, collection, type_, copyright_year=None):
+    """
+    JSON with explicit copyright information
+    Safe against other processes / threads adding to the same manifest
+    """
+    assert type_ in ("image", "map")
 
     if not copyright_year:
         copyright_year = datetime.datetime.now().year
 
     if fn[0] == "/":
         raise ValueError("Require relative path")
-    j["files"][fn] = {
+    entry = {
+        "fn": fn,
         "collection": collection,
         "type": type_,
         "copyright_year": copyright_year,
     }
 
-    # Be really careful not to corrupt records
-    json.dump(j,
-              open(jfn + ".tmp", "w"),
-              sort_keys=True,
-              indent=4,
-              separators=(',', ': '))
-    if os.path.exists(jfn):
-        shutil.move(jfn, jfn + ".old")
-    shutil.move(jfn + ".tmp", jfn)
+    with manifest_lock(basedir):
+        journal_fn = os.path.join(basedir, JOURNAL)
+        with open(journal_fn, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        # New chip: make sure .manifest itself exists right away
+        if size >= JOURNAL_MAX_BYTES or not os.path.exists(
+                os.path.join(basedir, MANIFEST)):
+            compact_unlocked(basedir)
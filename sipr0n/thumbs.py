@@ -0,0 +1,102 @@
+"""
+Thumbnail variant naming and manifest
+
+Next to MAP_DIR/vendor/chipid/single/vendor_chipid_user_flavor.jpg autothumb writes:
+-vendor_chipid_user_flavor.thumb.jpg: original 300px thumbnail in the source format
+-vendor_chipid_user_flavor.thumb150.webp etc: one per configured size and format
+-vendor_chipid_user_flavor.thumbs.json: manifest listing the above
+
+All names contain ".thumb" and end in an image extension
+Anything globbing single/*.jpg must skip ".thumb" in the basename
+(ex: auser_map2unk, auser_map_assign, fixmap, img2doku.process_fns)
+"""
+
+import json
+import os
+
+MANIFEST_EXT = ".thumbs.json"
+
+# Preference order when picking a variant
+# DokuWiki's default mime.conf doesn't serve webp everywhere, keep wiki on jpg
+GALLERY_FORMATS = ("webp", "jpg")
+WIKI_FORMATS = ("jpg", )
+
+# PIL save() format names
+PIL_FORMATS = {
+    "jpg": "JPEG",
+    "webp": "WEBP",
+    "png": "PNG",
+}
+
+
+def image_base(fn):
+    """
+    dir/vendor_chipid_user_flavor.jpg => dir/vendor_chipid_user_flavor
+    """
+    return fn.rsplit(".", 1)[0]
+
+
+def legacy_fn(fn):
+    withoutext, ext = fn.rsplit(".", 1)
+    return withoutext + ".thumb." + ext
+
+
+def variant_fn(fn, size, fmt):
+    return "%s.thumb%u.%s" % (image_base(fn), size, fmt)
+
+
+def manifest_fn(fn):
+    return image_base(fn) + MANIFEST_EXT
+
+
+def write_manifest(fn, info, variants):
+    """
+    fn: source image
+    info: probe.probe() of fn
+    variants: list of dict like
+        {"fn": "x.thumb150.webp", "size": 150, "format": "webp",
+         "width": 150, "height": 97, "bytes": 4242}
+    fn entries are relative to the single dir
+    """
+    j = {
+        "source": os.path.basename(fn),
+        "width": info["width"],
+        "height": info["height"],
+        "variants": variants,
+    }
+    out_fn = manifest_fn(fn)
+    with open(out_fn + ".tmp", "w") as f:
+        json.dump(j, f, indent=4, sort_keys=True)
+    os.replace(out_fn + ".tmp", out_fn)
+
+
+def read_manifest(fn):
+    """
+    Return the manifest for source image fn or None if there isn't one
+    """
+    try:
+        with open(manifest_fn(fn), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def best_variant(fn, width, formats=GALLERY_FORMATS):
+    """
+    Smallest variant sized at least width (else the largest) in the most
+    preferred format available
+    Return the variant's file name relative to the single dir or None
+    """
+    j = read_manifest(fn)
+    if not j:
+        return None
+    for fmt in formats:
+        variants = sorted([v for v in j["variants"] if v["format"] == fmt],
+                          key=lambda v: v["size"])
+        if not variants:
+            continue
+        for v in variants:
+            if v["size"] >= width:
+                return v["fn"]
+        return variants[-1]["fn"]
+    return None
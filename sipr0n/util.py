@@ -1,6 +1,7 @@
 import re
 import os
 import sys
+import time
 
 
 def add_bool_arg(parser, yes_arg, default=False, **kwargs):
@@ -339,6 +340,91 @@ class FnRetry:
         """
         self.tried[fn] = True
 
+    def forget(self, fn):
+        """
+        File was consumed: a new file at the same path is a new upload
+        """
+        self.tried.pop(fn, None)
+
+
+"""
+Used to hold off on files that are still being uploaded
+Ex: a slow sftp upload would otherwise be picked up half written
+"""
+
+
+class UploadGate:
+    # Uploader can create foo.jpg.done to skip waiting
+    DONE_EXT = ".done"
+
+    def __init__(self, stable_time=10.0):
+        # Seconds size / mtime must be unchanged before a file is ready
+        self.stable_time = stable_time
+        # filename to (size, mtime) for files not ready yet
+        self.waiting = {}
+
+    def is_marker(self, fn):
+        return fn.endswith(self.DONE_EXT)
+
+    def marker_fn(self, fn):
+        return fn + self.DONE_EXT
+
+    def marker_target(self, fn):
+        """
+        foo.jpg.done => foo.jpg
+        """
+        return fn[:-len(self.DONE_EXT)]
+
+    def ready(self, fn):
+        """
+        True if the upload looks complete
+        Otherwise remember it so the caller can check back via waiting_fns()
+        """
+        if os.path.exists(self.marker_fn(fn)):
+            self.waiting.pop(fn, None)
+            return True
+        st = os.stat(fn)
+        this = (st.st_size, st.st_mtime)
+        last = self.waiting.get(fn)
+        if time.time() - st.st_mtime < self.stable_time or (last
+                                                           and last != this):
+            self.waiting[fn] = this
+            return False
+        self.waiting.pop(fn, None)
+        return True
+
+    def waiting_fns(self):
+        """
+        Files that should be checked again
+        """
+        for fn in list(self.waiting.keys()):
+            if not os.path.exists(fn):
+                del self.waiting[fn]
+        return list(self.waiting.keys())
+
+    def time_left(self):
+        """
+        Seconds until the next waiting file could be ready
+        None if nothing is waiting
+        """
+        if not self.waiting:
+            return None
+        now = time.time()
+        return max(
+            0.0,
+            min([
+                mtime + self.stable_time - now
+                for _size, mtime in self.waiting.values()
+            ]))
+
+    def done(self, fn):
+        """
+        Upload has been consumed: remove the marker if there is one
+        """
+        marker_fn = self.marker_fn(fn)
+        if os.path.exists(marker_fn):
+            os.unlink(marker_fn)
+
 
 class VCMismatch(Exception):
     pass
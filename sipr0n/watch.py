@@ -0,0 +1,104 @@
+"""
+Event driven upload detection
+
+Uses inotify via watchdog (like autothumb) to queue files as soon as they are
+closed after writing. A slow full rescan is still done periodically by the
+caller so that nothing is lost if an event is dropped (ex: inotify queue
+overflow) or if watchdog isn't installed at all
+"""
+
+import os
+import queue
+import time
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+class UploadWatcher:
+    def __init__(self, root, rescan_interval=300.0, poll_interval=3.0):
+        self.root = os.path.realpath(root)
+        # How often to do a full glob even if events are flowing
+        self.rescan_interval = rescan_interval
+        # Used instead of events if watchdog isn't available
+        self.poll_interval = poll_interval
+        self.queue = queue.Queue()
+        self.observer = None
+        self.last_rescan = time.time()
+
+    def start(self):
+        if Observer is None:
+            print("WARNING: watchdog not installed, falling back to polling")
+            return False
+        try:
+            observer = Observer()
+            observer.schedule(self, self.root, recursive=True)
+            observer.start()
+        except OSError as e:
+            # OSError: inotify watch limit reached
+            print("WARNING: failed to start watcher, falling back to polling: %s" % (e, ))
+            return False
+        self.observer = observer
+        print("Watching %s" % (self.root, ))
+        return True
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def dispatch(self, event):
+        """
+        watchdog event handler interface
+        Called from the observer thread
+        """
+        if event.is_directory:
+            return
+        if event.event_type == "closed":
+            fn = event.src_path
+        # Ex: upload written to a temp file and then renamed into place
+        elif event.event_type == "moved":
+            fn = event.dest_path
+        else:
+            return
+        if type(fn) is bytes:
+            fn = os.fsdecode(fn)
+        self.queue.put(os.path.realpath(fn))
+
+    def rescan_due(self):
+        return time.time() - self.last_rescan >= self.rescan_interval
+
+    def wait(self, max_wait=None):
+        """
+        Block until there is something to do
+        Return None if a full rescan should be done
+        Otherwise return a (possibly empty) list of changed file names
+        """
+        if not self.observer:
+            time.sleep(self.poll_interval)
+            self.last_rescan = time.time()
+            return None
+
+        timeout = self.rescan_interval - (time.time() - self.last_rescan)
+        if max_wait is not None:
+            timeout = min(timeout, max_wait)
+        fns = []
+        if timeout > 0:
+            try:
+                fns.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+        # Coalesce anything else that is already waiting
+        while True:
+            try:
+                fns.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if self.rescan_due():
+            self.last_rescan = time.time()
+            return None
+        # Dedupe while preserving order
+        return list(dict.fromkeys(fns))
@@ -2,9 +2,31 @@
 
 import unittest
 import os
+import sys
+import struct
 import shutil
+import glob
+import lzma
+import zipfile
+import json
 import sipager
 import simapper
+from sipr0n import jobdb
+from sipr0n.util import UploadGate
+from sipr0n import place
+from sipr0n import hashdb
+from sipr0n import maptree
+from sipr0n import simap
+from sipr0n import manifestdb
+from sipr0n import probe
+from sipr0n import env
+from sipr0n import metadata
+from sipr0n import reindex
+from sipr0n import htmlmeta
+from sipr0n import thumbs
+import img2doku
+import imgs2doku
+import auser_copyright_map
 
 
 def rm_f(fn):
@@ -26,6 +48,15 @@ def cp_r(src, dst):
     shutil.copytree(src, dst)
 
 
+def write_html(fn, j):
+    """
+    Minimal map index.html as pr0nmap writes it
+    """
+    with open(fn, "w") as f:
+        f.write("<html><script>\ninitViewer(" + json.dumps(j) +
+                ");\n</script></html>\n")
+
+
 def setup_wiki():
     os.makedirs("dev/map", exist_ok=True)
     os.makedirs("dev/archive/data/media", exist_ok=True)
@@ -42,6 +73,71 @@ def cleanup():
     rm_rf("dev")
 
 
+def guess_collection_old(person_cc, copyright_db):
+    """
+    auser_copyright_map.guess_collection() before the alias table
+    """
+    person_cc = person_cc.split(",")[0].split("CC")[0].lower()
+    if person_cc == "FIXME" or not person_cc or person_cc == "None" or person_cc == "none":
+        return None
+    for this_collection, cstr in copyright_db.items():
+        this_collection = this_collection.lower()
+        cstr = cstr.lower()
+        cstr = cstr.split(",")[0].split("CC")[0]
+        if person_cc == cstr:
+            return this_collection
+
+    if "travis" in person_cc:
+        return "goodspeed"
+    if "texplained" in person_cc:
+        return "texplained"
+    if "digshadow" in person_cc:
+        return "mcmaster"
+    if "caps0ff" in person_cc:
+        return "caps0ff"
+    if "gerlinsky" in person_cc:
+        return "gerlinsky"
+    if "nats" in person_cc:
+        return "nats"
+    if "furrtek" in person_cc:
+        return "furrtek"
+    if "whitequark" in person_cc:
+        return "whitequark"
+    if "shirriff" in person_cc:
+        return "shirriff"
+    if "lempinen" in person_cc:
+        return "lempinen"
+    if "riddle" in person_cc:
+        return "sean"
+    if "decap" in person_cc:
+        return "drdecap"
+    if "nico" in person_cc:
+        return "nico"
+    if "ogoun" in person_cc:
+        return "ogun"
+    return None
+
+
+def load_autothumb():
+    """
+    autothumb/main.py isn't a package and wants a map dir in the cwd
+    """
+    import importlib.util
+    cwd = os.getcwd()
+    os.chdir("dev")
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "autothumb_main", os.path.join(cwd, "autothumb/main.py"))
+        ret = importlib.util.module_from_spec(spec)
+        # So pool workers can unpickle its functions
+        sys.modules[spec.name] = ret
+        spec.loader.exec_module(ret)
+    finally:
+        os.chdir(cwd)
+    ret.MAP_DIR = "dev/map"
+    return ret
+
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         """Call before every test case."""
@@ -129,6 +225,85 @@ class TestCase(unittest.TestCase):
         assert os.path.exists(
             "./dev/archive/data/pages/mcmaster/signetics/25120.txt")
 
+    def test_sipager_extract_archives(self):
+        """
+        tar and zip members are streamed out and the archive consumed
+        """
+        sipager.upload_gate = UploadGate(stable_time=0.0)
+        scrape_dir = "dev/uploadtmp/sipager"
+        cp("test/sipager/mcmaster_signetics_25120.tar", scrape_dir)
+        with zipfile.ZipFile(scrape_dir + "/mcmaster_signetics_25121.zip",
+                             "w") as zf:
+            zf.write("test/sipager/mcmaster_signetics_25120_die.jpg",
+                     "mcmaster_signetics_25121_die.jpg")
+        sipager.extract_archives(scrape_dir, assume_user=None)
+        assert sorted(os.listdir(scrape_dir)) == [
+            "mcmaster",
+            "mcmaster_signetics_25120_die.jpg",
+            "mcmaster_signetics_25120_misc.jpg",
+            "mcmaster_signetics_25120_pack_btm.jpg",
+            "mcmaster_signetics_25120_pack_top.jpg",
+            "mcmaster_signetics_25121_die.jpg",
+        ]
+
+    def test_sipager_extract_corrupt(self):
+        """
+        A corrupt archive leaves no partial members behind and is kept
+        """
+        sipager.upload_gate = UploadGate(stable_time=0.0)
+        scrape_dir = "dev/uploadtmp/sipager"
+        with open("test/sipager/mcmaster_signetics_25120.tar", "rb") as f:
+            data = bytearray(lzma.compress(f.read()))
+        # Past the first member's data
+        for i in range(len(data) // 2, len(data) // 2 + 64):
+            data[i] ^= 0xFF
+        archive_fn = scrape_dir + "/mcmaster_signetics_25120.tar.xz"
+        with open(archive_fn, "wb") as f:
+            f.write(data)
+        sipager.extract_archives(scrape_dir, assume_user=None)
+        assert glob.glob(scrape_dir + "/*.jpg") == []
+        assert os.path.exists(archive_fn)
+
+        # Disk filling up part way through a member
+        archive_fn = scrape_dir + "/mcmaster_signetics_25120.tar"
+        cp("test/sipager/mcmaster_signetics_25120.tar", archive_fn)
+        copy_member = sipager.copy_member
+
+        def copy_member_full(fin, fn_out, budget):
+            if glob.glob(scrape_dir + "/*.jpg"):
+                with open(fn_out, "wb") as f:
+                    f.write(fin.read(100))
+                raise OSError(28, "No space left on device")
+            return copy_member(fin, fn_out, budget)
+
+        sipager.copy_member = copy_member_full
+        try:
+            sipager.extract_archives(scrape_dir, assume_user=None)
+        finally:
+            sipager.copy_member = copy_member
+        assert glob.glob(scrape_dir + "/*.jpg") == []
+        assert os.path.exists(archive_fn)
+
+    def test_sipager_page_failure(self):
+        """
+        Upload is kept for a retry if the page can't be written
+        """
+        fn = "dev/uploadtmp/sipager/mcmaster_signetics_25120_die.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        run = img2doku.run
+
+        def run_fail(*args, **kwargs):
+            raise Exception("page generation failed")
+
+        img2doku.run = run_fail
+        try:
+            sipager.run(dev=True, once=True, verbose=self.verbose)
+        except Exception:
+            pass
+        finally:
+            img2doku.run = run
+        assert os.path.exists(fn)
+
     def test_simapper_user(self):
         shutil.copy("test/sipager/mcmaster_signetics_25120_die.jpg",
                     "dev/uploadtmp/simapper/mcmaster/signetics_25120_mz3.jpg")
@@ -154,6 +329,899 @@ class TestCase(unittest.TestCase):
         simapper.run(dev=True, once=True, verbose=self.verbose)
         assert os.path.exists("./dev/map/signetics/25120/mz/index.html")
 
+    def test_jobdb(self):
+        """
+        Job state should survive reopening the database
+        """
+        db = jobdb.JobDB("dev/lib/test.sqlite")
+        db.add("dev/a.jpg", user="mcmaster", mtime=1.0,
+               status=simapper.STATUS_PENDING)
+        db.add("dev/b.jpg", user="mcmaster", mtime=1.0,
+               status=simapper.STATUS_PENDING)
+        db.update("dev/b.jpg",
+                  status=simapper.STATUS_ERROR,
+                  stage=jobdb.STAGE_PLACED)
+        db.close()
+
+        db = jobdb.JobDB("dev/lib/test.sqlite")
+        pending = db.with_status(simapper.STATUS_PENDING)
+        assert [job["fn"] for job in pending] == ["dev/a.jpg"]
+        assert db.get("dev/b.jpg")["stage"] == jobdb.STAGE_PLACED
+        assert db.counts() == {
+            simapper.STATUS_PENDING: 1,
+            simapper.STATUS_ERROR: 1
+        }
+        db.close()
+
+    def test_jobdb_rejected(self):
+        """
+        Only rejected uploads that are still the exact same file are skipped
+        """
+        fn = "dev/uploadtmp/simapper/mcmaster/signetics_25120_mz.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        db = jobdb.JobDB("dev/lib/test.sqlite")
+        retry = (simapper.STATUS_PENDING, simapper.STATUS_DONE)
+        db.add(fn, user="mcmaster", mtime=os.path.getmtime(fn),
+               status=simapper.STATUS_COLLISION, ident=jobdb.file_ident(fn))
+        assert jobdb.rejected(db.get(fn), fn, retry)
+        # Consumed: same name and mtime is a new upload
+        db.update(fn, status=simapper.STATUS_DONE)
+        assert not jobdb.rejected(db.get(fn), fn, retry)
+        # Replaced w/ a new file
+        db.update(fn, status=simapper.STATUS_COLLISION)
+        st = os.stat(fn)
+        os.unlink(fn)
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert not jobdb.rejected(db.get(fn), fn, retry)
+        db.close()
+
+    def test_simapper_bad_name(self):
+        """
+        Badly named upload is marked as an error, not left pending
+        """
+        fn = "dev/uploadtmp/simapper/mcmaster/badname.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        try:
+            simapper.run(dev=True, once=True, verbose=self.verbose)
+        except Exception:
+            pass
+        db = jobdb.JobDB("dev/lib/simapper.sqlite")
+        assert db.counts() == {simapper.STATUS_ERROR: 1}
+        db.close()
+
+    def test_simapper_pool_chip_serialized(self):
+        """
+        Worker pool runs different chips at once but never the same chip
+        """
+        import threading
+        import time
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+        peak_total = [0]
+
+        def process_locked(entry):
+            k = entry["local_fn"].split("_")[1]
+            with lock:
+                active[k] = active.get(k, 0) + 1
+                peak[k] = max(peak.get(k, 0), active[k])
+                peak_total[0] = max(peak_total[0], sum(active.values()))
+            time.sleep(0.05)
+            with lock:
+                active[k] -= 1
+            entry["status"] = simapper.STATUS_DONE
+
+        orig = simapper.process_locked, simapper.job_db
+        simapper.process_locked = process_locked
+        simapper.job_db = None
+        pool = simapper.MapPool(workers=4)
+        try:
+            for chipid in ("25120", "2650"):
+                for flavor in ("a", "b", "c"):
+                    pool.submit({
+                        "local_fn": "signetics_%s_%s.jpg" % (chipid, flavor),
+                        "user": "mcmaster",
+                        "status": None,
+                    })
+            assert pool.reap(wait=True) == 6
+        finally:
+            pool.shutdown()
+            simapper.process_locked, simapper.job_db = orig
+        assert peak == {"25120": 1, "2650": 1}
+        assert peak_total[0] == 2
+
+    def test_simapper_duplicate(self):
+        """
+        Only an identical image that already has a map is a duplicate
+        """
+        src = "test/sipager/mcmaster_signetics_25120_die.jpg"
+        env.setup_env(dev=True)
+        os.makedirs("dev/archive/data/media/mcmaster/signetics/2650")
+        cp(src, "dev/archive/data/media/mcmaster/signetics/2650/die.jpg")
+        os.makedirs("dev/map/signetics/2650/single")
+        single_fn = "dev/map/signetics/2650/single/signetics_2650_mcmaster_mz.jpg"
+        cp(src, single_fn)
+        map_dir = os.path.realpath("dev/map/signetics/2650/mcmaster_mz")
+
+        def index():
+            db = hashdb.HashDB(env.HASH_DB)
+            try:
+                hashdb.update_index(db, env.MAP_DIR, env.ARCHIVE_WIKI_DIR)
+            finally:
+                db.close()
+
+        def upload_status():
+            upload = "dev/uploadtmp/simapper/mcmaster/signetics_25120_mz.jpg"
+            cp(src, upload)
+            try:
+                simapper.run(dev=True, once=True, verbose=self.verbose)
+            except Exception:
+                pass
+            db = jobdb.JobDB("dev/lib/simapper.sqlite")
+            try:
+                counts = db.counts()
+            finally:
+                db.close()
+            assert len(counts) == 1
+            return list(counts.keys())[0]
+
+        assert simapper.duplicate_map_dir(os.path.realpath(single_fn)) is None
+        assert simapper.duplicate_map_dir(
+            os.path.realpath(
+                "dev/archive/data/media/mcmaster/signetics/2650/die.jpg")) is None
+        index()
+        # Wiki photo and an unmapped single: go ahead and map it
+        assert upload_status() != simapper.STATUS_DUPLICATE
+
+        rm_rf("dev/map/signetics/25120")
+        rm_rf("dev/lib/simapper.sqlite")
+        os.makedirs(map_dir)
+        assert simapper.duplicate_map_dir(
+            os.path.realpath(single_fn)) == map_dir
+        assert upload_status() == simapper.STATUS_DUPLICATE
+
+    def test_upload_gate(self):
+        """
+        Fresh uploads should wait unless marked done
+        """
+        fn = "dev/uploadtmp/simapper/mcmaster/signetics_25120_mz.jpg"
+        shutil.copy("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        gate = UploadGate(stable_time=60.0)
+        assert not gate.ready(fn)
+        assert gate.waiting_fns() == [fn]
+        assert gate.time_left() > 0
+        open(fn + ".done", "w").close()
+        assert gate.ready(fn)
+        assert gate.waiting_fns() == []
+        gate.done(fn)
+        assert not os.path.exists(fn + ".done")
+
+    def test_place_file(self):
+        """
+        Same filesystem placement shouldn't need a copy
+        """
+        src = "dev/uploadtmp/simapper/mcmaster/signetics_25120_mz.jpg"
+        shutil.copy("test/sipager/mcmaster_signetics_25120_die.jpg", src)
+        data = open(src, "rb").read()
+
+        dst = "dev/map/a.jpg"
+        assert place.place_file(src, dst) == place.METHOD_HARDLINK
+        assert os.path.exists(src)
+        assert open(dst, "rb").read() == data
+
+        dst = "dev/map/b.jpg"
+        assert place.place_file(src, dst, move=True) == place.METHOD_RENAME
+        assert not os.path.exists(src)
+        assert open(dst, "rb").read() == data
+
+    def test_hashdb(self):
+        """
+        Identical files are found by content
+        """
+        db = hashdb.HashDB("dev/lib/hash.sqlite")
+        try:
+            src = "test/sipager/mcmaster_signetics_25120_die.jpg"
+            shutil.copy(src, "dev/map/a.jpg")
+            shutil.copy(src, "dev/map/b.jpg")
+            a = os.path.realpath("dev/map/a.jpg")
+            digest = db.hash(a)
+            assert digest == hashdb.hash_file(src)
+            assert db.cached(a) == digest
+            assert db.find(digest) == [a]
+            assert db.find(hashdb.hash_file("dev/map/b.jpg"), exclude=a) == []
+            os.unlink(a)
+            assert db.find(digest) == []
+        finally:
+            db.close()
+
+    def test_maptree(self):
+        """
+        Map tree index picks up maps and only rereads what changed
+        """
+        map_dir = "dev/map/signetics/25120/mcmaster_mz"
+        j = {
+            "layers": [{
+                "width": 150,
+                "height": 100,
+                "tileSize": 250,
+                "URL": "l1",
+            }],
+            "name": "signetics_25120_mcmaster_mz",
+        }
+        os.makedirs(map_dir)
+        write_html(map_dir + "/index.html", j)
+        os.makedirs("dev/map/signetics/25120/single")
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg",
+           "dev/map/signetics/25120/single/signetics_25120_mcmaster_mz.jpg")
+        cache_fn = "dev/lib/maptree.json"
+
+        tree = maptree.load("dev/map", cache_fn=cache_fn)
+        maps = maptree.maps(tree)
+        assert len(maps) == 1
+        chip, mapj = maps[0]
+        assert (chip["vendor"], chip["chipid"]) == ("signetics", "25120")
+        assert mapj["collection"] == "mcmaster"
+        assert mapj["flavor"] == "mz"
+        assert mapj["meta"] == j
+        assert [x["basename"] for x in chip["singles"]
+                ] == ["signetics_25120_mcmaster_mz.jpg"]
+
+        # Cached entry is reused as is
+        mapj["meta"] = "cached"
+        maptree.save_cache(cache_fn, tree)
+        tree = maptree.load("dev/map", cache_fn=cache_fn)
+        assert maptree.maps(tree)[0][1]["meta"] == "cached"
+
+        # Rewritten index.html is reread
+        write_html(map_dir + "/index.html", j)
+        os.utime(map_dir + "/index.html", (0, 0))
+        tree = maptree.load("dev/map", cache_fn=cache_fn)
+        assert maptree.maps(tree)[0][1]["meta"] == j
+
+    def test_simap_manifest(self):
+        """
+        Journaled manifest entries are visible before and after compaction
+        """
+        chipid_dir = "dev/map/signetics/25120"
+        os.makedirs(chipid_dir)
+        simap.map_manifest_add_file(chipid_dir, "single/a.jpg", "mcmaster",
+                                    "image", 2020)
+        # First entry creates .manifest right away
+        assert os.path.exists(chipid_dir + "/.manifest")
+        simap.map_manifest_add_file(chipid_dir, "mcmaster_mz", "mcmaster",
+                                    "map", 2020)
+        simap.map_manifest_add_file(chipid_dir, "single/a.jpg", "unknown",
+                                    "image", 2021)
+        expect = {
+            "files": {
+                "single/a.jpg": {
+                    "collection": "unknown",
+                    "type": "image",
+                    "copyright_year": 2021,
+                },
+                "mcmaster_mz": {
+                    "collection": "mcmaster",
+                    "type": "map",
+                    "copyright_year": 2020,
+                },
+            }
+        }
+        assert simap.map_manifest_load(chipid_dir) == expect
+        simap.map_manifest_compact(chipid_dir)
+        assert os.path.getsize(chipid_dir + "/.manifest.journal") == 0
+        assert simap.map_manifest_load(chipid_dir) == expect
+
+    def test_manifestdb(self):
+        """
+        Manifest index follows manifest changes
+        """
+        chipid_dir = "dev/map/signetics/25120"
+        os.makedirs(chipid_dir)
+        simap.map_manifest_add_file(chipid_dir, "single/a.jpg", "mcmaster",
+                                    "image", 2020)
+        simap.map_manifest_add_file(chipid_dir, "mcmaster_mz", "mcmaster",
+                                    "map", 2021)
+        db = manifestdb.ManifestDB("dev/lib/manifest.sqlite")
+        try:
+            manifestdb.update_index(db, "dev/map")
+            rows = db.query(collection="mcmaster", type_="map")
+            assert [(r["chipid"], r["fn"]) for r in rows
+                    ] == [("25120", "mcmaster_mz")]
+            assert len(db.query(year=2020)) == 1
+
+            # Journaled entry is picked up
+            simap.map_manifest_add_file(chipid_dir, "mcmaster_mz", "unknown",
+                                        "map", 2021)
+            manifestdb.update_index(db, "dev/map")
+            assert db.query(collection="mcmaster", type_="map") == []
+
+            shutil.rmtree(chipid_dir)
+            manifestdb.update_index(db, "dev/map")
+            assert db.query() == []
+        finally:
+            db.close()
+
+    def test_probe(self):
+        """
+        Dimensions come from the header of each parsed format
+        """
+        from PIL import Image
+        img = Image.new("RGB", (37, 19))
+        for ext, kwargs, format_ in (
+            ("jpg", {}, "JPEG"),
+            ("png", {}, "PNG"),
+            ("tif", {}, "TIFF"),
+            ("big.tif", {"big_tiff": True}, "TIFF"),
+        ):
+            fn = "dev/probe." + ext
+            img.save(fn, **kwargs)
+            info = probe.probe(fn)
+            assert info == {
+                "format": format_,
+                "width": 37,
+                "height": 19,
+                "size": os.path.getsize(fn),
+            }, (fn, info)
+        assert open("dev/probe.big.tif", "rb").read(4) == b"II+\x00"
+
+        # Real upload, progressive or not
+        info = probe.probe("test/sipager/mcmaster_signetics_25120_die.jpg")
+        src = Image.open("test/sipager/mcmaster_signetics_25120_die.jpg")
+        assert (info["width"], info["height"]) == src.size
+        assert probe.format_wh(info) == "%ux%u" % src.size
+
+    def test_probe_bad(self):
+        """
+        Truncated headers are rejected, unknown formats go to identify
+        """
+        from PIL import Image
+        Image.new("RGB", (37, 19)).save("dev/probe.jpg")
+        with open("dev/probe.jpg", "rb") as f:
+            data = f.read()
+        with open("dev/truncated.jpg", "wb") as f:
+            f.write(data[:20])
+        with self.assertRaises(probe.ProbeError):
+            probe.probe("dev/truncated.jpg")
+
+        with open("dev/page.jpg", "w") as f:
+            f.write("<html><body>Not found</body></html>\n")
+        Image.new("RGB", (37, 19)).save("dev/probe.gif")
+
+        identified = []
+
+        def probe_identify(fn):
+            identified.append(fn)
+            if fn.endswith(".gif"):
+                return "GIF", (37, 19)
+            raise probe.ProbeError("identify failed: " + fn)
+
+        orig = probe.probe_identify
+        probe.probe_identify = probe_identify
+        try:
+            with self.assertRaises(probe.ProbeError):
+                probe.probe("dev/page.jpg")
+            info = probe.probe("dev/probe.gif")
+        finally:
+            probe.probe_identify = orig
+        assert identified == ["dev/page.jpg", "dev/probe.gif"]
+        assert (info["format"], info["width"], info["height"]) == ("GIF", 37,
+                                                                   19)
+
+    def test_probe_format_size(self):
+        """
+        Matches identify's file size column
+        """
+        assert probe.format_size(313940) == "313940B"
+        assert probe.format_size(999999) == "999999B"
+        assert probe.format_size(1000000) == "1MB"
+        assert probe.format_size(12345678) == "12.3457MB"
+        assert probe.format_size(2500000000) == "2.5GB"
+
+    def test_autothumb_seed_manifest(self):
+        """
+        Thumbnails from before manifests existed are adopted, not redone
+        """
+        from PIL import Image
+        from sipr0n import thumbs
+        autothumb = load_autothumb()
+        os.makedirs("dev/map/signetics/25120/single")
+        fn = "dev/map/signetics/25120/single/signetics_25120_mcmaster_mz.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        mtime = os.path.getmtime(fn)
+        Image.new("RGB", (300, 194)).save(thumbs.legacy_fn(fn))
+        Image.new("RGB", (150, 97)).save(thumbs.variant_fn(fn, 150, "webp"))
+        # Made from an older upload
+        Image.new("RGB", (600, 388)).save(thumbs.variant_fn(fn, 600, "jpg"))
+        os.utime(thumbs.legacy_fn(fn), (mtime + 10, mtime + 10))
+        os.utime(thumbs.variant_fn(fn, 150, "webp"), (mtime, mtime))
+        os.utime(thumbs.variant_fn(fn, 600, "jpg"), (mtime - 10, mtime - 10))
+
+        autothumb.thumb(fn)
+        j = thumbs.read_manifest(fn)
+        assert [(v["fn"], v["width"], v["height"]) for v in j["variants"]] == [
+            ("signetics_25120_mcmaster_mz.thumb150.webp", 150, 97)
+        ]
+        assert os.path.getmtime(thumbs.legacy_fn(fn)) == mtime + 10
+        assert not os.path.exists(thumbs.variant_fn(fn, 300, "jpg"))
+
+        # Legacy thumbnail older than the image: start over
+        os.unlink(thumbs.manifest_fn(fn))
+        os.utime(thumbs.legacy_fn(fn), (mtime - 10, mtime - 10))
+        autothumb.thumb(fn)
+        j = thumbs.read_manifest(fn)
+        assert len(j["variants"]) == len(autothumb.THUMB_SIZES) * len(
+            autothumb.THUMB_FORMATS)
+        assert os.path.getmtime(thumbs.legacy_fn(fn)) >= mtime
+
+    def test_copyright_cache(self):
+        """
+        Parsed copyright.txt is reused until the file changes
+        """
+        env.setup_env(dev=True)
+        fn = env.COPYRIGHT_TXT
+        assert metadata.default_copyright(
+            "mcmaster") == "John McMaster, CC-BY"
+        db = metadata.copyright_db()
+        assert metadata.copyright_db() is db
+        with self.assertRaises(metadata.CollectionNotFound):
+            metadata.assert_collection_exists("newuser")
+
+        # user_add.py appends
+        with open(fn, "a") as f:
+            f.write("| newuser    | New User, CC-BY                          |       |\n")
+        metadata.assert_collection_exists("newuser")
+        assert metadata.copyright_names()["new user"] == "newuser"
+
+        # Same size edit, only the mtime changes
+        st = os.stat(fn)
+        with open(fn, "r") as f:
+            txt = f.read()
+        with open(fn, "w") as f:
+            f.write(txt.replace("New User, CC-BY", "New User, CC-0 "))
+        os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        assert os.path.getsize(fn) == st.st_size
+        assert metadata.default_copyright("newuser") == "New User, CC-0"
+
+        # Listed twice: last entry wins, same as load_copyright_db() always did
+        with open(fn, "a") as f:
+            f.write("| mcmaster   | J. McMaster, CC0                         |       |\n")
+        assert metadata.default_copyright("mcmaster") == "J. McMaster, CC0"
+        assert metadata.load_copyright_db()["mcmaster"] == "J. McMaster, CC0"
+        assert list(metadata.load_copyright_db().keys()) == [
+            "mcmaster", "anonymous", "newuser"
+        ]
+
+    def test_guess_collection(self):
+        """
+        Alias regex picks the same collection as the old if chain
+        """
+        import random
+        db = {
+            "mcmaster": "John McMaster, CC-BY",
+            "Goodspeed": "Travis Goodspeed, CC0",
+            "nico": "nico <xxx@xxx.net>, CC BY 3.0",
+            "marchcat": "FIXME",
+            "dup": "John McMaster, CC0",
+        }
+        names = [
+            "John McMaster, CC-BY", "travis goodspeed", "nico <xxx@xxx.net>",
+            "FIXME", "None", "", "Sean Riddle", "nicotravis", "riddle decap",
+            "ogounats", "Digshadow CC BY", "texplainedcaps0ff", "nobody",
+            "Ken Shirriff, CC BY 4.0", "Dr. Decap",
+        ]
+        aliases = [
+            alias for alias, _collection in auser_copyright_map.COLLECTION_ALIASES
+        ]
+        fragments = aliases + [
+            a[:3] for a in aliases
+        ] + [a[2:] for a in aliases] + [" ", ",", "CC", "x"]
+        r = random.Random(0)
+        for _i in range(2000):
+            names.append("".join(
+                r.choice(fragments) for _j in range(r.randint(1, 5))))
+        index = metadata.index_copyright_names(db)
+        for name in names:
+            assert auser_copyright_map.guess_collection(
+                name, index) == guess_collection_old(name, db), name
+
+        # Default is the cached index, not rebuilt per call
+        env.setup_env(dev=True)
+        metadata.copyright_names()
+
+        def index_copyright_names(db):
+            raise Exception("rebuilt copyright name index")
+
+        orig = metadata.index_copyright_names
+        metadata.index_copyright_names = index_copyright_names
+        try:
+            for _i in range(3):
+                assert auser_copyright_map.guess_collection(
+                    "John McMaster, CC-BY") == "mcmaster"
+        finally:
+            metadata.index_copyright_names = orig
+
+    def test_scrape_travis_resume(self):
+        """
+        Converted images are logged and skipped by the next run
+        """
+        from scraper import scrape_travis
+        completed_fn = "dev/completed.jsonl"
+        os.makedirs("dev/travis_in/ti/msp430/mz")
+        os.makedirs("dev/single")
+        images = [
+            "dev/travis_in/ti/msp430/mz/good.tif",
+            "dev/travis_in/ti/msp430/mz/bad.tif",
+        ]
+        for fn in images:
+            with open(fn, "w") as f:
+                f.write(fn)
+        parsed = {
+            "ti/msp430/mz/good.tif": {
+                "src_image": "ti/msp430/mz/good.tif",
+                "single_fn": "ti_msp430_mz.jpg",
+            },
+            "ti/msp430/mz/bad.tif": {
+                "src_image": "ti/msp430/mz/bad.tif",
+                "single_fn": "ti_msp430_mz-bad.jpg",
+            },
+        }
+
+        failing = set(["dev/travis_in/ti/msp430/mz/bad.tif"])
+
+        def copy_image(src_fn, dst_fn):
+            # No convert needed
+            if src_fn in failing:
+                raise Exception("convert failed")
+            shutil.copy(src_fn, dst_fn)
+
+        orig = scrape_travis.copy_image
+        scrape_travis.copy_image = copy_image
+        try:
+            noks = scrape_travis.copy_images(parsed,
+                                             "dev/travis_in",
+                                             "dev/single",
+                                             completed_fn=completed_fn)
+            assert list(noks.keys()) == ["ti/msp430/mz/bad.tif"]
+            assert os.path.exists("dev/single/ti_msp430_mz.jpg")
+
+            # Interrupted mid write
+            with open(completed_fn, "a") as f:
+                f.write('{"src_image": "ti/msp')
+            completed = scrape_travis.load_completed_db(completed_fn)
+            assert completed == set(["ti/msp430/mz/good.tif"])
+
+            parsed2, _noks = scrape_travis.parse_images(
+                "dev/travis_in", images, completed)
+            assert list(parsed2.keys()) == ["ti/msp430/mz/bad.tif"]
+
+            # Retry is logged on its own line after the partial one
+            failing.clear()
+            noks = scrape_travis.copy_images(parsed2,
+                                             "dev/travis_in",
+                                             "dev/single",
+                                             completed_fn=completed_fn)
+            assert noks == {}
+        finally:
+            scrape_travis.copy_image = orig
+        assert scrape_travis.load_completed_db(completed_fn) == set(
+            ["ti/msp430/mz/good.tif", "ti/msp430/mz/bad.tif"])
+        assert scrape_travis.load_completed_db("dev/nonexistent.jsonl") == set()
+
+    def test_reindex(self):
+        """
+        Page writes within the debounce window are indexed in one go
+        """
+        wiki_dir = "dev/archive"
+        assert reindex.page_fn_to_id(
+            wiki_dir, wiki_dir +
+            "/data/pages/tool/simapper/mcmaster.txt") == "tool:simapper:mcmaster"
+        with self.assertRaises(ValueError):
+            reindex.page_fn_to_id(wiki_dir, "dev/map/x.txt")
+
+        r = reindex.Reindexer(wiki_dir, debounce=3600, dev=True)
+        assert r.time_left() is None
+        assert not r.flush_if_due()
+        r.add_page_fn(wiki_dir + "/data/pages/mcmaster/signetics/25120.txt")
+        r.add("mcmaster:signetics:25120")
+        r.add("anonymous:atmel:x1")
+        assert 3500 < r.time_left() <= 3600
+        assert not r.flush_if_due()
+        r.first_change -= 3600
+        assert r.time_left() == 0
+        assert r.flush_if_due()
+        assert r.time_left() is None
+        assert not r.flush()
+
+        # Failed index is kept for the next flush
+        r = reindex.Reindexer(wiki_dir, debounce=0)
+        r.add("mcmaster:signetics:25120")
+        with self.assertRaises(Exception):
+            r.flush()
+        assert r.page_ids == set(["mcmaster:signetics:25120"])
+
+    def test_htmlmeta(self):
+        """
+        initViewer metadata is found in the prefix or past it
+        """
+        j = {"layers": [{"width": 30811, "height": 30989}], "name": "x"}
+        line = "initViewer(" + json.dumps(j) + ");\n"
+        with open("dev/map/prefix.html", "w") as f:
+            f.write("<html><script>\n" + line + "</script></html>\n")
+        with open("dev/map/far.html", "w") as f:
+            f.write("<html>\n" + " " * htmlmeta.PREFIX_BYTES + "\n" + line)
+        with open("dev/map/custom.html", "w") as f:
+            f.write("<html>new SiProjection()</html>\n")
+        with open("dev/map/custom_far.html", "w") as f:
+            f.write(" " * htmlmeta.PREFIX_BYTES + "\nnew SiProjection()\n")
+        with open("dev/map/none.html", "w") as f:
+            f.write("<html></html>\n")
+
+        assert htmlmeta.extract("dev/map/prefix.html") == j
+        assert htmlmeta.extract("dev/map/far.html") == j
+        assert htmlmeta.extract("dev/map/far.html", cache_=False) == j
+        for fn in ("dev/map/custom.html", "dev/map/custom_far.html"):
+            with self.assertRaises(htmlmeta.CustomPage):
+                htmlmeta.extract(fn)
+        with self.assertRaises(ValueError):
+            htmlmeta.extract("dev/map/none.html")
+
+        # Cached copy isn't shared w/ callers
+        htmlmeta.extract("dev/map/prefix.html")["layers"][0]["width"] = 1
+        assert htmlmeta.extract("dev/map/prefix.html") == j
+
+    def test_autothumb_gallery_index(self):
+        """
+        Newest thumbnails are tracked w/o rescanning on every change
+        """
+        autothumb = load_autothumb()
+        single_dir = "dev/map/signetics/25120/single"
+        os.makedirs(single_dir)
+        n = autothumb.GalleryIndex.CAPACITY + 5
+        fns = []
+        for i in range(n):
+            fn = single_dir + "/signetics_25120_mcmaster_f%02u.thumb.jpg" % i
+            open(fn, "w").close()
+            os.utime(fn, (1000 + i, 1000 + i))
+            fns.append(fn)
+
+        index = autothumb.GalleryIndex()
+        index.seed()
+        assert len(index.mtimes) == autothumb.GalleryIndex.CAPACITY
+        newest = fns[::-1][:autothumb.GALLERY_IMAGES]
+        assert index.newest() == newest
+
+        # Older than everything tracked while full
+        assert not index.add(fns[0])
+        # Unchanged
+        assert not index.add(fns[-1])
+        fn = single_dir + "/signetics_25120_mcmaster_new.thumb.jpg"
+        open(fn, "w").close()
+        os.utime(fn, (5000, 5000))
+        assert index.add(fn)
+        assert index.newest()[0] == fn
+        assert len(index.mtimes) == autothumb.GalleryIndex.CAPACITY
+
+        assert index.remove(fn)
+        assert not index.remove(fn)
+        assert index.newest() == newest
+
+        # Too few left: falls back to a rescan
+        os.unlink(fn)
+        for fn in fns[5:]:
+            os.unlink(fn)
+            index.remove(fn)
+        assert index.newest() == fns[4::-1]
+
+    def test_autothumb_manual_pool(self):
+        """
+        Manual mode thumbnails on worker processes and survives bad images
+        """
+        autothumb = load_autothumb()
+        single_dir = "dev/map/signetics/25120/single"
+        os.makedirs(single_dir)
+        good = []
+        for flavor in ("mz", "pol"):
+            fn = single_dir + "/signetics_25120_mcmaster_%s.jpg" % flavor
+            cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+            os.makedirs("dev/map/signetics/25120/mcmaster_" + flavor)
+            good.append(fn)
+        # Header probes fine but PIL can't decode it: TIFF w/o strips
+        bad = single_dir + "/signetics_25120_mcmaster_bad.jpg"
+        with open(bad, "wb") as f:
+            f.write(b"II*\x00" + struct.pack("<IH", 8, 2) +
+                    struct.pack("<HHII", 256, 3, 1, 37) +
+                    struct.pack("<HHII", 257, 3, 1, 19) + struct.pack("<I", 0))
+
+        assert autothumb.thumb_worker(good[0], False) is None
+        assert autothumb.thumb_worker(bad, False)
+
+        orig = autothumb.JOBS, autothumb.THUMBFILELIST
+        autothumb.JOBS = 2
+        autothumb.THUMBFILELIST = "dev/gallery.txt"
+        try:
+            autothumb.mode_manual()
+        finally:
+            autothumb.JOBS, autothumb.THUMBFILELIST = orig
+        for fn in good:
+            assert os.path.exists(thumbs.legacy_fn(fn))
+            assert thumbs.read_manifest(fn)
+        assert not os.path.exists(thumbs.manifest_fn(bad))
+        with open("dev/gallery.txt") as f:
+            assert len(f.read().split("\n")) == 2
+
+    def test_autothumb_draft(self):
+        """
+        Large JPEGs are decoded at a reduced scale, still above thumbnail size
+        """
+        from PIL import Image
+        autothumb = load_autothumb()
+        need = autothumb.source_size()
+        Image.new("RGB", (need * 5, need * 3)).save("dev/big.jpg")
+        Image.new("RGB", (need * 5, need * 3)).save("dev/big.png")
+
+        img = autothumb.open_thumb_source("dev/big.jpg")
+        img.load()
+        assert img.size[0] < need * 5
+        assert min(img.size) >= need
+        assert abs(img.size[0] * 3 - img.size[1] * 5) <= 5
+
+        img = autothumb.open_thumb_source("dev/big.png")
+        assert img.size == (need * 5, need * 3)
+
+    def test_autothumb_batch(self):
+        """
+        Watch events are coalesced and gallery.txt is written once per batch
+        """
+        import concurrent.futures
+        autothumb = load_autothumb()
+        single_dir = "dev/map/signetics/25120/single"
+        os.makedirs(single_dir)
+        fns = []
+        for flavor in ("mz", "pol"):
+            fn = single_dir + "/signetics_25120_mcmaster_%s.jpg" % flavor
+            cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+            os.makedirs("dev/map/signetics/25120/mcmaster_" + flavor)
+            fns.append(fn)
+
+        class Event:
+            def __init__(self, event_type, src_path, dest_path=None):
+                self.is_directory = False
+                self.event_type = event_type
+                self.src_path = src_path
+                self.dest_path = dest_path
+
+        tmp_fn = single_dir + "/.tmp_signetics_25120_mcmaster_pol.jpg"
+        for event in (
+                Event("created", fns[0]),
+                Event("modified", fns[0]),
+                # Tiles aren't interesting
+                Event("created", "dev/map/signetics/25120/mcmaster_mz/l1_0_0.jpg"),
+                Event("created", tmp_fn),
+                Event("moved", tmp_fn, fns[1]),
+                Event("created", fns[0]),
+        ):
+            autothumb.event_handler.dispatch(event)
+
+        orig = autothumb.BATCH_WINDOW, autothumb.write_gallery
+        writes = []
+        autothumb.BATCH_WINDOW = 0.1
+        autothumb.write_gallery = lambda thumbpaths: writes.append(thumbpaths)
+        try:
+            batch = autothumb.collect_batch()
+            assert batch == {
+                fns[0]: "created",
+                tmp_fn: "deleted",
+                fns[1]: "created",
+            }
+            assert autothumb.event_queue.empty()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+                autothumb.process_batch(pool, batch)
+        finally:
+            autothumb.BATCH_WINDOW, autothumb.write_gallery = orig
+        assert len(writes) == 1
+        assert sorted(writes[0]) == [thumbs.legacy_fn(fn) for fn in fns]
+        for fn in fns:
+            assert thumbs.read_manifest(fn)
+
+    def test_scrape_travis_sig_images(self):
+        """
+        Signatures are sha1sums, computed once per unchanged file
+        """
+        import hashlib
+        from collections import OrderedDict
+        from scraper import scrape_travis
+        os.makedirs("dev/travis_in/ti/msp430/mz")
+        parsed = OrderedDict()
+        for i in range(6):
+            rel = "ti/msp430/mz/%u.tif" % i
+            with open("dev/travis_in/" + rel, "w") as f:
+                f.write("image %u" % i)
+            parsed[rel] = {"src_image": rel}
+
+        db = hashdb.HashDB("dev/lib/hash.sqlite")
+        try:
+            scrape_travis.sig_images(parsed, "dev/travis_in", db, threads=3)
+            for rel, entry in parsed.items():
+                with open("dev/travis_in/" + rel, "rb") as f:
+                    assert entry["sha1sum"] == hashlib.sha1(
+                        f.read()).hexdigest()
+
+            # Rerun hits the cache
+            def hash_file(fn, algo=hashdb.HASH_ALGO):
+                raise Exception("rehashed " + fn)
+
+            orig = hashdb.hash_file
+            hashdb.hash_file = hash_file
+            try:
+                again = OrderedDict([(rel, {"src_image": rel})
+                                     for rel in parsed.keys()])
+                scrape_travis.sig_images(again, "dev/travis_in", db)
+            finally:
+                hashdb.hash_file = orig
+            assert again == parsed
+        finally:
+            db.close()
+
+    def test_img2doku_process_fns_thumbs(self):
+        """
+        autothumb's thumbnails aren't mistaken for map images
+        """
+        single_dir = "dev/map/signetics/25120/single"
+        os.makedirs(single_dir)
+        fn = single_dir + "/signetics_25120_mcmaster_mz.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        for size in (None, 150, 300, 600):
+            thumb_fn = thumbs.legacy_fn(fn) if size is None else \
+                thumbs.variant_fn(fn, size, "jpg")
+            cp(fn, thumb_fn)
+        map_fns, _page_fns, vendor, chipid = img2doku.process_fns(
+            ["dev/map/signetics/25120"])
+        assert map_fns == [fn]
+        assert (vendor, chipid) == ("signetics", "25120")
+
+    def test_imgs2doku(self):
+        """
+        One page per chip at dir_out/vendor/chipid.txt, replaced on rerun
+        """
+        os.makedirs("dev/imgs")
+        for flavor in ("mz", "pol"):
+            cp("test/sipager/mcmaster_signetics_25120_die.jpg",
+               "dev/imgs/signetics_25120_mcmaster_%s.jpg" % flavor)
+        report = imgs2doku.run("dev/imgs", "dev/pages")
+        assert (report["wrote"], report["errors"]) == (1, 0)
+        page_fn = "dev/pages/signetics/25120.txt"
+        with open(page_fn) as f:
+            txt = f.read()
+        assert "signetics_25120_mcmaster_pol.jpg" in txt
+
+        report = imgs2doku.run("dev/imgs", "dev/pages")
+        assert (report["wrote"], report["exists"], report["errors"]) == (1, 1,
+                                                                       0)
+        with open(page_fn) as f:
+            assert f.read() == txt
+
+    def test_img2doku_run_many(self):
+        """
+        Bulk page generation reports each page
+        """
+        os.makedirs("dev/map/signetics/25120/single")
+        fn = "dev/map/signetics/25120/single/signetics_25120_mcmaster_mz.jpg"
+        cp("test/sipager/mcmaster_signetics_25120_die.jpg", fn)
+        pages = [
+            {"hi_fns": [fn], "collect": "mcmaster"},
+            {"vendor": "atmel", "chipid": "x1", "collect": "anonymous"},
+        ]
+        report = img2doku.run_many(pages, write=True, www_dir="dev")
+        assert (report["wrote"], report["exists"], report["errors"]) == (2, 0, 0)
+        assert report["pages"][0]["wiki_page"] == "mcmaster:signetics:25120"
+        assert os.path.exists(
+            "dev/archive/data/pages/anonymous/atmel/x1.txt")
+
+        # Existing pages are refused w/o write_lazy / overwrite
+        report = img2doku.run_many(pages, write=True, www_dir="dev")
+        assert (report["wrote"], report["exists"], report["errors"]) == (0, 2, 2)
+
 
 if __name__ == "__main__":
     unittest.main()  # run all tests